@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Analytics.py
+Description:
+    The math behind the resample, rolling, returns and stats actions. Api fetches the bars
+    for a symbol / date range (just the fields it needs), these turn them into numpy arrays
+    and do the work on whole arrays, so only the (much smaller) answer goes back over the
+    wire.
+
+        resample  OHLCV bars per week (W), month (M), quarter (Q) or year (Y)
+        rolling   rolling mean / std / min / max / sum of a field over `window` bars
+        returns   simple or log returns of a field over `period` bars
+        stats     count, first / last, min / max, mean, std, total return, annualized
+                  volatility and max drawdown of a field
+
+    Needs numpy on the server. Api answers with an error if it isn't installed.
+"""
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import Columnar
+
+ACTIONS = ("resample", "rolling", "returns", "stats")
+PERIODS = ("D", "W", "M", "Q", "Y")
+ROLLING = ("mean", "std", "min", "max", "sum")
+BAR_FIELDS = ("Open", "High", "Low", "Close", "Volume")
+TRADING_DAYS = 252
+_DAY_MS = 86400000
+
+
+def parse_date(value):
+    """ A datetime from "2020-01-31" or "2020-01-31T16:00:00". Raises ValueError.
+    """
+    return datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+def date_filter(start=None, end=None, field="Date"):
+    """ Mongo filter for start <= field <= end (a date only end takes in that whole day).
+        Date may be stored as an iso string or a real date, mongo only compares a value with
+        bounds of the same type, so there is one clause for each.
+    """
+    strings, dates = {}, {}
+    if start:
+        begin = parse_date(start)
+        strings["$gte"] = begin.date().isoformat() if begin.time() == datetime.time() else begin.isoformat()
+        dates["$gte"] = begin
+    if end:
+        finish = parse_date(end)
+        if len(str(end)) <= 10:
+            finish += datetime.timedelta(days=1)
+            strings["$lt"] = finish.date().isoformat()
+            dates["$lt"] = finish
+        else:
+            strings["$lte"] = finish.isoformat()
+            dates["$lte"] = finish
+    if not dates:
+        return {}
+    return {"$or": [{field: strings}, {field: dates}]}
+
+
+def to_arrays(docs, fields, date_field="Date"):
+    """ (dates, {field: float64 array}) from the fetched documents, in date order. Dates are
+        datetime64[ms], missing or unreadable values are NaN.
+    """
+    raw = [doc.get(date_field) for doc in docs]
+    try:
+        dates = numpy.array(raw, dtype="datetime64[ms]")
+    except (ValueError, TypeError):
+        # time zones, or something numpy won't parse
+        dates = numpy.array([Columnar.NAT if value is None else Columnar.to_millis(value) for value in raw],
+                            dtype="int64").view("datetime64[ms]")
+    columns = {}
+    for field in fields:
+        values = [doc.get(field) for doc in docs]
+        try:
+            # parses the Volume strings in C
+            columns[field] = numpy.array(values, dtype="float64")
+        except (ValueError, TypeError):
+            columns[field] = numpy.array([_float(value) for value in values], dtype="float64")
+
+    keep = ~numpy.isnat(dates)
+    order = numpy.argsort(dates[keep], kind="stable")
+    return dates[keep][order], {field: values[keep][order] for field, values in columns.items()}
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+
+def date_strings(dates):
+    """ Dates for the response: "2020-01-31" when they're all midnight, else to the second.
+    """
+    millis = dates.view("int64")
+    return numpy.datetime_as_string(dates, unit="D" if (millis % _DAY_MS == 0).all() else "s").tolist()
+
+
+def _values(array):
+    # json has no NaN, send null
+    return [None if value != value else value for value in array.tolist()]
+
+
+def _rows(**columns):
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+
+def period_keys(dates, every):
+    """ A number per bar that's the same for every bar in the same period.
+    """
+    if every == "D":
+        return dates.astype("datetime64[D]").view("int64")
+    if every == "W":
+        # numpy weeks start on Thursday (1970-01-01), shift so they start on Monday
+        return (dates.astype("datetime64[D]") + numpy.timedelta64(3, "D")).astype("datetime64[W]").view("int64")
+    months = dates.astype("datetime64[M]").view("int64")
+    if every == "M":
+        return months
+    if every == "Q":
+        return months // 3
+    return months // 12
+
+
+def resample(dates, columns, every):
+    """ OHLCV bars per period: first Open, highest High, lowest Low, last Close, total
+        Volume, and how many bars went into it. Date is the first bar's day.
+    """
+    if not len(dates):
+        return []
+    keys = period_keys(dates, every)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(keys)) + 1))
+    ends = numpy.concatenate((starts[1:], [len(dates)])) - 1
+    # fmax / fmin skip NaN
+    return _rows(
+        Date=numpy.datetime_as_string(dates[starts], unit="D").tolist(),
+        Open=_values(columns["Open"][starts]),
+        High=_values(numpy.fmax.reduceat(columns["High"], starts)),
+        Low=_values(numpy.fmin.reduceat(columns["Low"], starts)),
+        Close=_values(columns["Close"][ends]),
+        Volume=_values(numpy.add.reduceat(numpy.nan_to_num(columns["Volume"]), starts)),
+        Bars=(ends - starts + 1).tolist(),
+    )
+
+
+def rolling(dates, values, window, stat):
+    """ `stat` over each run of `window` bars, dated by the last bar of the run.
+    """
+    if len(values) < window:
+        return []
+    if stat in ("mean", "sum") and not numpy.isnan(values).any():
+        # running totals, O(n) whatever the window (a NaN would spoil every total after it)
+        totals = numpy.cumsum(numpy.concatenate(([0.0], values)))
+        result = totals[window:] - totals[:-window]
+        if stat == "mean":
+            result /= window
+    else:
+        windows = numpy.lib.stride_tricks.sliding_window_view(values, window)
+        if stat == "std":
+            result = windows.std(axis=1, ddof=1) if window > 1 else numpy.zeros(len(windows))
+        else:
+            result = getattr(windows, stat)(axis=1)
+    return _rows(Date=date_strings(dates[window - 1:]), Value=_values(result))
+
+
+def returns(dates, values, period, kind):
+    """ Simple (x[t] / x[t-period] - 1) or log returns, dated by the later bar.
+    """
+    if len(values) <= period:
+        return []
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ratio = values[period:] / values[:-period]
+        result = numpy.log(ratio) if kind == "log" else ratio - 1
+    result[~numpy.isfinite(result)] = numpy.nan
+    return _rows(Date=date_strings(dates[period:]), Return=_values(result))
+
+
+def stats(dates, values):
+    """ Summary of one field over the range. Volatility is the std of the bar to bar log
+        returns scaled by sqrt(252), so it assumes daily bars.
+    """
+    values = values[~numpy.isnan(values)] if len(values) else values
+    if not len(values):
+        return {"count": 0}
+    first, last = values[0], values[-1]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        logs = numpy.diff(numpy.log(values))
+        drawdown = values / numpy.maximum.accumulate(values) - 1
+    logs = logs[numpy.isfinite(logs)]
+    days = date_strings(dates[[0, -1]])
+
+    def number(value):
+        value = float(value)
+        return value if numpy.isfinite(value) else None
+
+    return {
+        "count": int(len(values)),
+        "start": days[0],
+        "end": days[1],
+        "first": number(first),
+        "last": number(last),
+        "min": number(values.min()),
+        "max": number(values.max()),
+        "mean": number(values.mean()),
+        "std": number(values.std(ddof=1)) if len(values) > 1 else None,
+        "total_return": number(last / first - 1) if first else None,
+        "volatility": number(logs.std(ddof=1) * numpy.sqrt(TRADING_DAYS)) if len(logs) > 1 else None,
+        "max_drawdown": number(numpy.nanmin(drawdown)),
+    }
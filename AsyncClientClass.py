@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+AsyncClientClass.py
+Description:
+    An asyncio client for the server. One connection, any number of requests in flight at
+    once: every request is tagged with a request id and gets its own future, and a reader
+    task resolves the futures as the tagged responses come back.
+
+    Example:
+        async def main():
+            client = AsyncClient("192.168.1.177", 6000)
+            await client.connect()
+            info, bars = await asyncio.gather(
+                client.request(Request().createRequest(action="searchkey", collection="info", key="Symbol", value="GOOG")),
+                client.request(Request().createRequest(action="search", collection="data_med", params='{"Symbol":"GOOG"}')),
+            )
+            async for row in client.stream(Request().createRequest(action="search", collection="data_med", params='{"Symbol":"GOOG"}')):
+                print(row)
+            await client.close()
+Requires:
+    Message.py :: ClientMessage  (used for its framing only)
+"""
+import config
+import asyncio
+import traceback
+
+from Message import ClientMessage
+from ClientClass import Request
+
+
+class AsyncClient:
+    def __init__(self, host=None, port=None, timeout=None, debug=False):
+        self.host = host or config.host
+        self.port = int(port or config.port)
+        self.timeout = timeout
+        self.debug = debug
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.message = None
+        self.connecting = None
+        self.pending = {}       # request id -> future waiting on its response
+        self.streams = {}       # request id -> queue of (stream header, response) frames
+        self.response = None    # final frame of the last stream()
+        self._next_request_id = 0
+
+    async def connect(self):
+        if self.connecting is None:
+            # Lots of requests can start at once, only the first one opens the connection
+            self.connecting = asyncio.Lock()
+        async with self.connecting:
+            if self.writer is not None:
+                return
+            addr = (self.host, self.port)
+            if self.debug:
+                print("starting connection to", addr)
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            # No selector or socket: the message object is only used to frame requests
+            self.message = ClientMessage(None, None, addr)
+            self.listener = asyncio.create_task(self.read_responses())
+
+    async def read_responses(self):
+        message = self.message
+        try:
+            while True:
+                header = await message.read_header(self.reader)
+                if header is None:
+                    # hung up between frames
+                    raise asyncio.IncompleteReadError(b"", 2)
+                jsonheader = header[0]
+                data = await self.reader.readexactly(jsonheader["content-length"])
+                response = message.decode_content(data, jsonheader)
+                message.negotiated(jsonheader)
+                stream = self.streams.get(jsonheader.get("request-id"))
+                if stream is not None:
+                    stream.put_nowait((jsonheader.get("stream"), response))
+                    continue
+                future = self.pending.pop(jsonheader.get("request-id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.debug and not isinstance(e, asyncio.IncompleteReadError):
+                print("main: error: exception for", f"{message.addr}:\n{traceback.format_exc()}")
+            # Connection is gone, nobody still waiting is going to get an answer
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Connection to {message.addr} closed."))
+            self.pending.clear()
+            for stream in self.streams.values():
+                stream.put_nowait(("error", ConnectionError(f"Connection to {message.addr} closed.")))
+            # Forget the dead connection so the next request opens a new one instead of
+            # writing into it and waiting forever
+            self.writer.close()
+            self.reader = self.writer = self.listener = None
+
+    async def request(self, request, timeout=None):
+        """ Sends one request and waits for its response. Many of these can be awaited at
+            the same time (asyncio.gather) over the one connection.
+        """
+        await self.connect()
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        self.writer.write(self.message.encode_request(request, request_id))
+        await self.writer.drain()
+        try:
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        finally:
+            # Timed out or cancelled: forget it, a late answer is dropped
+            self.pending.pop(request_id, None)
+
+    async def stream(self, request, timeout=None):
+        """ Async generator: sends a search / searchkey with "stream" set and yields the rows
+            as each chunk arrives. `timeout` is how long to wait for each chunk. The final
+            frame (count or error) is left in self.response.
+        """
+        if not request["content"].get("stream"):
+            request = dict(request, content=dict(request["content"], stream=True))
+        await self.connect()
+        request_id = self._next_request_id
+        self._next_request_id += 1
+        frames = self.streams[request_id] = asyncio.Queue()
+        try:
+            self.writer.write(self.message.encode_request(request, request_id))
+            await self.writer.drain()
+            while True:
+                stream, response = await asyncio.wait_for(frames.get(), timeout or self.timeout)
+                if stream == "error":
+                    raise response
+                for row in response.get("results", {}).get("data", []):
+                    yield row
+                if stream != "chunk":
+                    self.response = response
+                    break
+        finally:
+            self.streams.pop(request_id, None)
+
+    async def batch(self, requests, timeout=None):
+        """ Sends a list of requests as one batch request, the response has one result per
+            request in order. See Client.batch.
+        """
+        contents = [request.get("content", request) for request in requests]
+        return await self.request(Request().createRequest(action="batch", requests=contents), timeout)
+
+    async def gather(self, requests, timeout=None):
+        """ Sends all the requests concurrently and returns the responses in request order.
+        """
+        return await asyncio.gather(*(self.request(request, timeout) for request in requests))
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.listener.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        self.reader = self.writer = self.listener = None
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+AsyncServerClass.py
+Description:
+    An asyncio version of ServerClass.Server. It speaks exactly the same wire format
+    (v1 json headers or v2 binary ones, see Protocol.py), so every existing client works with it.
+    Each connection gets a reader coroutine that pulls frames off the socket and starts a
+    task per request, and a writer coroutine that sends the answers back in request order.
+    Database work still runs on threads (loop.run_in_executor) so the event loop only does
+    I/O, and every request is limited to config.request_timeout seconds. Streamed searches
+    are sent a chunk at a time as the writer gets to them.
+Requires:
+    Message.py :: ServerMessage  (used for its framing and Api plumbing, not its socket code)
+
+    Start it with:  ./Server.py mode=async
+"""
+import config
+import asyncio
+import signal
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from Message import Message, ServerMessage, ResponseSlot
+from Codecs import CODECS
+from DbHelpers import openPool
+from ResultCache import ResultCache, Versions
+from IndexAdvisor import IndexAdvisor
+from Metrics import Metrics, serve_http, LOOP_TICK
+from Profiler import Profiler
+
+
+class AsyncServer:
+    def __init__(self,db=None,host=None,port=None,threads=None,metrics=None,metrics_port=None):
+        self.db = db or config.database
+        self.host = host or config.host
+        self.port = int(port or config.port)
+        self.threads = threads or int(config.worker_threads)
+        self.timeout = config.request_timeout
+
+        # Same shared mongo pool (or memory store) as the selectors server
+        self.pool, self.db = openPool(self.db)
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="db-worker")
+        self.cache = ResultCache(config.cache_max_bytes, config.cache_ttl) if config.cache_enabled else None
+        self.batch = ThreadPoolExecutor(max_workers=config.batch_threads, thread_name_prefix="batch-worker")
+        self.advisor = IndexAdvisor(config.index_auto, config.index_auto_min_count, config.index_auto_min_ms,
+                                    config.index_max_shapes) if config.index_advisor else None
+        if metrics is None:
+            metrics = config.metrics_enabled
+        self.metrics = Metrics() if metrics else None
+        self.metrics_port = config.metrics_port if metrics_port is None else metrics_port
+        self.profiler = Profiler()
+        self.versions = Versions(config.version_ttl) if config.versions_enabled else None
+        self.connections = 0
+        self.server = None
+
+    async def read_frame(self, reader, message):
+        """ Reads one whole frame. Returns (jsonheader, content) or None if the client hung up
+            cleanly between frames.
+        """
+        header = await message.read_header(reader)
+        if header is None:
+            return None
+        jsonheader, header_size = header
+        data = await reader.readexactly(jsonheader["content-length"])
+        if self.metrics is not None:
+            self.metrics.received(header_size + len(data))
+        return jsonheader, message.decode_content(data, jsonheader)
+
+    async def respond(self, message, request, jsonheader, slot):
+        """ Runs the query + encoding on a worker thread and returns the response frame.
+            `slot` (Message.ResponseSlot) only carries the request's timer and capture here.
+        """
+        loop = asyncio.get_running_loop()
+        job = lambda: message.answer(request, jsonheader, slot.timer, slot.capture)
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(self.executor, job), self.timeout)
+        except asyncio.TimeoutError:
+            result = {"results":{"Error":f"Request timed out after {self.timeout} seconds."}}
+        except Exception as e:
+            print("worker: error:", traceback.format_exc())
+            result = {"results":{"Error":f"Server error: {e!r}"}}
+        slot.failed()
+        return message.create_response(result, request, jsonheader)
+
+    async def stream(self, message, request, jsonheader, slot):
+        """ Async generator over the frames of a streamed search. Each chunk is pulled off the
+            cursor and encoded on a worker thread only when the writer asks for it, so no more
+            than one chunk is ever waiting on a slow client.
+        """
+        frames = message.stream_frames(request, jsonheader)
+        pending = None
+        try:
+            while True:
+                pending = self.executor.submit(next, frames, None)
+                try:
+                    frame = await asyncio.wait_for(asyncio.wrap_future(pending), self.timeout)
+                except asyncio.TimeoutError:
+                    slot.failed()
+                    yield message.stream_error(f"Request timed out after {self.timeout} seconds.", request, jsonheader)
+                    return
+                except Exception as e:
+                    print("worker: error:", traceback.format_exc())
+                    slot.failed()
+                    yield message.stream_error(f"Server error: {e!r}", request, jsonheader)
+                    return
+                if frame is None:
+                    return
+                yield frame
+        finally:
+            # Close the cursor under the stream (timeout, error or the client went away). A
+            # worker may still be inside next(frames), so that waits for it to come back.
+            if pending is None:
+                frames.close()
+            else:
+                pending.add_done_callback(lambda future: frames.close())
+
+    async def write_responses(self, writer, responses):
+        """ Sends finished responses in the order the requests arrived. A streamed response
+            is sent frame by frame before moving on. A None means the reader is done.
+        """
+        while True:
+            item = await responses.get()
+            if item is None:
+                break
+            task, slot = item
+            frames = [await task] if isinstance(task, asyncio.Task) else task
+            if isinstance(frames, list):
+                for frame in frames:
+                    await self.send_frame(writer, frame)
+            else:
+                async for frame in frames:
+                    await self.send_frame(writer, frame)
+            if slot.watched():
+                slot.sent()
+
+    async def send_frame(self, writer, frame):
+        writer.writelines(frame)
+        await writer.drain()
+        if self.metrics is not None:
+            self.metrics.sent(sum(len(segment) for segment in frame))
+
+    async def refuse(self, writer, addr):
+        """ Over config.max_connections: say so and hang up (see ServerClass.Server.refuse).
+        """
+        print("refused connection from", addr, "(max_connections)")
+        if self.metrics is not None:
+            self.metrics.connection_refused()
+        writer.write(Message(None, None, addr).refusal("Server busy: too many connections, try again later."))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def handle_connection(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        if config.max_connections and self.connections >= config.max_connections:
+            await self.refuse(writer, addr)
+            return
+        self.connections += 1
+        print("accepted connection from", addr)
+        # No selector or socket: the message object is only used to frame and answer requests
+        message = ServerMessage(None, None, addr, self.db, self.pool, cache=self.cache, batch=self.batch, advisor=self.advisor,
+                                metrics=self.metrics, profiler=self.profiler,
+                                versions=self.versions)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+        # Backpressure: the reader waits while max_in_flight answers are queued, and drain()
+        # waits while more than send_high_water bytes haven't gone out
+        responses = asyncio.Queue(maxsize=config.max_in_flight or 0)
+        if config.send_high_water:
+            writer.transport.set_write_buffer_limits(config.send_high_water, config.send_low_water)
+        sender = asyncio.create_task(self.write_responses(writer, responses))
+        try:
+            while True:
+                frame = await self.read_frame(reader, message)
+                if frame is None:
+                    break
+                jsonheader, request = frame
+                if jsonheader["content-type"] in CODECS:
+                    print("received request", repr(request), "from", addr)
+                slot = ResponseSlot(timer=self.metrics.timer(request) if self.metrics is not None else None,
+                                    capture=self.profiler.capture(request))
+                if responses.full() and self.metrics is not None:
+                    # the put below waits for the writer to catch up
+                    self.metrics.paused()
+                if message.wants_stream(request, jsonheader):
+                    # Runs when the writer gets to it, one chunk at a time
+                    await responses.put((self.stream(message, request, jsonheader, slot), slot))
+                    continue
+                # Start on it now, pipelined requests are worked on concurrently
+                await responses.put((asyncio.create_task(self.respond(message, request, jsonheader, slot)), slot))
+            await responses.put(None)
+            await sender
+        except (asyncio.CancelledError, ConnectionError):
+            sender.cancel()
+        except Exception:
+            print("main: error: exception for", f"{addr}:\n{traceback.format_exc()}")
+            sender.cancel()
+        finally:
+            self.connections -= 1
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+            writer.close()
+
+    async def watch_loop(self):
+        """ There's no select() to time here, so this measures how late a timer fires: a busy
+            or blocked event loop makes it late.
+        """
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_TICK)
+            self.metrics.loop_time(max(0.0, time.perf_counter() - started - LOOP_TICK))
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        print("listening on", (self.host, self.port), "(asyncio)")
+        loop = asyncio.get_running_loop()
+        metrics_http = watcher = None
+        if self.metrics is not None:
+            watcher = asyncio.create_task(self.watch_loop())
+            if self.metrics_port:
+                metrics_http = serve_http(self.metrics, self.host, int(self.metrics_port))
+                print("metrics on", f"http://{self.host}:{self.metrics_port}/metrics")
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.server.close)
+        except (NotImplementedError, RuntimeError):
+            # Not on the main thread / not supported on this platform
+            pass
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+                if metrics_http is not None:
+                    metrics_http.shutdown()
+
+    def run_server(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("caught keyboard interrupt, exiting")
+        finally:
+            self.executor.shutdown(wait=False)
+            self.batch.shutdown(wait=False)
+            self.pool.close()
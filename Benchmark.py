@@ -0,0 +1,1157 @@
+#!/usr/bin/env python3
+""" Benchmark.py
+Description:
+    Quick benchmarks for the client / server. Servers are started as separate processes on
+    127.0.0.1 so they don't fight the load generator for the GIL. Results are printed as json.
+Requires:
+    ClientClass.py, AsyncClientClass.py, Server.py
+Usage:
+    ./Benchmark.py bench=transport requests=5000 concurrency=50 port=6100
+    ./Benchmark.py bench=transport action=searchkey db=memory://   (no mongo needed)
+    ./Benchmark.py bench=buffers mb=8 chunk=65536
+    ./Benchmark.py bench=stream rows=200000 chunk=500
+    ./Benchmark.py bench=codecs rows=50000 rounds=3
+    ./Benchmark.py bench=compression rows=5000 levels=1,6,9
+    ./Benchmark.py bench=columnar rows=50000 rounds=3
+    ./Benchmark.py bench=analytics rows=2520 rounds=5
+    ./Benchmark.py bench=memory rows=100000 queries=200
+    ./Benchmark.py bench=history rows=200000 symbols=50 queries=100
+    ./Benchmark.py bench=load mix=test:1,searchkey:4,search:4,insert:1 concurrency=16 duration=10
+    ./Benchmark.py bench=load rate=500 duration=30 mode=async
+    ./Benchmark.py bench=load host=10.0.61.34 port=6000 collection=data_med rows=0 mix=searchkey
+    ./Benchmark.py bench=metrics duration=5 concurrency=8 rounds=2
+    ./Benchmark.py bench=clientpool requests=2000 threads=8 size=4
+    ./Benchmark.py bench=versions rows=5000 requests=200
+    ./Benchmark.py bench=slowclient clients=4 rows=2000 duration=5
+    ./Benchmark.py bench=protocol requests=5000 mode=async
+"""
+import config
+import sys
+import os
+import time
+import json
+import socket
+import signal
+import struct
+import asyncio
+import subprocess
+import tracemalloc
+from helpers import myArgParse
+from ClientClass import Client
+from ClientClass import Request
+from AsyncClientClass import AsyncClient
+
+HOST = "127.0.0.1"
+
+
+def Usage():
+    print(f"Usage: {sys.argv[0]} bench=<{'|'.join(BENCHMARKS)}> [requests=N] [concurrency=N] [port=N]")
+    sys.exit()
+
+
+def start_server(port, **kwargs):
+    """ Starts ./Server.py in its own process and waits until it accepts connections.
+        kwargs become key=value arguments (mode=async, workers=4, ...).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    args = [sys.executable, os.path.join(here, "Server.py"), f"host={HOST}", f"port={port}"]
+    args += [f"{k}={v}" for k, v in kwargs.items()]
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL, cwd=here)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"Server on port {port} never came up.")
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def rate(count, seconds):
+    return round(count / seconds, 1) if seconds else None
+
+
+def one_shot(port, count, request):
+    """ The original client: a new connection for every request.
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        client = Client(HOST, port)
+        client.start_connection(request)
+    return rate(count, time.perf_counter() - start)
+
+
+def pipelined(port, count, concurrency, request):
+    """ One keep-alive connection, `concurrency` requests written before reading answers.
+    """
+    client = Client(HOST, port)
+    client.connect()
+    start = time.perf_counter()
+    done = 0
+    while done < count:
+        batch = min(concurrency, count - done)
+        client.pipeline([request] * batch)
+        done += batch
+    elapsed = time.perf_counter() - start
+    client.close()
+    return rate(count, elapsed)
+
+
+def async_concurrent(port, count, concurrency, request):
+    """ AsyncClient on one connection with up to `concurrency` requests in flight.
+    """
+    async def run():
+        client = AsyncClient(HOST, port)
+        await client.connect()
+        limit = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with limit:
+                await client.request(request)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(count)))
+        elapsed = time.perf_counter() - start
+        await client.close()
+        return elapsed
+
+    return rate(count, asyncio.run(run()))
+
+
+def bench_transport(kwargs):
+    """ selectors server vs asyncio server, each driven by the three client styles.
+    """
+    port = int(kwargs.get("port", 6100))
+    count = int(kwargs.get("requests", 5000))
+    concurrency = int(kwargs.get("concurrency", 50))
+    request = Request().createRequest(action=kwargs.get("action", "test"))
+
+    results = {"requests": count, "concurrency": concurrency, "requests_per_second": {}}
+    for mode in ("selectors", "async"):
+        proc = start_server(port, mode=mode, **({"db": kwargs["db"]} if "db" in kwargs else {}))
+        try:
+            results["requests_per_second"][mode] = {
+                "one_shot": one_shot(port, max(1, count // 10), request),
+                "keep_alive_pipelined": pipelined(port, count, concurrency, request),
+                "async_client": async_concurrent(port, count, concurrency, request),
+            }
+        finally:
+            stop_server(proc)
+    return results
+
+
+class FakeSocket:
+    """ In-memory stand-in for a non-blocking socket. Hands out / accepts at most `chunk` bytes
+        per call so big frames arrive in pieces, like they do over a real network.
+    """
+    def __init__(self, data=b"", chunk=65536):
+        self.data = data
+        self.pos = 0
+        self.chunk = chunk
+        self.sent = 0
+
+    def recv(self, size):
+        if self.pos >= len(self.data):
+            raise BlockingIOError
+        data = self.data[self.pos:self.pos + min(size, self.chunk)]
+        self.pos += len(data)
+        return data
+
+    def recv_into(self, view, size):
+        data = self.recv(min(size, len(view)))
+        view[:len(data)] = data
+        return len(data)
+
+    def send(self, data):
+        sent = min(len(data), self.chunk)
+        self.sent += sent
+        return sent
+
+    def sendmsg(self, buffers):
+        room = self.chunk
+        for buffer in buffers:
+            room -= min(room, len(buffer))
+        self.sent += self.chunk - room
+        return self.chunk - room
+
+
+class LegacyBuffers:
+    """ The receive / send code as it was before the buffer rework (bytes += and re-slicing),
+        with a counter for every byte copied in user space.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.copied = 0
+        self._recv_buffer = b""
+        self._send_buffer = b""
+
+    def receive_frame(self):
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except BlockingIOError:
+                break
+            self.copied += len(self._recv_buffer) + len(data)   # bytes += bytes
+            self._recv_buffer += data
+        jsonheader_len = struct.unpack(">H", self._recv_buffer[:2])[0]
+        self.copied += 2 + len(self._recv_buffer) - 2           # [:2] and [2:]
+        self._recv_buffer = self._recv_buffer[2:]
+        jsonheader = json.loads(self._recv_buffer[:jsonheader_len])
+        self.copied += len(self._recv_buffer)                   # [:hdrlen] and [hdrlen:]
+        self._recv_buffer = self._recv_buffer[jsonheader_len:]
+        content_len = jsonheader["content-length"]
+        data = self._recv_buffer[:content_len]
+        self.copied += len(self._recv_buffer)                   # [:len] and [len:]
+        self._recv_buffer = self._recv_buffer[content_len:]
+        self.copied += len(data)                                # io.BytesIO(data) in _json_decode
+        return json.loads(data)
+
+    def send_frame(self, header, content):
+        self._send_buffer = header + content
+        self.copied += len(self._send_buffer)
+        while self._send_buffer:
+            sent = self.sock.send(self._send_buffer)
+            self.copied += len(self._send_buffer) - sent        # _send_buffer[sent:]
+            self._send_buffer = self._send_buffer[sent:]
+
+
+def bench_buffers(kwargs):
+    """ Bytes copied in user space per MB moved through Message, before and after the
+        bytearray / memoryview rework. Kernel copies and the json decode itself are the same
+        either way and are not counted.
+    """
+    from Message import ClientMessage
+
+    class CountingMessage(ClientMessage):
+        copied = 0
+
+        def _recv_reserve(self, size):
+            before = (self._recv_start, len(self._recv_buffer))
+            super()._recv_reserve(size)
+            if before[0] and self._recv_start == 0:
+                self.copied += self._recv_available()       # slid unread bytes to the front
+            if len(self._recv_buffer) != before[1]:
+                self.copied += before[1]                    # bytearray grew (may realloc)
+
+    mb = float(kwargs.get("mb", 8))
+    chunk = int(kwargs.get("chunk", 65536))
+    row = {"Date": "2018-01-02T12:00:00", "Open": 1048.34, "High": 1066.94, "Low": 1045.23, "Close": 1065.0,
+           "Volume": "1237600", "Symbol": "GOOG", "AdjClose": 1065.0, "Name": "GOOG-2018-01-02", "Year": 2018, "Month": 1}
+    rows = int(mb * 1024 * 1024 / len(json.dumps(row)))
+    content = json.dumps({"results": {"success": True, "count": rows, "data": [row] * rows}}).encode()
+    framer = CountingMessage(None, None, None)
+    header, content = framer._create_frame(content_bytes=content, content_type="text/json", content_encoding="utf-8")
+    frame = header + content
+    megabytes = len(frame) / (1024 * 1024)
+
+    results = {"frame_mb": round(megabytes, 2), "socket_chunk": chunk, "recv_chunk_size": config.recv_chunk_size}
+
+    legacy = LegacyBuffers(FakeSocket(frame, chunk))
+    start = time.perf_counter()
+    legacy.receive_frame()
+    recv_seconds = time.perf_counter() - start
+    recv_copied, legacy.copied = legacy.copied, 0
+    legacy.sock = FakeSocket(chunk=chunk)
+    start = time.perf_counter()
+    legacy.send_frame(header, content)
+    results["before"] = {
+        "recv_bytes_copied_per_mb": round(recv_copied / megabytes),
+        "recv_seconds": round(recv_seconds, 4),
+        "send_bytes_copied_per_mb": round(legacy.copied / megabytes),
+        "send_seconds": round(time.perf_counter() - start, 4),
+    }
+
+    message = CountingMessage(None, FakeSocket(frame, chunk), None, keep_alive=True)
+    start = time.perf_counter()
+    while message.sock.pos < len(frame):
+        message._read()
+        message.process_frames()
+    recv_seconds = time.perf_counter() - start
+    message.sock = FakeSocket(chunk=chunk)
+    start = time.perf_counter()
+    message._queue_send([header, content])
+    while message._send_queue:
+        message._write()
+    results["after"] = {
+        "recv_bytes_copied_per_mb": round(message.copied / megabytes),
+        "recv_seconds": round(recv_seconds, 4),
+        # only the small protoheader + json header concatenation is copied
+        "send_bytes_copied_per_mb": round(len(header) / megabytes),
+        "send_seconds": round(time.perf_counter() - start, 4),
+    }
+    return results
+
+
+def bench_stream(kwargs):
+    """ Peak server memory for a big search answered as one response (every row in a list,
+        then one json body) vs streamed in chunks. Rows are made up on the fly the way a
+        mongo cursor hands them over, and streamed frames are dropped as if they were sent.
+    """
+    from Message import ServerMessage
+
+    count = int(kwargs.get("rows", 200000))
+    chunk = int(kwargs.get("chunk", config.stream_chunk_rows))
+    request = {"action": "search", "collection": "data_med", "stream": chunk}
+    jsonheader = {"content-type": "text/json", "request-id": 0}
+    message = ServerMessage(None, None, None)
+
+    def cursor():
+        for i in range(count):
+            yield {"_id": f"{i:024x}", "Date": "2018-01-02T12:00:00", "Open": 1048.34, "High": 1066.94,
+                   "Low": 1045.23, "Close": 1065.0, "Volume": "1237600", "Symbol": "GOOG",
+                   "AdjClose": 1065.0, "Name": f"GOOG-{i}", "Year": 2018, "Month": 1}
+
+    results = {"rows": count, "chunk_rows": chunk}
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = list(cursor())
+    frame = message.create_response({"results": {"success": True, "count": len(rows), "data": rows}}, request, jsonheader)
+    results["single_response"] = {
+        "bytes": sum(len(segment) for segment in frame),
+        "peak_mb": round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2),
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+    del rows, frame
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    sent = frames = 0
+    for frame in message.chunk_frames(cursor(), chunk, request, jsonheader):
+        sent += sum(len(segment) for segment in frame)
+        frames += 1
+    results["streamed"] = {
+        "bytes": sent,
+        "frames": frames,
+        "peak_mb": round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2),
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+    tracemalloc.stop()
+    return results
+
+
+def stock_rows(count):
+    """ Made up daily bars shaped like data_med documents, with prices that move around so
+        the numbers aren't all the same.
+    """
+    import random
+    random.seed(count)
+    price = 1048.34
+    rows = []
+    for i in range(count):
+        price = round(price * random.uniform(0.97, 1.03), 2)
+        rows.append({"_id": f"5e72a5881c54daa33e{i:06x}", "Date": f"{2000 + i // 365 % 20}-{i % 12 + 1:02d}-{i % 28 + 1:02d}T12:00:00",
+                     "Open": price, "High": round(price * 1.01, 2), "Low": round(price * 0.99, 2), "Close": price,
+                     "Volume": str(random.randint(100000, 5000000)), "Symbol": "GOOG", "AdjClose": price,
+                     "Name": f"GOOG-{i}", "Year": 2000 + i // 365 % 20, "Month": i % 12 + 1})
+    return rows
+
+
+def round_tripped(codec, body, decoded, result):
+    """ True if a decoded body is the result that was encoded. Columnar comes back as
+        {field: array} with date strings turned into timestamps and number strings into ints,
+        so its rows are compared column type by column type.
+    """
+    import datetime
+    import Columnar
+
+    if codec.name != "columnar":
+        return decoded == result
+    kinds = {column["name"]: column["type"] for column in Columnar.read_meta(body).get("columns", [])}
+
+    def plain(name, value):
+        if kinds.get(name) == "ts":
+            # a datetime (numpy) or epoch milliseconds (array) back, an iso string going in
+            return Columnar.to_millis(value) if isinstance(value, (str, datetime.datetime)) else int(value)
+        return str(value)
+
+    rows = Columnar.to_rows(decoded["results"].pop("data"))
+    expected = result["results"]["data"]
+    return (
+        decoded["results"] == {key: value for key, value in result["results"].items() if key != "data"}
+        and [{name: plain(name, value) for name, value in row.items()} for row in rows]
+        == [{name: plain(name, value) for name, value in row.items()} for row in expected]
+    )
+
+
+def bench_codecs(kwargs):
+    """ Encode / decode speed and body size of a search response in every registered codec
+        (and the pure python MessagePack when the msgpack package is what's registered).
+    """
+    import Codecs
+    from Codecs import CODECS, Codec, MsgPack
+
+    count = int(kwargs.get("rows", 50000))
+    rounds = int(kwargs.get("rounds", 3))
+    result = {"results": {"success": True, "count": count, "data": stock_rows(count)}}
+
+    codecs = list(CODECS.values())
+    if Codecs.msgpack is not None:
+        codecs.append(Codec("msgpack-pure", "application/msgpack", "binary",
+                            lambda obj, encoding: MsgPack.packb(obj), lambda data, encoding: MsgPack.unpackb(data)))
+
+    results = {"rows": count, "codecs": {}}
+    for codec in codecs:
+        encode = decode = float("inf")
+        for _ in range(rounds):
+            start = time.perf_counter()
+            body = codec.encode(result, codec.encoding)
+            encode = min(encode, time.perf_counter() - start)
+            start = time.perf_counter()
+            decoded = codec.decode(memoryview(body), codec.encoding)
+            decode = min(decode, time.perf_counter() - start)
+        assert round_tripped(codec, body, decoded, result), f"{codec.name} did not round trip"
+        megabytes = len(body) / (1024 * 1024)
+        results["codecs"][codec.name] = {
+            "bytes": len(body),
+            "bytes_per_row": round(len(body) / count, 1),
+            "encode_rows_per_second": rate(count, encode),
+            "decode_rows_per_second": rate(count, decode),
+            "encode_mb_per_second": round(megabytes / encode, 1),
+            "decode_mb_per_second": round(megabytes / decode, 1),
+        }
+    return results
+
+
+def bench_compression(kwargs):
+    """ Compression ratio and CPU time of every installed compressor at a few levels, on a
+        search response encoded with each codec.
+    """
+    from Codecs import CODECS, COMPRESSORS
+
+    count = int(kwargs.get("rows", 5000))
+    levels = [int(level) for level in kwargs.get("levels", "1,6,9").split(",")]
+    result = {"results": {"success": True, "count": count, "data": stock_rows(count)}}
+
+    results = {"rows": count, "threshold": config.compress_threshold, "codecs": {}}
+    for codec in CODECS.values():
+        body = codec.encode(result, codec.encoding)
+        megabytes = len(body) / (1024 * 1024)
+        entry = results["codecs"][codec.name] = {"bytes": len(body)}
+        for compressor in COMPRESSORS.values():
+            for level in levels:
+                start = time.process_time()
+                compressed = compressor.compress(body, level)
+                compress_seconds = time.process_time() - start
+                start = time.process_time()
+                assert compressor.decompress(compressed) == body
+                decompress_seconds = time.process_time() - start
+                entry[f"{compressor.name}-{level}"] = {
+                    "bytes": len(compressed),
+                    "ratio": round(len(body) / len(compressed), 2),
+                    "compress_cpu_ms": round(compress_seconds * 1000, 2),
+                    "decompress_cpu_ms": round(decompress_seconds * 1000, 2),
+                    "compress_mb_per_second": round(megabytes / compress_seconds, 1) if compress_seconds else None,
+                }
+    return results
+
+
+def bench_columnar(kwargs):
+    """ Rows (json, msgpack) against columns for what analytics clients do with a search
+        result: decode it and pull out the price / volume series.
+    """
+    from Codecs import CODECS, get_codec
+
+    count = int(kwargs.get("rows", 50000))
+    rounds = int(kwargs.get("rounds", 3))
+    fields = ("Date", "Open", "High", "Low", "Close", "Volume")
+    result = {"results": {"success": True, "count": count, "data": stock_rows(count)}}
+
+    def series(decoded):
+        data = decoded["results"]["data"]
+        if isinstance(data, dict):
+            return [data[field] for field in fields]
+        return [[row[field] for row in data] for field in fields]
+
+    results = {"rows": count, "fields": fields, "codecs": {}}
+    for codec in [codec for codec in CODECS.values() if codec.name != "columnar"] + [get_codec("columnar")]:
+        encode = decode = extract = float("inf")
+        for _ in range(rounds):
+            start = time.perf_counter()
+            body = codec.encode(result, codec.encoding)
+            encode = min(encode, time.perf_counter() - start)
+            start = time.perf_counter()
+            decoded = codec.decode(memoryview(body), codec.encoding)
+            decode = min(decode, time.perf_counter() - start)
+            start = time.perf_counter()
+            columns = series(decoded)
+            extract = min(extract, time.perf_counter() - start)
+        assert list(columns[4]) == [row["Close"] for row in result["results"]["data"]]
+        results["codecs"][codec.name] = {
+            "bytes": len(body),
+            "bytes_per_row": round(len(body) / count, 1),
+            "encode_ms": round(encode * 1000, 2),
+            "decode_ms": round(decode * 1000, 2),
+            "extract_series_ms": round(extract * 1000, 2),
+            "client_total_ms": round((decode + extract) * 1000, 2),
+        }
+    return results
+
+
+def bench_analytics(kwargs):
+    """ Server side time and response size of resample / rolling / returns / stats over ten
+        years of daily bars (no mongo, the documents are made up), against shipping every bar.
+    """
+    import Analytics
+    if Analytics.numpy is None:
+        return {"Error": "Needs numpy (pip install numpy)."}
+
+    count = int(kwargs.get("rows", 2520))
+    rounds = int(kwargs.get("rounds", 5))
+    docs = stock_rows(count)
+    everything = len(json.dumps({"results": {"success": True, "count": count, "data": docs}}))
+
+    def timed(work):
+        best = float("inf")
+        for _ in range(rounds):
+            start = time.perf_counter()
+            answer = work()
+            best = min(best, time.perf_counter() - start)
+        return answer, round(best * 1000, 3)
+
+    (dates, columns), to_arrays = timed(lambda: Analytics.to_arrays(docs, Analytics.BAR_FIELDS))
+    close = columns["Close"]
+    actions = {
+        "resample": lambda: Analytics.resample(dates, columns, "M"),
+        "rolling": lambda: Analytics.rolling(dates, close, 50, "mean"),
+        "returns": lambda: Analytics.returns(dates, close, 1, "log"),
+        "stats": lambda: Analytics.stats(dates, close),
+    }
+    results = {"rows": count, "search_bytes": everything, "to_arrays_ms": to_arrays, "actions": {}}
+    for name, work in actions.items():
+        answer, ms = timed(work)
+        size = len(json.dumps({"results": answer}))
+        results["actions"][name] = {"compute_ms": ms, "bytes": size, "fraction_of_search": round(size / everything, 4)}
+    return results
+
+
+def bench_memory(kwargs):
+    """ Queries on the in-process store (db=memory://) with and without its indexes.
+    """
+    from MemoryStore import MemoryCollection
+
+    count = int(kwargs.get("rows", 100000))
+    queries = int(kwargs.get("queries", 200))
+    symbols = [f"S{i:03d}" for i in range(500)]
+    rows = stock_rows(count)
+    for i, row in enumerate(rows):
+        row["Symbol"] = symbols[i % len(symbols)]
+        row["Close"] = float(i)
+    tests = {
+        "equality": lambda i: {"Symbol": symbols[i % len(symbols)]},
+        "in": lambda i: {"Symbol": {"$in": symbols[i % 100:i % 100 + 5]}},
+        "range": lambda i: {"Close": {"$gte": float(i * 100), "$lt": float(i * 100 + 200)}},
+        "equality_sorted": lambda i: {"Symbol": symbols[i % len(symbols)], "Close": {"$gte": 0.0}},
+    }
+
+    results = {"rows": count, "queries": queries, "ms_per_query": {}}
+    saved = config.memory_auto_index
+    try:
+        for indexed in (False, True):
+            config.memory_auto_index = indexed
+            collection = MemoryCollection("bench")
+            collection.insert_many(dict(row) for row in rows)
+            label = "indexed" if indexed else "scan"
+            for name, query in tests.items():
+                list(collection.find(query(0)))     # builds the index when indexed
+                start = time.perf_counter()
+                for i in range(queries):
+                    list(collection.find(query(i)).sort("Close", -1).limit(50))
+                results["ms_per_query"].setdefault(name, {})[label] = round((time.perf_counter() - start) * 1000 / queries, 3)
+    finally:
+        config.memory_auto_index = saved
+    return results
+
+
+def bench_history(kwargs):
+    """ Searches on history served from mapped column files (ColumnStore.py) next to the
+        same documents in the indexed in-process store.
+    """
+    import shutil
+    import tempfile
+    from MemoryStore import MemoryCollection
+    from ColumnStore import ColumnCollection, ingest
+
+    count = int(kwargs.get("rows", 200000))
+    queries = int(kwargs.get("queries", 100))
+    symbols = [f"S{i:03d}" for i in range(int(kwargs.get("symbols", 50)))]
+    rows = stock_rows(count)
+    for i, row in enumerate(rows):
+        row["Symbol"] = symbols[i % len(symbols)]
+    tests = {
+        "symbol": lambda i: ({"Symbol": symbols[i % len(symbols)]}, None, 0),
+        "year": lambda i: ({"Symbol": symbols[i % len(symbols)], "Date": {"$gte": "2010-01-01", "$lt": "2011-01-01"}}, None, 0),
+        "year_projected": lambda i: ({"Symbol": symbols[i % len(symbols)], "Date": {"$gte": "2010-01-01", "$lt": "2011-01-01"}},
+                                     {"Date": 1, "Close": 1}, 0),
+        "page": lambda i: ({"Symbol": symbols[i % len(symbols)]}, None, 100),
+    }
+
+    path = tempfile.mkdtemp()
+    results = {"rows": count, "symbols": len(symbols), "queries": queries}
+    try:
+        start = time.perf_counter()
+        memory = MemoryCollection("bench")
+        memory.insert_many(dict(row) for row in rows)
+        list(memory.find({"Symbol": symbols[0], "Date": {"$gte": ""}}))     # builds its indexes
+        results["memory_load_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        results["ingest"] = ingest(memory, path)
+        column = ColumnCollection("bench", path)
+        start = time.perf_counter()
+        list(column.find({"Symbol": symbols[0]}).limit(1))
+        results["column_first_query_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+        results["ms_per_query"] = {}
+        for name, test in tests.items():
+            for label, collection in (("memory", memory), ("column", column)):
+                start = time.perf_counter()
+                for i in range(queries):
+                    query, projection, limit = test(i)
+                    found = list(collection.find(query, projection).sort([("Date", 1), ("_id", 1)]).limit(limit))
+                results["ms_per_query"].setdefault(name, {"rows": len(found)})[label] = round((time.perf_counter() - start) * 1000 / queries, 3)
+        column.close()
+    finally:
+        shutil.rmtree(path)
+    return results
+
+
+LOAD_ACTIONS = ("test", "searchkey", "search", "insert")
+
+
+def parse_mix(mix):
+    """ {"test": 1, "search": 4, ...} from "test:1,search:4". An action without a weight gets 1.
+    """
+    weights = {}
+    for item in mix.split(","):
+        action, _, weight = item.strip().partition(":")
+        if action not in LOAD_ACTIONS:
+            raise ValueError(f"Unknown action {action!r} in mix, pick from {', '.join(LOAD_ACTIONS)}.")
+        weights[action] = float(weight or 1)
+    if not any(weights.values()):
+        raise ValueError("The mix needs at least one action with a weight above 0.")
+    return weights
+
+
+def load_requests(collection, symbols, cache=None):
+    """ {action: function(random) -> request content} for the load mix.
+    """
+    extra = {"cache": cache} if cache else {}
+
+    def search(rng):
+        params = {"Symbol": rng.choice(symbols), "Close": {"$gte": round(rng.uniform(0, 2000), 2)}}
+        return dict(action="search", collection=collection, params=json.dumps(params), sort="-Date", limit=50, **extra)
+
+    def insert(rng):
+        price = round(rng.uniform(10, 2000), 2)
+        document = {"Symbol": rng.choice(symbols), "Date": time.strftime("%Y-%m-%d"), "Open": price,
+                    "High": price, "Low": price, "Close": price, "Volume": str(rng.randint(100, 10 ** 6))}
+        # insert takes its document as a json string
+        return dict(action="insert", collection=collection, data=json.dumps(document))
+
+    return {
+        "test": lambda rng: dict(action="test"),
+        "searchkey": lambda rng: dict(action="searchkey", collection=collection, key="Symbol", value=rng.choice(symbols), **extra),
+        "search": search,
+        "insert": insert,
+    }
+
+
+def response_error(response):
+    """ The error in a response, None if there isn't one.
+    """
+    results = response.get("results") if isinstance(response, dict) else None
+    if isinstance(results, dict) and "Error" in results:
+        return str(results["Error"])
+    result = response.get("result") if isinstance(response, dict) else None
+    if isinstance(result, str) and result.startswith("Error"):
+        return result
+    return None
+
+
+def percentiles(samples):
+    """ Latency summary in milliseconds from a list of seconds.
+    """
+    import math
+
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def rank(fraction):
+        # nearest rank, so p999 of 500 samples is the max rather than made up
+        return ordered[min(len(ordered), max(1, math.ceil(fraction * len(ordered)))) - 1]
+
+    summary = {f"p{label}": round(rank(fraction) * 1000, 3)
+               for label, fraction in (("50", 0.5), ("90", 0.9), ("99", 0.99), ("999", 0.999))}
+    summary["max"] = round(ordered[-1] * 1000, 3)
+    summary["mean"] = round(sum(ordered) / len(ordered) * 1000, 3)
+    return summary
+
+
+def run_load(host, port, weights, builders, duration, concurrency, target_rate=None, warmup=1.0, timeout=10.0):
+    """ Drives the mix at the server from `concurrency` threads, each with its own keep-alive
+        Client. With no target_rate every thread sends its next request as soon as the last one is
+        answered (closed loop). With one, requests are due every 1 / target_rate seconds whatever
+        happened to the ones before (open loop) and latency is counted from when a request
+        was due, so a server that falls behind shows it in the percentiles instead of just
+        slowing the generator down. Requests due in the first `warmup` seconds aren't counted.
+    """
+    import random
+    import threading
+
+    actions = [action for action in weights if weights[action] > 0]
+    chances = [weights[action] for action in actions]
+    lock = threading.Lock()
+    due_numbers = iter(range(10 ** 12))
+    start = time.perf_counter() + 0.2     # time for the threads to connect
+    measure_from = start + warmup
+    end = start + warmup + duration
+    results = []
+
+    def worker(number):
+        rng = random.Random(number)
+        samples = {action: [] for action in actions}
+        errors = {action: 0 for action in actions}
+        messages = []
+        lag = 0.0
+        client = Client(host, port)
+        client.connect()
+        time.sleep(max(0.0, start - time.perf_counter()))
+        while True:
+            if target_rate:
+                with lock:
+                    due = start + next(due_numbers) / target_rate
+                if due >= end:
+                    break
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    lag = max(lag, -wait)
+            else:
+                due = time.perf_counter()
+                if due >= end:
+                    break
+            action = rng.choices(actions, chances)[0]
+            request = Request().createRequest(**builders[action](rng))
+            try:
+                error = response_error(client.request(request, timeout))
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                client.close()      # whatever was in flight on it is lost, start over
+                client = Client(host, port)
+                client.connect()
+            finished = time.perf_counter()
+            if due < measure_from:
+                continue
+            samples[action].append(finished - due)
+            if error is not None:
+                errors[action] += 1
+                if len(messages) < 5:
+                    messages.append(f"{action}: {error}")
+        client.close()
+        with lock:
+            results.append((samples, errors, messages, lag))
+
+    threads = [threading.Thread(target=worker, args=(number,), daemon=True) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report = {"duration": duration, "concurrency": concurrency, "target_rate": target_rate, "mix": weights}
+    by_action = {}
+    everything, failures, messages, lag = [], 0, [], 0.0
+    for action in actions:
+        times = [value for samples, *_ in results for value in samples[action]]
+        failed = sum(errors[action] for _, errors, *_ in results)
+        everything += times
+        failures += failed
+        by_action[action] = {"requests": len(times), "errors": failed,
+                             "throughput": rate(len(times), duration), "latency_ms": percentiles(times)}
+    for _, _, found, behind in results:
+        messages += found
+        lag = max(lag, behind)
+    report.update(requests=len(everything), errors=failures, throughput=rate(len(everything), duration),
+                  latency_ms=percentiles(everything), actions=by_action, error_samples=messages[:10])
+    if target_rate:
+        # the generator couldn't keep up with the rate if this is big, more threads or processes
+        report["max_send_lag_ms"] = round(lag * 1000, 3)
+    return report
+
+
+def bench_load(kwargs):
+    """ A mix of test / searchkey / search / insert at a fixed concurrency or rate against a
+        local server (db=memory:// unless told otherwise) or one at host=. Reports throughput,
+        latency percentiles and errors, overall and per action.
+    """
+    port = int(kwargs.get("port", 6100))
+    host = kwargs.get("host")
+    collection = kwargs.get("collection", "loadtest")
+    symbols = [f"L{i:03d}" for i in range(int(kwargs.get("symbols", 100)))]
+    try:
+        weights = parse_mix(kwargs.get("mix", "test:1,searchkey:4,search:4,insert:1"))
+    except ValueError as e:
+        return {"Error": str(e)}
+    builders = load_requests(collection, symbols, kwargs.get("cache"))
+    seed = int(kwargs.get("rows", 10000))
+
+    proc = None
+    if host is None:
+        host = HOST
+        server = {key: kwargs[key] for key in ("mode", "workers", "threads") if key in kwargs}
+        proc = start_server(port, db=kwargs.get("db", "memory://loadtest"), **server)
+    try:
+        if seed:
+            client = Client(host, port)
+            rows = stock_rows(seed)
+            for i, row in enumerate(rows):
+                row.pop("_id")
+                row["Symbol"] = symbols[i % len(symbols)]
+            for first in range(0, len(rows), 1000):
+                client.request(Request().createRequest(action="insert_many", collection=collection,
+                                                       data=rows[first:first + 1000]), 60)
+            client.close()
+        report = run_load(host, port, weights, builders,
+                          duration=float(kwargs.get("duration", 10)),
+                          concurrency=int(kwargs.get("concurrency", 16)),
+                          target_rate=float(kwargs["rate"]) if "rate" in kwargs else None,
+                          warmup=float(kwargs.get("warmup", 1)),
+                          timeout=float(kwargs.get("timeout", 10)))
+    finally:
+        if proc is not None:
+            stop_server(proc)
+    report["server"] = f"{host}:{port}" if proc is None else dict(db=kwargs.get("db", "memory://loadtest"),
+                                                                    mode=kwargs.get("mode", config.server_mode),
+                                                                    workers=int(kwargs.get("workers", 1)))
+    report["seeded_rows"] = seed
+    return report
+
+
+def bench_metrics(kwargs):
+    """ What the server's metrics cost: the time of one request's worth of recording on its
+        own, and the same load against a server with metrics on and off.
+    """
+    from Metrics import Metrics
+
+    calls = int(kwargs.get("calls", 200000))
+    metrics = Metrics()
+    request = {"action": "search"}
+    start = time.perf_counter()
+    for _ in range(calls):
+        # what one answered request records: its phases and the bytes both ways
+        timer = metrics.timer(request)
+        timer.phase("queue")
+        timer.phase("db")
+        timer.phase("encode")
+        metrics.received(100)
+        metrics.sent(1000)
+        timer.sent()
+    per_request = (time.perf_counter() - start) / calls
+    results = {"recording_us_per_request": round(per_request * 1e6, 3)}
+
+    port = int(kwargs.get("port", 6100))
+    mix = parse_mix(kwargs.get("mix", "test:1,searchkey:1"))
+    builders = load_requests("loadtest", ["L000"], kwargs.get("cache"))
+    duration = float(kwargs.get("duration", 5))
+    concurrency = int(kwargs.get("concurrency", 8))
+    rounds = int(kwargs.get("rounds", 2))
+    runs = {"on": [], "off": []}
+    for _ in range(rounds):
+        # alternate so drift on the machine hits both the same
+        for label in ("off", "on"):
+            proc = start_server(port, db="memory://loadtest", metrics=1 if label == "on" else 0,
+                                **{key: kwargs[key] for key in ("mode",) if key in kwargs})
+            try:
+                runs[label].append(run_load(HOST, port, mix, builders, duration, concurrency))
+            finally:
+                stop_server(proc)
+    for label, reports in runs.items():
+        results[label] = {
+            "throughput": round(sum(report["throughput"] for report in reports) / len(reports), 1),
+            "p50_ms": round(sum(report["latency_ms"]["p50"] for report in reports) / len(reports), 3),
+            "p99_ms": round(sum(report["latency_ms"]["p99"] for report in reports) / len(reports), 3),
+        }
+    results["throughput_change_percent"] = round((results["on"]["throughput"] / results["off"]["throughput"] - 1) * 100, 2)
+    return results
+
+
+def bench_clientpool(kwargs):
+    """ What a program calling the server from many threads gets: a new Client per request
+        (connect every time) against one shared ClientPool, called from the same threads, and
+        the pool with every request submitted at once.
+    """
+    import threading
+    from ClientPool import ClientPool
+
+    port = int(kwargs.get("port", 6100))
+    count = int(kwargs.get("requests", 2000))
+    threads = int(kwargs.get("threads", 8))
+    size = int(kwargs.get("size", 4))
+    request = Request().createRequest(action=kwargs.get("action", "test"))
+
+    def threaded(call):
+        per_thread = max(1, count // threads)
+
+        def run():
+            for _ in range(per_thread):
+                call()
+
+        workers = [threading.Thread(target=run) for _ in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return rate(per_thread * threads, time.perf_counter() - start)
+
+    def one_shot():
+        client = Client(HOST, port)
+        client.start_connection(request)
+
+    results = {"requests": count, "threads": threads, "pool_size": size, "requests_per_second": {}}
+    proc = start_server(port, db=kwargs.get("db", "memory://"), **{key: kwargs[key] for key in ("mode",) if key in kwargs})
+    try:
+        results["requests_per_second"]["client_per_request"] = threaded(one_shot)
+        pool = ClientPool((HOST, port), size=size)
+        try:
+            results["requests_per_second"]["pool_call"] = threaded(lambda: pool.call(request))
+            start = time.perf_counter()
+            futures = [pool.submit(request) for _ in range(count)]
+            for future in futures:
+                future.result()
+            results["requests_per_second"]["pool_submit_all"] = rate(count, time.perf_counter() - start)
+            results["pool_stats"] = pool.stats()
+        finally:
+            pool.close()
+    finally:
+        stop_server(proc)
+    return results
+
+
+def bench_versions(kwargs):
+    """ Fetching the same reference data again and again, with and without the client cache
+        (if-none-match): requests per second and bytes the server sent per request.
+    """
+    port = int(kwargs.get("port", 6100))
+    rows = int(kwargs.get("rows", 5000))
+    count = int(kwargs.get("requests", 200))
+    query = Request().createRequest(action="search", collection="info", params="{}", cache=kwargs.get("cache"))
+    documents = [{"Symbol": f"S{i:05d}", "Name": f"Company number {i}", "Sector": f"Sector {i % 11}",
+                  "Exchange": "NASDAQ" if i % 2 else "NYSE", "Shares": 1000000 + i} for i in range(rows)]
+
+    results = {"rows": rows, "requests": count}
+    proc = start_server(port, db="memory://versions", **{key: kwargs[key] for key in ("mode",) if key in kwargs})
+    try:
+        client = Client(HOST, port)
+        client.request(Request().createRequest(action="insert_many", collection="info", data=json.dumps(documents)))
+        client.close()
+        for label, cache in (("no_cache", None), ("client_cache", True)):
+            client = Client(HOST, port, cache=cache)
+            before = client.request(Request().createRequest(action="serverstats"))["results"]["bytes_out"]
+            start = time.perf_counter()
+            for _ in range(count):
+                client.request(query)
+            elapsed = time.perf_counter() - start
+            after = client.request(Request().createRequest(action="serverstats"))["results"]["bytes_out"]
+            results[label] = {
+                "requests_per_second": rate(count, elapsed),
+                "bytes_sent_per_request": round((after - before) / count),
+            }
+            if cache:
+                results[label]["cache"] = client.cache.stats()
+            client.close()
+    finally:
+        stop_server(proc)
+    return results
+
+
+def server_rss(pid):
+    """ Resident memory of a process in MB, from /proc (Linux only, None elsewhere).
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+
+
+def bench_slowclient(kwargs):
+    """ Clients that pipeline big searches as fast as they can and never read an answer,
+        against one well behaved client: the server's memory while it goes on, how many
+        requests the slow clients got in, and the well behaved client's latency.
+    """
+    import threading
+    from Message import ClientMessage
+
+    port = int(kwargs.get("port", 6100))
+    rows = int(kwargs.get("rows", 2000))
+    clients = int(kwargs.get("clients", 4))
+    duration = float(kwargs.get("duration", 5))
+    documents = [{"Symbol": f"S{i:05d}", "Name": f"Company number {i}", "Sector": f"Sector {i % 11}",
+                  "Exchange": "NASDAQ" if i % 2 else "NYSE", "Shares": 1000000 + i} for i in range(rows)]
+    search = Request().createRequest(action="search", collection="info", params="{}")
+    # a few hundred pipelined searches back to back, written over and over
+    frames = b"".join(ClientMessage(None, None, None).encode_request(search, i) for i in range(256))
+
+    results = {"rows": rows, "slow_clients": clients, "duration": duration}
+    proc = start_server(port, db="memory://slowclient", **{key: kwargs[key] for key in ("mode",) if key in kwargs})
+    stop = threading.Event()
+    written = [0] * clients
+    peak = [0]
+    try:
+        client = Client(HOST, port)
+        client.request(Request().createRequest(action="insert_many", collection="info", data=json.dumps(documents)))
+        client.close()
+        results["rss_mb_before"] = server_rss(proc.pid)
+
+        def slow(number):
+            sock = socket.create_connection((HOST, port))
+            sock.settimeout(0.1)
+            view = memoryview(frames)
+            offset = 0
+            try:
+                while not stop.is_set():
+                    try:
+                        offset += sock.send(view[offset:])
+                    except socket.timeout:
+                        continue
+                    if offset == len(frames):
+                        written[number] += 256
+                        offset = 0
+            except OSError:
+                pass
+            finally:
+                sock.close()
+
+        def watch():
+            while not stop.wait(0.1):
+                peak[0] = max(peak[0], server_rss(proc.pid) or 0)
+
+        threads = [threading.Thread(target=slow, args=(number,)) for number in range(clients)]
+        threads.append(threading.Thread(target=watch))
+        for thread in threads:
+            thread.start()
+        fast = Client(HOST, port)
+        test = Request().createRequest(action="searchkey", collection="info", key="Symbol", value="S00001")
+        samples = []
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            fast.request(test)
+            samples.append(time.perf_counter() - start)
+        stats = fast.request(Request().createRequest(action="serverstats"))["results"]
+        fast.close()
+        stop.set()
+        for thread in threads:
+            thread.join()
+        results["rss_mb_peak"] = peak[0]
+        results["slow_requests_written"] = sum(written)
+        results["pauses"] = stats.get("pauses")
+        results["fast_client"] = {"requests": len(samples), "latency_ms": percentiles(samples)}
+    finally:
+        stop.set()
+        stop_server(proc)
+    return results
+
+
+def bench_protocol(kwargs):
+    """ v1 (json) against v2 (fixed binary, Protocol.py) frame headers: the CPU to build and
+        parse the frames of small requests, and round trips per second of test / searchkey
+        over one keep-alive connection.
+    """
+    from Message import Message, ClientMessage
+
+    port = int(kwargs.get("port", 6100))
+    count = int(kwargs.get("requests", 5000))
+    requests = {
+        "test": Request().createRequest(action="test"),
+        "searchkey": Request().createRequest(action="searchkey", collection="info", key="Symbol", value="S00001"),
+    }
+    results = {"requests": count, "frame_us": {}, "round_trips_per_second": {}, "latency_ms": {}}
+
+    for version in (1, 2):
+        client = ClientMessage(None, None, None)
+        client.protocol = version
+        start = time.perf_counter()
+        frames = [client.encode_request(requests["searchkey"], i) for i in range(count)]
+        built = time.perf_counter() - start
+        reader = Message(None, None, None)
+        reader._recv_buffer = bytearray(b"".join(frames))
+        reader._recv_end = len(reader._recv_buffer)
+        start = time.perf_counter()
+        for _ in range(count):
+            reader.process_protoheader()
+            reader.process_jsonheader()
+            body = reader.jsonheader["content-length"]
+            with reader._recv_take(body):
+                pass
+            reader.reset_frame()
+        parsed = time.perf_counter() - start
+        results["frame_us"][f"v{version}"] = {
+            "build": round(built / count * 1e6, 2),
+            "parse_header": round(parsed / count * 1e6, 2),
+            "header_bytes": len(frames[-1]) - body,
+        }
+
+    configured = config.protocol_version
+    proc = start_server(port, db="memory://protocol", **{key: kwargs[key] for key in ("mode",) if key in kwargs})
+    try:
+        client = Client(HOST, port)
+        client.request(Request().createRequest(action="insert", collection="info", data=json.dumps({"Symbol": "S00001"})))
+        client.close()
+        for version in (1, 2):
+            config.protocol_version = version
+            for action, request in requests.items():
+                client = Client(HOST, port)
+                client.request(request)     # connect and negotiate
+                samples = []
+                for _ in range(count):
+                    start = time.perf_counter()
+                    client.request(request)
+                    samples.append(time.perf_counter() - start)
+                label = f"{action}_v{version}"
+                results["round_trips_per_second"][label] = rate(count, sum(samples))
+                results["latency_ms"][label] = percentiles(samples)["p50"]
+                client.close()
+    finally:
+        config.protocol_version = configured
+        stop_server(proc)
+    return results
+
+
+BENCHMARKS = {
+    "transport": bench_transport,
+    "buffers": bench_buffers,
+    "stream": bench_stream,
+    "codecs": bench_codecs,
+    "compression": bench_compression,
+    "columnar": bench_columnar,
+    "analytics": bench_analytics,
+    "memory": bench_memory,
+    "history": bench_history,
+    "load": bench_load,
+    "metrics": bench_metrics,
+    "clientpool": bench_clientpool,
+    "versions": bench_versions,
+    "slowclient": bench_slowclient,
+    "protocol": bench_protocol,
+}
+
+if __name__ == "__main__":
+    kwargs, args = myArgParse(sys.argv)
+    bench = kwargs.get("bench", None)
+    if bench not in BENCHMARKS:
+        Usage()
+    print(json.dumps(BENCHMARKS[bench](kwargs), indent=2))
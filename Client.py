@@ -10,13 +10,23 @@ Requires:
 Usage:
     Pass in values to the client using key value pairs 
     ./Client.py host=10.0.61.34 port=6000 action=search value=rhino
+    ./Client.py host=10.0.61.34 port=6000 action=test mode=async
+    ./Client.py action=search collection=data_med params='{"Symbol":"GOOG"}' stream=500
+    ./Client.py action=search collection=data_med params='{"Symbol":"GOOG"}' limit=50 sort=-Date projection=Date,Close
+    ./Client.py action=searchkey collection=info key=Symbol value=GOOG codec=msgpack
+    ./Client.py action=search collection=data_med params='{"Symbol":"GOOG"}' format=columnar
+    ./Client.py action=resample collection=data_med symbol=GOOG start=2010-01-01 every=M
+    ./Client.py action=insert_many collection=quotes file=quotes.jsonl batch=5000
+    ./Client.py action=batch requests='[{"action":"test"},{"action":"searchkey","collection":"info","key":"Symbol","value":"GOOG"}]'
 """
 import config
 import sys
 from ClientClass import Client
 from ClientClass import Request
+from AsyncClientClass import AsyncClient
 from helpers import myArgParse
 import json
+import asyncio
 
 def Usage():
     print("Usage: <host> <port> <action> <value>")
@@ -35,6 +45,8 @@ if __name__ == "__main__":
     host = kwargs.get("host", config.host)          # MANDATORY 
     port = int(kwargs.get("port", config.port))     # MANDATORY Port to connect to (XXXXX, e,g, 6000)
     db = kwargs.get("db", config.database)  
+    mode = kwargs.get("mode", config.client_mode)   # selectors or async
+    codec = kwargs.get("codec", None)               # json (default) or msgpack, see Codecs.py
 
 
     action = kwargs.get("action", None)             # MANDATORY Tells backend what to do: (search,insert, etc.) 
@@ -45,11 +57,34 @@ if __name__ == "__main__":
     collection = kwargs.get("collection", None)     # optional
     data = kwargs.get("data", None)                 # optional
     params = kwargs.get("params",None)
+    stream = kwargs.get("stream",None)              # optional, rows per chunk (search / searchkey)
+    limit = kwargs.get("limit",None)                # optional, most rows to return
+    sort = kwargs.get("sort",None)                  # optional, e.g. Symbol,-Date
+    projection = kwargs.get("projection",None)      # optional, fields to return e.g. Date,Close
+    after = kwargs.get("after",None)                # optional, "next" token from the last page
+    cache = kwargs.get("cache",None)                # optional, cache=bypass skips the result cache
+    format = kwargs.get("format",None)              # optional, format=columnar for typed arrays per field
+    file = kwargs.get("file",None)                  # optional, jsonl file to load with insert_many
+    batch = kwargs.get("batch",None)                # optional, documents per insert_many request
+    requests = kwargs.get("requests",None)          # optional, json list of requests for action=batch
+
+    # resample / rolling / returns / stats
+    symbol = kwargs.get("symbol",None)              # optional, same as params='{"Symbol":...}'
+    start = kwargs.get("start",None)                # optional, first day e.g. 2010-01-01
+    end = kwargs.get("end",None)                    # optional, last day
+    field = kwargs.get("field",None)                # optional, price field (Close)
+    every = kwargs.get("every",None)                # optional, resample period W, M, Q, Y
+    window = kwargs.get("window",None)              # optional, rolling window in bars
+    stat = kwargs.get("stat",None)                  # optional, rolling mean, std, min, max, sum
+    period = kwargs.get("period",None)              # optional, bars between returns
+    kind = kwargs.get("kind",None)                  # optional, simple or log returns
+    keys = kwargs.get("keys",None)                  # optional, create_index keys e.g. Symbol,-Date
+    unique = kwargs.get("unique",None)              # optional, create_index unique=true
 
 
 
     # Create an instance of our "Request" class
-    request = Request()
+    request = Request(codec)
 
     # if not (host and port and action) or (key or value):
     #     Usage()
@@ -57,9 +92,41 @@ if __name__ == "__main__":
 
     # run `Client.py host=xxx.xxx.xxx.xxx port=xxxx action=test` to see if server responds 
 
-    request = request.createRequest(action=action, key=key, collection=collection, data=data, value=value, params=params)
-
-    client = Client(host, port)
-    client.start_connection(request)
-    response = client.get_response()
+    request = request.createRequest(action=action, key=key, collection=collection, data=data, value=value, params=params, stream=stream,
+                                    limit=limit, sort=sort, projection=projection, after=after, cache=cache,
+                                    format=format, requests=requests, symbol=symbol, start=start, end=end, field=field,
+                                    every=every, window=window, stat=stat, period=period, kind=kind,
+                                    keys=keys, unique=unique)
+
+    if file:
+        # Bulk load, one document per line
+        client = Client(host, port)
+        response = client.insert_jsonl(collection, file, batch, timeout=config.request_timeout)
+        client.close()
+    elif stream and mode == "async":
+        async def send(request):
+            client = AsyncClient(host, port, config.request_timeout)
+            async for row in client.stream(request):
+                print(row)
+            await client.close()
+            return client.response
+        response = asyncio.run(send(request))
+    elif stream:
+        # Print rows as they arrive instead of waiting for the whole result
+        client = Client(host, port)
+        for row in client.stream(request, config.request_timeout):
+            print(row)
+        client.close()
+        response = client.get_response()
+    elif mode == "async":
+        async def send(request):
+            client = AsyncClient(host, port, config.request_timeout)
+            response = await client.request(request)
+            await client.close()
+            return response
+        response = asyncio.run(send(request))
+    else:
+        client = Client(host, port)
+        client.start_connection(request)
+        response = client.get_response()
     print(response)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import config
 import sys
 import selectors
 import json
@@ -6,8 +7,13 @@ import io
 import struct
 import socket
 import traceback
+import time
+import collections
+import threading
 
 from Message import ClientMessage
+from Codecs import get_codec, CODEC_NAMES
+from ResultCache import ACTIONS, query_key
 
 """
  ______                           _   
@@ -22,12 +28,19 @@ from Message import ClientMessage
 class Request:
     """This class builds an appropriate json request for the client to send. 
        It makes sure all requests are formatted the same.  
+       Pass codec="msgpack" (see Codecs.py) to send it, and get the answer back, as MessagePack.
     """
-    def __init__(self):
+    def __init__(self, codec=None):
         self.request = {}
         self.request["type"] = "text/json"
         self.request["encoding"] = "utf-8"
         self.request['content'] = {}
+        if codec:
+            codec = get_codec(codec)
+            if codec is None:
+                raise ValueError(f"Unknown codec, pick one of {list(CODEC_NAMES)}.")
+            self.request["type"] = codec.content_type
+            self.request["encoding"] = codec.encoding
 
     def createRequest(self, **kwargs):
         """ Loops through kwargs and pulls out all key value pair creating
@@ -38,6 +51,84 @@ class Request:
             
         return self.request
 
+"""
+ ______                                      _____            _          
+ | ___ \                                    /  __ \          | |         
+ | |_/ /___  ___ _ __   ___  _ __  ___  ___ | /  \/ __ _  ___| |__   ___ 
+ |    // _ \/ __| '_ \ / _ \| '_ \/ __|/ _ \| |    / _` |/ __| '_ \ / _ \
+ | |\ \  __/\__ \ |_) | (_) | | | \__ \  __/| \__/\ (_| | (__| | | |  __/
+ \_| \_\___||___/ .__/ \___/|_| |_|___/\___| \____/\__,_|\___|_| |_|\___|
+                | |                                                      
+                |_|                                                      
+"""
+CacheEntry = collections.namedtuple("CacheEntry", "key tag response")
+
+
+class ResponseCache:
+    """ Answers to searches (and the analytics actions) we already have, with the tag the
+        server gave each one. A repeat of the same question sends the tag along
+        ("if-none-match"), and if nothing changed the server answers with a few bytes instead
+        of the rows, and we hand back the answer kept here. The least recently used entries go
+        once there are `max_entries`. Responses are shared, so don't change them. One cache
+        can be shared by several clients (and threads).
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = int(max_entries or config.client_cache_entries)
+        self.entries = collections.OrderedDict()   # key -> CacheEntry, oldest first
+        self.lock = threading.Lock()
+        self.not_modified = 0
+        self.stored = 0
+        self.evictions = 0
+
+    def key(self, request):
+        content = request.get("content") if isinstance(request, dict) else None
+        if not isinstance(content, dict) or content.get("action") not in ACTIONS or content.get("stream"):
+            return None
+        return (request.get("type"), content.get("action"), content.get("collection"), query_key(content))
+
+    def lookup(self, request):
+        """ The entry to ask the server about, None if we have nothing for this request.
+        """
+        key = self.key(request)
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def update(self, request, jsonheader, response, asked=None):
+        """ Called with every response. Returns what the caller should get: the kept answer
+            if the server said "not modified", otherwise `response` (kept if it has a tag).
+        """
+        if jsonheader.get("not-modified") and asked is not None:
+            with self.lock:
+                self.not_modified += 1
+            return asked.response
+        tag = jsonheader.get("etag")
+        key = self.key(request) if tag is not None else None
+        if key is None:
+            return response
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = CacheEntry(key, tag, response)
+            self.stored += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return response
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "not_modified": self.not_modified,
+                "stored": self.stored,
+                "evictions": self.evictions,
+            }
+
 """
   _____ _ _            _   
  /  __ \ (_)          | |  
@@ -48,12 +139,20 @@ class Request:
                            
 """
 class Client:
-    def __init__(self, host=None, port=None,debug=False):
+    """ Talks to the server. `start_connection` is the original one shot: connect, send one
+        request, wait for the answer, hang up. For lots of small requests call `connect()` once
+        and then `send()`/`request()`/`pipeline()` as often as you like over the same socket.
+        `stream()` reads a big search a chunk at a time. With cache=True (or a ResponseCache
+        to share) searches asked before are only sent back if they changed.
+    """
+    def __init__(self, host=None, port=None,debug=False,cache=None):
         self.sel = selectors.DefaultSelector()
         self.host = host
         self.port = port
         self.debug = debug
         self.response = None
+        self.message = None     # keep-alive connection (see connect)
+        self.cache = ResponseCache() if cache is True else cache or None
 
         if not self.host:
             self.host = config.host
@@ -67,9 +166,11 @@ class Client:
             print("starting connection to", addr)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setblocking(False)
+        # Don't hold small request frames back waiting on the last one's ACK (Nagle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         sock.connect_ex(addr)
         events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        message = ClientMessage(self.sel, sock, addr, request)
+        message = ClientMessage(self.sel, sock, addr, request, cache=self.cache)
         self.sel.register(sock, events, data=message)
 
         try:
@@ -96,3 +197,159 @@ class Client:
 
     def get_response(self):
         return self.response
+
+    def connect(self):
+        """ Opens a keep-alive connection that stays up until `close()` is called.
+        """
+        if self.message is not None and self.message.sock is not None:
+            return
+        addr = (self.host, self.port)
+        if self.debug:
+            print("starting keep-alive connection to", addr)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        # Don't hold small request frames back waiting on the last one's ACK (Nagle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect_ex(addr)
+        self.message = ClientMessage(self.sel, sock, addr, keep_alive=True, cache=self.cache)
+        self.sel.register(sock, selectors.EVENT_READ, data=self.message)
+
+    def send(self, request):
+        """ Queues a request on the keep-alive connection without waiting for the answer.
+            Returns the request id to hand to `wait()`.
+        """
+        self.connect()
+        return self.message.queue_request(request)
+
+    def wait(self, request_ids, timeout=None):
+        """ Runs the event loop until every id in `request_ids` has a response (or the timeout
+            runs out) and returns the responses in the same order as the ids.
+        """
+        message = self.message
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while any(rid not in message.responses for rid in request_ids):
+            self.poll(deadline, timeout)
+        return [message.responses.pop(rid) for rid in request_ids]
+
+    def poll(self, deadline=None, timeout=None):
+        """ One pass of the event loop on the keep-alive connection. Raises if the connection
+            is gone or the deadline has passed.
+        """
+        message = self.message
+        if message.sock is None:
+            raise RuntimeError(f"Connection to {message.addr} closed with requests pending.")
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            raise TimeoutError(f"No response from {message.addr} in {timeout} seconds.")
+        for key, mask in self.sel.select(timeout=remaining):
+            try:
+                key.data.process_events(mask)
+            except Exception:
+                print(
+                    "main: error: exception for",
+                    f"{message.addr}:\n{traceback.format_exc()}",
+                )
+                message.close()
+
+    def request(self, request, timeout=None):
+        """ Sends one request over the keep-alive connection and returns its response.
+        """
+        self.response = self.wait([self.send(request)], timeout)[0]
+        return self.response
+
+    def pipeline(self, requests, timeout=None):
+        """ Writes all the requests back to back before reading anything, then returns the
+            responses in request order. One round trip instead of len(requests).
+        """
+        request_ids = [self.send(request) for request in requests]
+        return self.wait(request_ids, timeout)
+
+    def batch(self, requests, timeout=None, codec=None):
+        """ Sends a list of requests (Request.createRequest dicts, or just their content) as one
+            batch request. The server runs them at the same time and the response has one
+            result per request, in order. A request that failed has its own Error result.
+        """
+        contents = [request.get("content", request) for request in requests]
+        return self.request(Request(codec).createRequest(action="batch", requests=contents), timeout)
+
+    def stream(self, request, timeout=None):
+        """ Sends a search / searchkey with "stream" set and yields the rows as each chunk
+            arrives, so the whole result never has to be in memory at once. `timeout` is how
+            long to wait for each chunk. When it's done `get_response()` has the final frame
+            (the count, or the error). A server that doesn't stream answers in one frame, and
+            those rows are yielded the same way.
+        """
+        if not request["content"].get("stream"):
+            request = dict(request, content=dict(request["content"], stream=True))
+        request_id = self.send(request)
+        message = self.message
+        chunks = message.chunks[request_id] = collections.deque()
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                while chunks:
+                    yield from chunks.popleft()["results"]["data"]
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                if request_id in message.responses:
+                    break
+                self.poll(deadline, timeout)
+            self.response = message.responses.pop(request_id)
+            yield from self.response.get("results", {}).get("data", [])
+        finally:
+            # Stops saving chunks if the caller quit early (the rest are read and dropped)
+            message.chunks.pop(request_id, None)
+
+    def insert_jsonl(self, collection, path, batch_size=None, in_flight=4, timeout=None):
+        """ Loads a file with one json document per line into `collection` with insert_many.
+            The file is read as it is sent, `batch_size` lines per request with up to
+            `in_flight` requests pipelined, so it never has to fit in memory. Returns the
+            totals and the failed line numbers (1 based) with the reasons.
+        """
+        batch_size = int(batch_size or config.bulk_batch_size)
+        summary = {"success": True, "lines": 0, "requests": 0, "inserted": 0, "failed": []}
+        waiting = collections.deque()   # (request id, line number of each document)
+
+        def collect():
+            request_id, lines = waiting.popleft()
+            result = self.wait([request_id], timeout)[0].get("results", {})
+            if "Error" in result:
+                summary["failed"].extend({"line": line, "error": result["Error"]} for line in lines)
+                return
+            summary["inserted"] += result.get("inserted", 0)
+            summary["failed"].extend({"line": lines[f["index"]], "error": f["error"]} for f in result.get("failed", []))
+
+        def send(documents, lines):
+            if len(waiting) >= in_flight:
+                collect()
+            request = Request().createRequest(action="insert_many", collection=collection, data=documents)
+            waiting.append((self.send(request), lines))
+            summary["requests"] += 1
+
+        documents, lines = [], []
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                summary["lines"] += 1
+                try:
+                    documents.append(json.loads(line))
+                except ValueError as e:
+                    summary["failed"].append({"line": number, "error": f"Bad json: {e}"})
+                    continue
+                lines.append(number)
+                if len(documents) >= batch_size:
+                    send(documents, lines)
+                    documents, lines = [], []
+        if documents:
+            send(documents, lines)
+        while waiting:
+            collect()
+
+        summary["failed"].sort(key=lambda failure: failure["line"])
+        summary["success"] = not summary["failed"]
+        return summary
+
+    def close(self):
+        if self.message is not None and self.message.sock is not None:
+            self.message.close()
+        self.message = None
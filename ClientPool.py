@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+ClientPool.py
+Description:
+    A client for programs that call the server a lot from many threads. It keeps keep-alive
+    connections open to one or more servers and runs all of them from one background thread,
+    so a request costs a frame on an open socket instead of a connect, and any thread can use
+    the same pool:
+
+        pool = ClientPool("10.0.61.34:6000,10.0.61.35:6000", size=4, timeout=5, retries=2)
+        future = pool.submit(Request().createRequest(action="searchkey", collection="info", key="Symbol", value="GOOG"))
+        print(pool.call(Request().createRequest(action="test")))     # waits for the answer
+        print(future.result(), future.elapsed, future.attempts)
+        print(pool.stats())
+        pool.close()
+
+    A request goes to an idle connection if there is one, else a new connection is opened (up
+    to `size` per server, on the server with the fewest), else it is pipelined on the
+    connection with the fewest requests in flight. A server whose connection fails is left
+    alone for `backoff` seconds while others are up.
+
+    `timeout` is per attempt. A request is tried again (up to `retries` more times, waiting
+    backoff * 2^n with some jitter) when the server says it is busy, when its connection fails,
+    or when it times out, but a write (insert, update, ...) is only tried again if the server
+    can't have run it: it was busy, or none of the request had been sent when the connection
+    failed. Otherwise the future gets the error (TimeoutError / ConnectionError).
+
+    With cache=True (or a ClientClass.ResponseCache) a search asked before carries the tag of the
+    answer we have, and the server only sends the rows again if they changed.
+
+    Each future gets `elapsed` (seconds from submit to answer, retries included) and `attempts`,
+    and stats() has latency percentiles per action plus retry / timeout / error counts.
+    Streamed searches aren't supported, use ClientClass.Client.stream for those.
+Requires:
+    Message.py :: ClientMessage, Metrics.py :: Histogram
+"""
+import config
+import collections
+import heapq
+import itertools
+import random
+import selectors
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+from Message import ClientMessage
+from ClientClass import Request, ResponseCache
+from Metrics import Histogram
+
+# Actions that change data: only retried when the server can't have run them
+WRITE_ACTIONS = ("insert", "insert_many", "update", "delete", "create_index", "batch")
+
+
+def parse_servers(servers):
+    """ "host:port,host:port", a (host, port) tuple or a list of either -> [(host, port), ...]
+    """
+    if servers is None:
+        return [(config.host, int(config.port))]
+    if isinstance(servers, str):
+        servers = [server for server in servers.split(",") if server.strip()]
+    elif isinstance(servers, tuple):
+        servers = [servers]
+    parsed = []
+    for server in servers:
+        if isinstance(server, str):
+            host, _, port = server.strip().rpartition(":")
+            server = (host or config.host, port)
+        parsed.append((server[0], int(server[1])))
+    if not parsed:
+        raise ValueError("ClientPool needs at least one server.")
+    return parsed
+
+
+class Call:
+    """ One submitted request and where it is up to.
+    """
+    __slots__ = ("request", "action", "future", "timeout", "retries", "attempts", "submitted",
+                 "connection", "request_id", "sent_from")
+
+    def __init__(self, request, timeout, retries):
+        self.request = request
+        self.action = str(request["content"].get("action"))
+        self.future = Future()
+        self.timeout = timeout
+        self.retries = retries
+        self.attempts = 0
+        self.submitted = time.perf_counter()
+        self.connection = None
+        self.request_id = None
+        self.sent_from = 0      # the connection's queued byte count before this request
+
+
+class Connection:
+    """ One keep-alive connection in the pool.
+    """
+    def __init__(self, sel, server, cache=None):
+        self.server = server
+        self.calls = {}         # request id -> Call waiting on its answer
+        self.abandoned = set()  # ids of calls that timed out, their answers are thrown away
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.connect_ex(server)
+        self.message = ClientMessage(sel, sock, server, keep_alive=True, cache=cache)
+        sel.register(sock, selectors.EVENT_READ, data=self.message)
+
+    def load(self):
+        return len(self.calls) + len(self.abandoned)
+
+
+class ClientPool:
+    def __init__(self, servers=None, size=None, timeout=None, retries=None, backoff=None, cache=None, debug=False):
+        self.servers = parse_servers(servers)
+        self.size = int(size or config.client_pool_size)
+        self.timeout = config.client_timeout if timeout is None else timeout
+        self.retries = int(config.client_retries if retries is None else retries)
+        self.backoff = config.client_backoff if backoff is None else backoff
+        self.cache = ResponseCache() if cache is True else cache or None
+        self.debug = debug
+
+        self.sel = selectors.DefaultSelector()
+        # submit() appends to `incoming` and writes a byte to wakeup_send, the loop does the rest
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.sel.register(self.wakeup_recv, selectors.EVENT_READ, data=None)
+        self.incoming = collections.deque()
+
+        # Only the loop thread touches these
+        self.connections = {}                               # ClientMessage -> Connection
+        self.by_server = {server: [] for server in self.servers}
+        self.down = {}                                      # server -> time it can be tried again
+        self.delayed = []                                   # heap of (due, n, Call) waiting to retry
+        self.deadlines = []                                 # heap of (deadline, n, Call, attempt)
+        self.sequence = itertools.count()
+        self.in_flight = 0
+
+        self.lock = threading.Lock()                        # guards the counters below
+        self.latency = {}                                   # action -> Histogram
+        self.counts = {"requests": 0, "errors": 0, "error_responses": 0, "retries": 0, "timeouts": 0,
+                       "connections_opened": 0, "connections_lost": 0}
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, name="client-pool", daemon=True)
+        self.thread.start()
+
+    def submit(self, request, timeout=None, retries=None):
+        """ Queues a request (Request.createRequest dict, or just its content) and returns a
+            concurrent.futures.Future for the response. Safe to call from any thread.
+        """
+        if "content" not in request:
+            request = Request().createRequest(**request)
+        if request["content"].get("stream"):
+            raise ValueError("ClientPool doesn't stream, use ClientClass.Client.stream.")
+        if self.closing:
+            raise RuntimeError("ClientPool is closed.")
+        call = Call(request, self.timeout if timeout is None else timeout, self.retries if retries is None else int(retries))
+        self.incoming.append(call)
+        self.wake()
+        return call.future
+
+    def call(self, request, timeout=None, retries=None):
+        """ submit() and wait for the answer. Raises what the request failed with.
+        """
+        return self.submit(request, timeout, retries).result()
+
+    def map(self, requests, timeout=None):
+        """ Submits all the requests at once and returns their responses in order.
+        """
+        futures = [self.submit(request, timeout) for request in requests]
+        return [future.result() for future in futures]
+
+    def wake(self):
+        try:
+            self.wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            # Already full of wakeups (or closed), the loop will get to it
+            pass
+
+    def stats(self):
+        """ Latency per action (from submit to answer, retries included) and counters.
+        """
+        with self.lock:
+            actions = {action: histogram.summary() for action, histogram in sorted(self.latency.items())}
+            counts = dict(self.counts)
+        return {
+            "servers": [f"{host}:{port}" for host, port in self.servers],
+            "connections": {f"{host}:{port}": len(self.by_server[(host, port)]) for host, port in self.servers},
+            "in_flight": self.in_flight,
+            **counts,
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "actions": actions,
+        }
+
+    def close(self, timeout=None):
+        """ Stops taking requests, waits (up to `timeout` seconds) for the ones in flight,
+            then hangs up. Anything still unanswered fails with RuntimeError.
+        """
+        self.closing = True
+        self.wake()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            self.closing = "now"
+            self.wake()
+            self.thread.join()
+
+    """
+    Everything below runs on the pool's own thread.
+    """
+    def run(self):
+        try:
+            while True:
+                self.start_incoming()
+                if self.closing == "now" or (self.closing and not self.in_flight and not self.incoming):
+                    break
+                for key, mask in self.sel.select(timeout=self.next_wakeup()):
+                    if key.data is None:
+                        self.drain_wakeups()
+                        continue
+                    self.process(key.data, mask)
+                self.expire()
+        except Exception:
+            print("client-pool: error:", traceback.format_exc())
+        finally:
+            self.shutdown()
+
+    def drain_wakeups(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def next_wakeup(self):
+        """ How long select() can sleep: until the next retry is due or timeout runs out.
+        """
+        due = [heap[0][0] for heap in (self.delayed, self.deadlines) if heap]
+        if not due:
+            return None
+        return max(0.0, min(due) - time.monotonic())
+
+    def start_incoming(self):
+        while self.incoming:
+            call = self.incoming.popleft()
+            if not call.future.set_running_or_notify_cancel():
+                continue        # cancelled before we got to it
+            self.in_flight += 1
+            self.send(call)
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.send(heapq.heappop(self.delayed)[2])
+
+    def pick(self):
+        """ An idle connection, else a new one if a server has room, else the least busy.
+        """
+        now = time.monotonic()
+        servers = [server for server in self.servers if self.down.get(server, 0) <= now] or self.servers
+        best = None
+        for server in servers:
+            for connection in self.by_server[server]:
+                if best is None or connection.load() < best.load():
+                    best = connection
+        if best is not None and best.load() == 0:
+            return best
+        room = [server for server in servers if len(self.by_server[server]) < self.size]
+        if not room:
+            return best
+        server = min(room, key=lambda server: len(self.by_server[server]))
+        connection = Connection(self.sel, server, self.cache)
+        self.connections[connection.message] = connection
+        self.by_server[server].append(connection)
+        self.count("connections_opened")
+        if self.debug:
+            print("client-pool: connected to", server)
+        return connection
+
+    def send(self, call):
+        if self.closing == "now":
+            return self.finish(call, error=RuntimeError("ClientPool is closed."))
+        call.attempts += 1
+        try:
+            connection = self.pick()
+            call.sent_from = connection.message._queued_total
+            call.request_id = connection.message.queue_request(call.request)
+        except OSError as e:
+            # couldn't even open the socket (bad host name, out of files, ...)
+            return self.retry(call, ConnectionError(f"Can't connect: {e!r}"), safe=True)
+        call.connection = connection
+        connection.calls[call.request_id] = call
+        if call.timeout:
+            heapq.heappush(self.deadlines, (time.monotonic() + call.timeout, next(self.sequence), call, call.attempts))
+
+    def process(self, message, mask):
+        connection = self.connections.get(message)
+        if connection is None:
+            return
+        try:
+            message.process_events(mask)
+        except Exception as e:
+            return self.lost(connection, e)
+        for request_id in list(message.responses):
+            response = message.responses.pop(request_id)
+            if request_id in connection.abandoned:
+                connection.abandoned.discard(request_id)
+                continue
+            call = connection.calls.pop(request_id, None)
+            if call is None:
+                continue
+            call.connection = None
+            results = response.get("results") if isinstance(response, dict) else None
+            if isinstance(results, dict) and str(results.get("Error", "")).startswith("Server busy"):
+                # The server turned it away without running it, so even a write can go again
+                self.retry(call, None, safe=True, response=response)
+            else:
+                self.finish(call, response)
+        if message.sock is None:
+            self.lost(connection, ConnectionError("Server closed the connection."))
+
+    def lost(self, connection, error):
+        """ A connection failed: drop it and try its requests again where that is safe.
+        """
+        if connection.message.sock is not None:
+            connection.message.close()
+        self.connections.pop(connection.message, None)
+        if connection in self.by_server[connection.server]:
+            self.by_server[connection.server].remove(connection)
+        self.down[connection.server] = time.monotonic() + self.backoff
+        self.count("connections_lost")
+        if self.debug:
+            print("client-pool: lost", connection.server, repr(error))
+        sent = connection.message._sent_total
+        for call in connection.calls.values():
+            call.connection = None
+            # if not one byte of it went out, the server never saw it
+            self.retry(call, ConnectionError(f"Connection to {connection.server} failed: {error!r}"),
+                       safe=sent <= call.sent_from)
+        connection.calls.clear()
+
+    def expire(self):
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, n, call, attempt = heapq.heappop(self.deadlines)
+            if call.future.done() or call.attempts != attempt or call.connection is None:
+                continue        # answered, or already on another attempt
+            connection = call.connection
+            connection.calls.pop(call.request_id, None)
+            connection.abandoned.add(call.request_id)
+            call.connection = None
+            self.count("timeouts")
+            self.retry(call, TimeoutError(f"No response from {connection.server} in {call.timeout} seconds."), safe=False)
+
+    def retry(self, call, error, safe=False, response=None):
+        """ Tries the call again after a backoff, or gives up with `error` (or `response`).
+        """
+        if call.attempts <= call.retries and (safe or call.action not in WRITE_ACTIONS) and not self.closing == "now":
+            self.count("retries")
+            wait = self.backoff * 2 ** (call.attempts - 1) * random.uniform(0.5, 1.0)
+            heapq.heappush(self.delayed, (time.monotonic() + wait, next(self.sequence), call))
+        elif response is not None:
+            self.finish(call, response)
+        else:
+            self.finish(call, error=error)
+
+    def finish(self, call, response=None, error=None):
+        elapsed = time.perf_counter() - call.submitted
+        self.in_flight -= 1
+        with self.lock:
+            histogram = self.latency.get(call.action)
+            if histogram is None:
+                histogram = self.latency[call.action] = Histogram()
+            histogram.add(elapsed)
+            self.counts["requests"] += 1
+            if error is not None:
+                self.counts["errors"] += 1
+            elif isinstance(response, dict) and isinstance(response.get("results"), dict) and "Error" in response["results"]:
+                self.counts["error_responses"] += 1
+        call.future.elapsed = elapsed
+        call.future.attempts = call.attempts
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(response)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def shutdown(self):
+        """ Fails whatever is left and closes every socket.
+        """
+        self.closing = "now"
+        leftovers = [heapq.heappop(self.delayed)[2] for _ in range(len(self.delayed))]
+        for connection in list(self.connections.values()):
+            leftovers.extend(connection.calls.values())
+            connection.calls.clear()
+            if connection.message.sock is not None:
+                connection.message.close()
+        while self.incoming:
+            call = self.incoming.popleft()
+            if call.future.set_running_or_notify_cancel():
+                self.in_flight += 1
+                leftovers.append(call)
+        for call in leftovers:
+            self.finish(call, error=RuntimeError("ClientPool closed before the request was answered."))
+        self.connections.clear()
+        for server in self.by_server:
+            self.by_server[server] = []
+        self.sel.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
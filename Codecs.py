@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+Codecs.py
+Description:
+    The body formats a frame can be in, keyed by the frame's "content-type" header. Message
+    encodes and decodes bodies through this registry, so adding a format is one
+    register_codec() call. A client picks the format by sending its request in it, and the
+    server answers in the same one (old clients send "text/json" and get json back as before).
+
+        text/json            json, what everything used before
+        application/msgpack  MessagePack: smaller than json and no number <-> text conversion.
+                             Uses the `msgpack` package when it is installed, otherwise the
+                             pure python MsgPack class below (same bytes, just slower).
+        application/x-columnar
+                             Search results as one typed array per field (Columnar.py).
+                             Sent when a search asks for format=columnar.
+
+    Bodies can also be compressed. A client lists the compressors it has in the
+    "accept-compression" header, and the server compresses a response with the first one it
+    also has, but only if the body is at least config.compress_threshold bytes. The frame then
+    says which one in "content-compression". Compressors (preferred first): zstd and lz4 if
+    installed, zlib always. compression_stats keeps the ratio and CPU time for compressionstats.
+"""
+import config
+import json
+import struct
+import threading
+import time
+import zlib
+
+import Columnar
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Faster compressors, used when installed (pip install zstandard / lz4)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class Codec:
+    """ One body format. `encode(obj, encoding)` returns bytes, `decode(data, encoding)` takes
+        bytes or a memoryview. `encoding` is the frame's content-encoding ("utf-8" for json,
+        "binary" for msgpack).
+    """
+    def __init__(self, name, content_type, encoding, encode, decode):
+        self.name = name
+        self.content_type = content_type
+        self.encoding = encoding
+        self.encode = encode
+        self.decode = decode
+
+
+CODECS = {}         # content-type -> Codec
+CODEC_NAMES = {}    # short name (json, msgpack) -> Codec
+
+
+def register_codec(codec):
+    CODECS[codec.content_type] = codec
+    CODEC_NAMES[codec.name] = codec
+
+
+def get_codec(content_type):
+    """ The codec for a content-type (or short name), None if we don't know it.
+    """
+    return CODECS.get(content_type) or CODEC_NAMES.get(content_type)
+
+
+class MsgPack:
+    """ Pure python MessagePack (https://msgpack.org/) for when the msgpack package isn't
+        installed. Handles what our requests and responses are made of: None, bool, int,
+        float, str, bytes, lists / tuples and dicts. Anything else raises TypeError, the same
+        as json.dumps does.
+    """
+    _u8 = struct.Struct(">B")
+    _u16 = struct.Struct(">H")
+    _u32 = struct.Struct(">I")
+    _u64 = struct.Struct(">Q")
+    _i8 = struct.Struct(">b")
+    _i16 = struct.Struct(">h")
+    _i32 = struct.Struct(">i")
+    _i64 = struct.Struct(">q")
+    _f32 = struct.Struct(">f")
+    _f64 = struct.Struct(">d")
+    # type byte -> length / value format
+    _ints = {0xCC: _u8, 0xCD: _u16, 0xCE: _u32, 0xCF: _u64, 0xD0: _i8, 0xD1: _i16, 0xD2: _i32, 0xD3: _i64}
+    _strs = {0xD9: _u8, 0xDA: _u16, 0xDB: _u32}
+    _bins = {0xC4: _u8, 0xC5: _u16, 0xC6: _u32}
+
+    @classmethod
+    def packb(cls, obj):
+        out = bytearray()
+        cls._pack(obj, out)
+        return bytes(out)
+
+    @classmethod
+    def _pack(cls, obj, out):
+        # Most common types first, bool before int (bool is an int)
+        if isinstance(obj, str):
+            data = obj.encode("utf-8")
+            n = len(data)
+            if n < 32:
+                out.append(0xA0 | n)
+            elif n < 0x100:
+                out += b"\xd9" + cls._u8.pack(n)
+            elif n < 0x10000:
+                out += b"\xda" + cls._u16.pack(n)
+            else:
+                out += b"\xdb" + cls._u32.pack(n)
+            out += data
+        elif obj is None:
+            out.append(0xC0)
+        elif obj is True:
+            out.append(0xC3)
+        elif obj is False:
+            out.append(0xC2)
+        elif isinstance(obj, int):
+            if 0 <= obj < 0x80:
+                out.append(obj)
+            elif -32 <= obj < 0:
+                out.append(obj & 0xFF)
+            elif obj >= 0:
+                if obj < 0x100:
+                    out += b"\xcc" + cls._u8.pack(obj)
+                elif obj < 0x10000:
+                    out += b"\xcd" + cls._u16.pack(obj)
+                elif obj < 0x100000000:
+                    out += b"\xce" + cls._u32.pack(obj)
+                else:
+                    out += b"\xcf" + cls._u64.pack(obj)
+            else:
+                if obj >= -0x80:
+                    out += b"\xd0" + cls._i8.pack(obj)
+                elif obj >= -0x8000:
+                    out += b"\xd1" + cls._i16.pack(obj)
+                elif obj >= -0x80000000:
+                    out += b"\xd2" + cls._i32.pack(obj)
+                else:
+                    out += b"\xd3" + cls._i64.pack(obj)
+        elif isinstance(obj, float):
+            out += b"\xcb" + cls._f64.pack(obj)
+        elif isinstance(obj, dict):
+            n = len(obj)
+            if n < 16:
+                out.append(0x80 | n)
+            elif n < 0x10000:
+                out += b"\xde" + cls._u16.pack(n)
+            else:
+                out += b"\xdf" + cls._u32.pack(n)
+            for key, value in obj.items():
+                cls._pack(key, out)
+                cls._pack(value, out)
+        elif isinstance(obj, (list, tuple)):
+            n = len(obj)
+            if n < 16:
+                out.append(0x90 | n)
+            elif n < 0x10000:
+                out += b"\xdc" + cls._u16.pack(n)
+            else:
+                out += b"\xdd" + cls._u32.pack(n)
+            for item in obj:
+                cls._pack(item, out)
+        elif isinstance(obj, (bytes, bytearray, memoryview)):
+            n = len(obj)
+            if n < 0x100:
+                out += b"\xc4" + cls._u8.pack(n)
+            elif n < 0x10000:
+                out += b"\xc5" + cls._u16.pack(n)
+            else:
+                out += b"\xc6" + cls._u32.pack(n)
+            out += obj
+        else:
+            raise TypeError(f"Object of type {type(obj).__name__} is not MessagePack serializable")
+
+    @classmethod
+    def unpackb(cls, data):
+        obj, pos = cls._unpack(data, 0)
+        if pos != len(data):
+            raise ValueError(f"{len(data) - pos} extra bytes after MessagePack object.")
+        return obj
+
+    @classmethod
+    def _unpack(cls, data, pos):
+        """ Returns (object, position after it).
+        """
+        b = data[pos]
+        pos += 1
+        if b < 0x80:
+            return b, pos
+        if b >= 0xE0:
+            return b - 0x100, pos
+        if 0xA0 <= b <= 0xBF:
+            end = pos + (b & 0x1F)
+            return str(data[pos:end], "utf-8"), end
+        if 0x90 <= b <= 0x9F:
+            return cls._unpack_array(data, pos, b & 0x0F)
+        if 0x80 <= b <= 0x8F:
+            return cls._unpack_map(data, pos, b & 0x0F)
+        if b == 0xC0:
+            return None, pos
+        if b == 0xC2:
+            return False, pos
+        if b == 0xC3:
+            return True, pos
+        if b == 0xCB:
+            return cls._f64.unpack_from(data, pos)[0], pos + 8
+        if b == 0xCA:
+            return cls._f32.unpack_from(data, pos)[0], pos + 4
+        if b in cls._ints:
+            fmt = cls._ints[b]
+            return fmt.unpack_from(data, pos)[0], pos + fmt.size
+        if b in cls._strs:
+            fmt = cls._strs[b]
+            n = fmt.unpack_from(data, pos)[0]
+            pos += fmt.size
+            return str(data[pos:pos + n], "utf-8"), pos + n
+        if b in cls._bins:
+            fmt = cls._bins[b]
+            n = fmt.unpack_from(data, pos)[0]
+            pos += fmt.size
+            return bytes(data[pos:pos + n]), pos + n
+        if b in (0xDC, 0xDD):
+            fmt = cls._u16 if b == 0xDC else cls._u32
+            return cls._unpack_array(data, pos + fmt.size, fmt.unpack_from(data, pos)[0])
+        if b in (0xDE, 0xDF):
+            fmt = cls._u16 if b == 0xDE else cls._u32
+            return cls._unpack_map(data, pos + fmt.size, fmt.unpack_from(data, pos)[0])
+        raise ValueError(f"Unsupported MessagePack type byte 0x{b:02x}.")
+
+    @classmethod
+    def _unpack_array(cls, data, pos, n):
+        items = []
+        for _ in range(n):
+            item, pos = cls._unpack(data, pos)
+            items.append(item)
+        return items, pos
+
+    @classmethod
+    def _unpack_map(cls, data, pos, n):
+        obj = {}
+        for _ in range(n):
+            key, pos = cls._unpack(data, pos)
+            obj[key], pos = cls._unpack(data, pos)
+        return obj, pos
+
+
+def _json_encode(obj, encoding):
+    return json.dumps(obj, ensure_ascii=False).encode(encoding)
+
+
+def _json_decode(data, encoding):
+    # str() decodes straight out of a memoryview, no intermediate bytes copy
+    return json.loads(str(data, encoding))
+
+
+if msgpack is not None:
+    def _msgpack_encode(obj, encoding):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def _msgpack_decode(data, encoding):
+        return msgpack.unpackb(data, raw=False)
+else:
+    def _msgpack_encode(obj, encoding):
+        return MsgPack.packb(obj)
+
+    def _msgpack_decode(data, encoding):
+        return MsgPack.unpackb(data)
+
+
+register_codec(Codec("json", "text/json", "utf-8", _json_encode, _json_decode))
+register_codec(Codec("msgpack", "application/msgpack", "binary", _msgpack_encode, _msgpack_decode))
+# Only used for responses, picked with format=columnar on a search (see Columnar.py)
+register_codec(Codec("columnar", "application/x-columnar", "binary", Columnar.encode, Columnar.decode))
+
+
+class Compressor:
+    """ One compression method. `compress(data, level)` and `decompress(data, limit)` both
+        return bytes. `decompress` raises ValueError rather than give back more than `limit`
+        bytes (None = no limit), so a tiny request can't unpack into gigabytes.
+        `level` is the default from config.compress_levels.
+    """
+    def __init__(self, name, compress, decompress, level):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.level = config.compress_levels.get(name, level)
+
+
+COMPRESSORS = {}    # name -> Compressor, most preferred first
+
+
+def register_compressor(compressor):
+    COMPRESSORS[compressor.name] = compressor
+
+
+def pick_compressor(accepted):
+    """ The first compressor in the client's "accept-compression" list that we have too.
+    """
+    if isinstance(accepted, str):
+        accepted = accepted.split(",")
+    for name in accepted or []:
+        if name in COMPRESSORS:
+            return COMPRESSORS[name]
+    return None
+
+
+def compress_body(content_bytes, accepted):
+    """ Compresses a frame body if the client takes one of our compressors and the body is
+        big enough to be worth it. Returns (body, compressor name or None).
+    """
+    compressor = pick_compressor(accepted)
+    if compressor is None:
+        return content_bytes, None
+    if len(content_bytes) < config.compress_threshold:
+        compression_stats.skipped(compressor.name)
+        return content_bytes, None
+    start = time.thread_time()
+    compressed = compressor.compress(content_bytes, compressor.level)
+    seconds = time.thread_time() - start
+    if len(compressed) >= len(content_bytes):
+        # Didn't help (already compact or random), send it as it was
+        compression_stats.compressed(compressor.name, len(content_bytes), len(content_bytes), seconds)
+        return content_bytes, None
+    compression_stats.compressed(compressor.name, len(content_bytes), len(compressed), seconds)
+    return compressed, compressor.name
+
+
+def decompress_body(data, name, limit=None):
+    """ Undoes compress_body. Raises ValueError if it comes to more than `limit` bytes.
+    """
+    compressor = COMPRESSORS.get(name)
+    if compressor is None:
+        raise ValueError(f'Unknown content-compression "{name}".')
+    start = time.thread_time()
+    data = compressor.decompress(data, limit)
+    compression_stats.decompressed(name, len(data), time.thread_time() - start)
+    return data
+
+
+class CompressionStats:
+    """ Running totals per compressor, for the compressionstats action. Frames are counted
+        from the moment a client asked for compression: "skipped" were under the threshold.
+        ratio is uncompressed / compressed bytes over everything that was compressed.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def _entry(self, name):
+        if name not in self.totals:
+            self.totals[name] = {
+                "frames": 0, "skipped": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0,
+                "decompressed_frames": 0, "decompressed_bytes": 0, "decompress_cpu_seconds": 0.0,
+            }
+        return self.totals[name]
+
+    def skipped(self, name):
+        with self.lock:
+            self._entry(name)["skipped"] += 1
+
+    def compressed(self, name, bytes_in, bytes_out, seconds):
+        with self.lock:
+            entry = self._entry(name)
+            entry["frames"] += 1
+            entry["bytes_in"] += bytes_in
+            entry["bytes_out"] += bytes_out
+            entry["cpu_seconds"] += seconds
+
+    def decompressed(self, name, size, seconds):
+        with self.lock:
+            entry = self._entry(name)
+            entry["decompressed_frames"] += 1
+            entry["decompressed_bytes"] += size
+            entry["decompress_cpu_seconds"] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            stats = {
+                "threshold": config.compress_threshold,
+                "available": list(COMPRESSORS),
+                "compressors": {},
+            }
+            for name, entry in self.totals.items():
+                entry = dict(entry)
+                entry["level"] = COMPRESSORS[name].level if name in COMPRESSORS else None
+                entry["ratio"] = round(entry["bytes_in"] / entry["bytes_out"], 3) if entry["bytes_out"] else None
+                entry["mb_per_cpu_second"] = (
+                    round(entry["bytes_in"] / (1024 * 1024) / entry["cpu_seconds"], 1) if entry["cpu_seconds"] else None
+                )
+                entry["cpu_seconds"] = round(entry["cpu_seconds"], 6)
+                entry["decompress_cpu_seconds"] = round(entry["decompress_cpu_seconds"], 6)
+                stats["compressors"][name] = entry
+            return stats
+
+
+compression_stats = CompressionStats()
+
+
+def _too_big(limit):
+    return ValueError(f"Compressed body unpacks to more than the {limit} byte limit.")
+
+
+def _zlib_decompress(data, limit=None):
+    if limit is None:
+        return zlib.decompress(data)
+    unpacker = zlib.decompressobj()
+    out = unpacker.decompress(data, limit)
+    if unpacker.unconsumed_tail:
+        # stopped at the limit with input left over
+        raise _too_big(limit)
+    out += unpacker.flush()
+    if len(out) > limit:
+        raise _too_big(limit)
+    return out
+
+
+def _zstd_decompress(data, limit=None):
+    if limit is None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    # Not decompress(max_output_size=...): that trusts a content size in the frame header
+    # and allocates it up front. Read it out instead and stop one byte past the limit.
+    out = bytearray()
+    with zstandard.ZstdDecompressor().stream_reader(bytes(data)) as reader:
+        while len(out) <= limit:
+            chunk = reader.read(limit + 1 - len(out))
+            if not chunk:
+                return bytes(out)
+            out += chunk
+    raise _too_big(limit)
+
+
+def _lz4_decompress(data, limit=None):
+    if limit is None:
+        return lz4.frame.decompress(data)
+    unpacker = lz4.frame.LZ4FrameDecompressor()
+    out = unpacker.decompress(data, max_length=limit + 1)
+    if len(out) > limit or not unpacker.eof:
+        raise _too_big(limit)
+    return out
+
+
+if zstandard is not None:
+    register_compressor(Compressor(
+        "zstd",
+        lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+        _zstd_decompress,
+        3,
+    ))
+if lz4 is not None:
+    register_compressor(Compressor(
+        "lz4",
+        lambda data, level: lz4.frame.compress(data, compression_level=level),
+        _lz4_decompress,
+        0,
+    ))
+register_compressor(Compressor("zlib", zlib.compress, _zlib_decompress, 6))
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+"""
+ColumnStore.py
+Description:
+    Read only, memory mapped storage for history that doesn't change once it's loaded (the
+    bars in data_med). `ingest` reads a collection once and writes a directory of one file
+    per symbol plus an index:
+
+        index.json      the collection, how Date was stored, and per symbol its file, row
+                        count and first / last Date (epoch ms)
+        <symbol>.col    the symbol's documents sorted by Date (then _id) in the Columnar.py
+                        body layout, every field one contiguous little endian array
+
+    config.column_store = {"data_med": "history/data_med"} has the server answer that
+    collection from the files instead of mongo (in any database), everything else still goes
+    to mongo or memory://. Nothing is read at start: index.json is read the first time the
+    collection is used and a symbol's file is mapped the first time a query needs it (the OS
+    pages it in from there, and shares the pages between server processes).
+
+    A query picks the symbols from a Symbol equality / $in and the rows from Date ranges
+    (binary search on the mapped Date column), makes dicts of just those rows and just the
+    fields the filter, sort and projection need, and checks them with MemoryStore's filter
+    code. So any filter, sort or paging token works, it's only fast when it tests Symbol /
+    Date. Sorted by Date (then _id), or not sorted, rows come off the mapping in order and a
+    limit stops the read early.
+
+    Documents come back typed: Volume as an int, _id as a string, Date the way mongo had it
+    (date string, iso string or datetime, going by the first document). A field a document
+    didn't have is left out. Writes and create_index are refused, ingest again (and restart
+    the server) to pick up new data.
+Usage:
+    ./ColumnStore.py collection=data_med [path=history/data_med] [db=stockgame]
+"""
+import array
+import bisect
+import datetime
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+from urllib.parse import quote
+
+import config
+import Columnar
+from MemoryStore import MemoryCursor, matches, project, sort_key
+
+SYMBOL = "Symbol"
+DATE = "Date"
+INDEX = "index.json"
+CHUNK = 1024            # rows turned into dicts at a time when streaming off a mapping
+_DAY_MS = 86400000
+_EPOCH = datetime.datetime(1970, 1, 1)
+_SWAP = sys.byteorder != "little"
+
+
+def date_type(value):
+    """ How a Date was stored: "date" ("2020-01-31"), "iso" (a longer string) or "datetime".
+    """
+    if isinstance(value, str):
+        return "date" if len(value) <= 10 else "iso"
+    return "datetime"
+
+
+def _from_millis(millis, kind):
+    value = _EPOCH + datetime.timedelta(milliseconds=millis)
+    if kind == "date":
+        return value.date().isoformat()
+    if kind == "iso":
+        return value.isoformat()
+    return value
+
+
+def _conditions(query):
+    """ (key, condition) for the top level of a filter and its $and parts, which all have to hold.
+    """
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            for part in condition:
+                yield from _conditions(part)
+        else:
+            yield key, condition
+
+
+def _fields(query, found=None):
+    """ The top level fields a filter tests.
+    """
+    found = set() if found is None else found
+    for key, condition in (query or {}).items():
+        if key in ("$and", "$or", "$nor"):
+            for part in condition:
+                _fields(part, found)
+        elif not key.startswith("$"):
+            found.add(key.split(".")[0])
+    return found
+
+
+def _is_operators(condition):
+    return isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition)
+
+
+def _symbols(query):
+    """ The Symbol values a filter allows, None if it doesn't say.
+    """
+    allowed = None
+    for key, condition in _conditions(query):
+        if key != SYMBOL:
+            continue
+        if _is_operators(condition):
+            if "$eq" in condition:
+                values = [condition["$eq"]]
+            elif isinstance(condition.get("$in"), list):
+                values = condition["$in"]
+            else:
+                continue
+        elif isinstance(condition, (dict, list)) or hasattr(condition, "search"):
+            continue
+        else:
+            values = [condition]
+        try:
+            values = set(values)
+        except TypeError:
+            continue
+        allowed = values if allowed is None else allowed & values
+    return allowed
+
+
+def _millis(target, widen):
+    try:
+        millis = Columnar.to_millis(target)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if isinstance(target, str):
+        # strings compare as strings in mongo ("2020-01-31" < "2020-01-31T00:00"), a day
+        # either way keeps every row that could match
+        millis += widen * _DAY_MS
+    return millis
+
+
+def _date_bounds(query):
+    """ (lowest, highest) epoch ms a Date can have and still pass the filter, None for no
+        limit. Can let through rows that don't match (matches() has the last word), never
+        leaves out one that does.
+    """
+    low, high = None, None
+
+    def narrow(lower, upper):
+        nonlocal low, high
+        if lower is not None:
+            low = lower if low is None else max(low, lower)
+        if upper is not None:
+            high = upper if high is None else min(high, upper)
+
+    for key, condition in _conditions(query):
+        if key == "$or":
+            # a row passes through one branch, so it's inside the widest of them
+            ranges = [_date_bounds(part) for part in condition]
+            if ranges:
+                narrow(None if any(r[0] is None for r in ranges) else min(r[0] for r in ranges),
+                       None if any(r[1] is None for r in ranges) else max(r[1] for r in ranges))
+        elif key == DATE and _is_operators(condition):
+            for op, target in condition.items():
+                if op in ("$gt", "$gte", "$eq"):
+                    narrow(_millis(target, -1), None)
+                if op in ("$lt", "$lte", "$eq"):
+                    narrow(None, _millis(target, 1))
+        elif key == DATE and not isinstance(condition, (dict, list)):
+            narrow(_millis(condition, -1), _millis(condition, 1))
+    return low, high
+
+
+class SymbolFile:
+    """ One symbol's mapped column file.
+    """
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind            # how Date goes back out, see date_type
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        meta = Columnar.read_meta(self.map)
+        self.rows = meta["rows"]
+        self.columns = {column["name"]: self._column(column) for column in meta["columns"]}
+        self.dates = self.columns[DATE][1]
+
+    def _column(self, column):
+        kind, offset, rows = column["type"], column["offset"], self.rows
+        if kind in ("str", "json"):
+            # offsets (rows + 1 of them) then the utf-8 bytes
+            return kind, self._numbers("q", offset, rows + 1), self.view[offset + (rows + 1) * 8:offset + column["size"]]
+        return kind, self._numbers("d" if kind == "f8" else "q", offset, rows)
+
+    def _numbers(self, code, offset, count):
+        view = self.view[offset:offset + count * 8]
+        if _SWAP:
+            values = array.array(code, bytes(view))
+            values.byteswap()
+            return values
+        return view.cast(code)
+
+    def slice(self, low, high):
+        """ (first, last + 1) row with low <= Date <= high (None = no limit).
+        """
+        start = 0 if low is None else bisect.bisect_left(self.dates, low)
+        stop = self.rows if high is None else bisect.bisect_right(self.dates, high)
+        return start, max(start, stop)
+
+    def values(self, name, start, stop):
+        column = self.columns[name]
+        kind = column[0]
+        if kind in ("str", "json"):
+            offsets, data = column[1][start:stop + 1].tolist(), column[2]
+            values = [str(data[a:b], "utf-8") for a, b in zip(offsets, offsets[1:])]
+            return [json.loads(value) for value in values] if kind == "json" else values
+        values = column[1][start:stop].tolist()
+        if kind == "f8":
+            return [None if value != value else value for value in values]
+        if kind == "ts":
+            dates = self.kind if name == DATE else "datetime"
+            return [None if value == Columnar.NAT else _from_millis(value, dates) for value in values]
+        return values
+
+    def documents(self, start, stop, fields=None):
+        """ Rows start to stop as dicts, with only `fields` (None = all of them).
+        """
+        names = [name for name in self.columns if fields is None or name in fields]
+        columns = [self.values(name, start, stop) for name in names]
+        return [{name: value for name, value in zip(names, row) if value is not None} for row in zip(*columns)]
+
+    def close(self):
+        for column in self.columns.values():
+            for part in column[1:]:
+                if isinstance(part, memoryview):
+                    part.release()
+        self.dates = None
+        self.view.release()
+        self.map.close()
+
+
+class ColumnCursor(MemoryCursor):
+    """ find() on a ColumnCollection: sort() and limit() then iterate.
+    """
+    def __iter__(self):
+        parts, fields = self.collection.plan(self.query, self.projection, self.sorting)
+        direction = self._direction(parts)
+        documents = self._documents(parts, fields, direction or 1)
+        if direction is None:
+            documents = list(documents)
+            for key, order in reversed(self.sorting):
+                documents.sort(key=lambda document: sort_key(document.get(key)), reverse=order < 0)
+            documents = iter(documents)
+        count = 0
+        for document in documents:
+            yield project(document, self.projection)
+            count += 1
+            if count == self.count:
+                break
+
+    def _direction(self, parts):
+        """ 1 or -1 if the files' own order (Symbol, Date, _id) is the sort asked for, else None.
+        """
+        if not self.sorting:
+            return 1
+        names = [key for key, order in self.sorting]
+        orders = {order for key, order in self.sorting}
+        natural = [SYMBOL, DATE, "_id"]
+        if len({part[0] for part in parts}) <= 1 and names[0] != SYMBOL:
+            natural = [DATE, "_id"]
+        if len(orders) == 1 and names == natural[:len(names)]:
+            return orders.pop()
+        return None
+
+    def _documents(self, parts, fields, direction):
+        if direction < 0:
+            parts = parts[::-1]
+        for symbol, start, stop in parts:
+            chunks = range(start, stop, CHUNK)
+            for first in (reversed(chunks) if direction < 0 else chunks):
+                documents = symbol.documents(first, min(first + CHUNK, stop), fields)
+                self.collection.rows_read += len(documents)
+                if direction < 0:
+                    documents.reverse()
+                for document in documents:
+                    if matches(document, self.query):
+                        yield document
+
+
+class ColumnCollection:
+    """ A collection served from ingest's files. Looks like the reading half of a pymongo
+        collection.
+    """
+    read_only = True
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = None           # index.json, read on first use
+        self.files = {}             # file name -> SymbolFile, mapped on first use
+        self.queries = 0
+        self.rows_read = 0
+
+    def _entries(self):
+        with self.lock:
+            if self.index is None:
+                try:
+                    with open(os.path.join(self.path, INDEX)) as f:
+                        index = json.load(f)
+                except FileNotFoundError:
+                    raise ValueError(f"{self.name} hasn't been ingested into {self.path} yet (./ColumnStore.py collection={self.name}).")
+                index["symbols"].sort(key=lambda entry: sort_key(entry["symbol"]))
+                self.index = index
+            return self.index
+
+    def _file(self, entry):
+        with self.lock:
+            symbol = self.files.get(entry["file"])
+            if symbol is None:
+                symbol = self.files[entry["file"]] = SymbolFile(os.path.join(self.path, entry["file"]), self.index["date_type"])
+            return symbol
+
+    def find(self, query=None, projection=None, batch_size=0, **kwargs):
+        return ColumnCursor(self, query or {}, projection)
+
+    def plan(self, query, projection, sorting):
+        """ ([(SymbolFile, first row, last row + 1)], fields to read or None for all).
+        """
+        self.queries += 1
+        symbols = _symbols(query)
+        low, high = _date_bounds(query)
+        parts = []
+        for entry in self._entries()["symbols"]:
+            if symbols is not None and entry["symbol"] not in symbols:
+                continue
+            if (low is not None and entry["last"] < low) or (high is not None and entry["first"] > high):
+                continue    # no need to map it
+            symbol = self._file(entry)
+            start, stop = symbol.slice(low, high)
+            if stop > start:
+                parts.append((symbol, start, stop))
+
+        fields = None
+        include = {key for key, value in (projection or {}).items() if value and key != "_id"}
+        if include:
+            fields = include | _fields(query) | {key for key, order in sorting} | {"_id"}
+        return parts, fields
+
+    def count_documents(self, query):
+        return sum(1 for document in self.find(query))
+
+    def distinct(self, key, query=None):
+        if key == SYMBOL and not query:
+            return [entry["symbol"] for entry in self._entries()["symbols"]]
+        values = {}
+        for document in self.find(query, {key: 1}):
+            if key in document:
+                values.setdefault(json.dumps(document[key], sort_keys=True, default=str), document[key])
+        return list(values.values())
+
+    def index_information(self):
+        return {"_id_": {"key": [("_id", 1)]},
+                f"{SYMBOL}_1_{DATE}_1": {"key": [(SYMBOL, 1), (DATE, 1)], "column_store": self.path}}
+
+    def _read_only(self, *args, **kwargs):
+        raise ValueError(f"{self.name} is read only, it's served from {self.path} (config.column_store).")
+
+    insert_one = insert_many = bulk_write = delete_many = create_index = drop_index = _read_only
+
+    def stats(self):
+        with self.lock:
+            index, files = self.index, list(self.files.values())
+        stats = {"path": self.path, "loaded": index is not None, "queries": self.queries, "rows_read": self.rows_read}
+        if index is not None:
+            stats.update(symbols=len(index["symbols"]), rows=index["rows"], ingested=index["ingested"])
+        stats["mapped_files"] = len(files)
+        stats["mapped_bytes"] = sum(len(symbol.map) for symbol in files)
+        return stats
+
+    def close(self):
+        with self.lock:
+            for symbol in self.files.values():
+                try:
+                    symbol.close()
+                except BufferError:
+                    pass    # a cursor still has a view, the process is going away anyway
+            self.files = {}
+
+
+class ColumnDatabase:
+    """ client[db]: the column store's collections, anything else from the real database.
+    """
+    def __init__(self, database, collections):
+        self.database = database
+        self.collections = collections
+
+    def __getitem__(self, name):
+        collection = self.collections.get(name)
+        return self.database[name] if collection is None else collection
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
+class ColumnClient:
+    """ Wraps the pool's client (mongo or memory) so the collections in config.column_store
+        are answered from their files.
+    """
+    def __init__(self, client, paths):
+        self.client = client
+        self.collections = {name: ColumnCollection(name, path) for name, path in paths.items()}
+
+    def __getitem__(self, name):
+        return ColumnDatabase(self.client[name], self.collections)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def stats(self):
+        return {name: collection.stats() for name, collection in self.collections.items()}
+
+    def close(self):
+        for collection in self.collections.values():
+            collection.close()
+        self.client.close()
+
+
+def _file_name(symbol, used):
+    name = quote(str(symbol), safe="")[:100] or "_"
+    while name + ".col" in used:
+        name += "_"
+    used.add(name + ".col")
+    return name + ".col"
+
+
+def _write(path, data):
+    # a server that has the old file mapped keeps reading the old one
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def ingest(collection, path):
+    """ Writes a collection's documents (anything with find / distinct, mongo or memory) to
+        per symbol column files in `path`. Documents without a Symbol or a readable Date are
+        skipped. Returns a summary.
+    """
+    started = time.time()
+    os.makedirs(path, exist_ok=True)
+    kind = None
+    entries, used, columns = [], set(), {}
+    rows = skipped = size = 0
+    for symbol in sorted(collection.distinct(SYMBOL), key=sort_key):
+        if symbol is None or isinstance(symbol, (dict, list)):
+            continue
+        documents = []
+        for document in collection.find({SYMBOL: symbol}):
+            try:
+                millis = Columnar.to_millis(document.get(DATE))
+            except (ValueError, TypeError, OverflowError):
+                skipped += 1
+                continue
+            document["_id"] = str(document.get("_id", ""))
+            documents.append((millis, document["_id"], document))
+        if not documents:
+            continue
+        documents.sort(key=lambda item: item[:2])
+        if kind is None:
+            kind = date_type(documents[0][2][DATE])
+        for item in documents:
+            columns.update(dict.fromkeys(item[2]))
+
+        name = _file_name(symbol, used)
+        body = Columnar.encode({"results": {"data": [item[2] for item in documents]}})
+        _write(os.path.join(path, name), body)
+        entries.append({"symbol": symbol, "file": name, "rows": len(documents),
+                        "first": documents[0][0], "last": documents[-1][0]})
+        rows += len(documents)
+        size += len(body)
+
+    index = {"collection": getattr(collection, "name", None), "date_type": kind or "date",
+             "columns": list(columns), "rows": rows, "skipped": skipped,
+             "ingested": datetime.datetime.utcnow().isoformat(timespec="seconds"), "symbols": entries}
+    _write(os.path.join(path, INDEX), json.dumps(index).encode("utf-8"))
+    for name in os.listdir(path):
+        if name.endswith(".col") and name not in used:
+            os.remove(os.path.join(path, name))     # symbols that are gone since the last ingest
+    return {"path": path, "symbols": len(entries), "rows": rows, "skipped": skipped,
+            "bytes": size, "seconds": round(time.time() - started, 3)}
+
+
+if __name__ == "__main__":
+    from pymongo import MongoClient
+    from helpers import myArgParse
+
+    kwargs, args = myArgParse(sys.argv)
+    collection = kwargs.get("collection")
+    path = kwargs.get("path", config.column_store.get(collection))
+    if not (collection and path):
+        print(f"Usage: {sys.argv[0]} collection=<name> [path=<directory>] [db=<mongo database>]")
+        sys.exit()
+    client = MongoClient(config.mongo_uri)
+    try:
+        print(json.dumps(ingest(client[kwargs.get("db", config.database)][collection], path), indent=2))
+    finally:
+        client.close()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Columnar.py
+Description:
+    A binary body format for search results where every row has the same fields (the
+    OHLCV bars in data_med). Instead of a list of dicts that repeats every key on every row,
+    each field is sent once as a contiguous little endian array:
+
+        Open, High, Low, Close, AdjClose   float64
+        Volume                             int64 (it's a string in mongo)
+        Date                               int64 milliseconds since the epoch (UTC)
+
+    Other fields get a type from their values: int64, float64 (NaN where a row doesn't have
+    it), timestamps for datetimes, utf-8 strings, or json text for anything else.
+
+    With numpy installed the client decodes the columns straight into numpy arrays (Date as
+    datetime64[ms]) with no per row python objects. The arrays are read only views of the
+    frame body. Without numpy they come back as array.array (strings as lists).
+
+    Body layout:
+        b"COL1"                  magic
+        uint32                   length of the json meta that follows
+        meta                     json: {"result": ..., "rows": n, "columns": [{"name", "type", "offset", "size"}]}
+        column blocks            each starts on an 8 byte boundary (offset is from the body start)
+
+    "result" is the response with its "data" list taken out. A response that isn't a list of
+    dicts (errors, counts, stats) is all in "result" and there are no columns. A string /
+    json column is int64 offsets (rows + 1 of them) followed by the utf-8 bytes.
+"""
+import array
+import datetime
+import json
+import math
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"COL1"
+_meta_length = struct.Struct("<I")
+
+# Known data_med fields, the rest are worked out from their values
+SCHEMA = {
+    "Date": "ts",
+    "Open": "f8",
+    "High": "f8",
+    "Low": "f8",
+    "Close": "f8",
+    "AdjClose": "f8",
+    "Volume": "i8",
+}
+
+NAT = -(2 ** 63)    # missing timestamp, the same bit pattern numpy uses for NaT
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_SWAP = sys.byteorder != "little"
+
+
+def to_millis(value):
+    """ Epoch milliseconds for a datetime, date or iso formatted string. Naive times are UTC.
+        Raises ValueError / TypeError for anything else.
+    """
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        # integer arithmetic, timestamp() goes through a float
+        delta = value - _EPOCH
+        return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+    if isinstance(value, datetime.date):
+        return (value - _EPOCH.date()).days * 86400000
+    raise TypeError(f"Not a date: {value!r}")
+
+
+def _coerce(kind, values):
+    """ The column's values converted for `kind`, raises if one of them doesn't fit.
+    """
+    if kind == "f8":
+        return [math.nan if value is None else float(value) for value in values]
+    if kind == "i8":
+        # Volume is stored as "1237600"
+        return [value if type(value) is int else int(value) for value in values]
+    if kind == "ts":
+        return [NAT if value is None else to_millis(value) for value in values]
+    raise ValueError(kind)
+
+
+def _infer(values):
+    """ (type, values) for a column without a SCHEMA entry.
+    """
+    present = [value for value in values if value is not None]
+    types = {type(value) for value in present}
+    if types and types <= {int} and len(present) == len(values):
+        if all(-2 ** 63 <= value < 2 ** 63 for value in values):
+            return "i8", values
+    if types and types <= {int, float}:
+        return "f8", _coerce("f8", values)
+    if types and types <= {datetime.datetime, datetime.date}:
+        return "ts", _coerce("ts", values)
+    if types == {str} and len(present) == len(values):
+        return "str", values
+    return "json", [json.dumps(value, default=str) for value in values]
+
+
+def _column(name, values):
+    kind = SCHEMA.get(name)
+    if kind is not None:
+        if kind == "i8" and None in values:
+            kind = "f8"     # no missing value in int64, NaN will do
+        try:
+            return kind, _coerce(kind, values)
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return _infer(values)
+
+
+def _pack(kind, values):
+    if kind in ("str", "json"):
+        data = [value.encode("utf-8") for value in values]
+        offsets = array.array("q", [0])
+        total = 0
+        for item in data:
+            total += len(item)
+            offsets.append(total)
+        if _SWAP:
+            offsets.byteswap()
+        return offsets.tobytes() + b"".join(data)
+    packed = array.array("d" if kind == "f8" else "q", values)
+    if _SWAP:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def encode(result, encoding=None):
+    """ Codec encode: a response dict to a columnar body.
+    """
+    rows = None
+    results = result.get("results") if isinstance(result, dict) else None
+    if isinstance(results, dict) and isinstance(results.get("data"), list):
+        if all(isinstance(row, dict) for row in results["data"]):
+            rows = results["data"]
+    if rows is None:
+        meta = json.dumps({"result": result}).encode("utf-8")
+        return MAGIC + _meta_length.pack(len(meta)) + meta
+
+    names = {}
+    for row in rows:
+        for name in row:
+            names[name] = None      # first seen order
+
+    blocks = []
+    columns = []
+    for name in names:
+        kind, values = _column(name, [row.get(name) for row in rows])
+        blocks.append(_pack(kind, values))
+        columns.append({"name": name, "type": kind, "size": len(blocks[-1])})
+
+    # The offsets depend on how long the meta is, which depends on the offsets. Work them
+    # out from a meta length guess and grow the guess until it holds.
+    stripped = dict(result, results={k: v for k, v in results.items() if k != "data"})
+    guess = 0
+    while True:
+        offset = _align(len(MAGIC) + _meta_length.size + guess)
+        for column in columns:
+            column["offset"] = offset
+            offset = _align(offset + column["size"])
+        meta = json.dumps({"result": stripped, "rows": len(rows), "columns": columns}).encode("utf-8")
+        if len(meta) <= guess:
+            break
+        guess = len(meta) + 64
+
+    body = bytearray(MAGIC + _meta_length.pack(len(meta)) + meta)
+    for column, block in zip(columns, blocks):
+        body += bytes(column["offset"] - len(body))
+        body += block
+    return bytes(body)
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def decode(data, encoding=None):
+    """ Codec decode: a columnar body back to the response dict, with "data" holding
+        {field: array} instead of a list of rows.
+    """
+    # One copy out of the receive buffer, the columns are views of it
+    data = bytes(data)
+    meta = read_meta(data)
+    result = meta["result"]
+    if "columns" not in meta:
+        return result
+
+    rows = meta["rows"]
+    columns = {}
+    for column in meta["columns"]:
+        columns[column["name"]] = _unpack(column["type"], data, column["offset"], column["size"], rows)
+    result["results"]["data"] = columns
+    return result
+
+
+def read_meta(data):
+    """ The json meta at the front of a columnar body (bytes, memoryview or an mmap, only the
+        meta is copied). Raises ValueError if it isn't one.
+    """
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a columnar body.")
+    start = len(MAGIC) + _meta_length.size
+    (length,) = _meta_length.unpack_from(data, len(MAGIC))
+    return json.loads(bytes(data[start:start + length]).decode("utf-8"))
+
+
+def _unpack(kind, data, offset, size, rows):
+    if kind in ("str", "json"):
+        offsets = _ints(data, offset, rows + 1)
+        base = offset + (rows + 1) * 8
+        view = memoryview(data)
+        values = [str(view[base + offsets[i]:base + offsets[i + 1]], "utf-8") for i in range(rows)]
+        if kind == "json":
+            values = [json.loads(value) for value in values]
+        return values
+    if numpy is not None:
+        values = numpy.frombuffer(data, dtype="<f8" if kind == "f8" else "<i8", count=rows, offset=offset)
+        return values.view("datetime64[ms]") if kind == "ts" else values
+    values = array.array("d" if kind == "f8" else "q")
+    values.frombytes(data[offset:offset + size])
+    if _SWAP:
+        values.byteswap()
+    return values
+
+
+def _ints(data, offset, count):
+    values = array.array("q")
+    values.frombytes(data[offset:offset + count * 8])
+    if _SWAP:
+        values.byteswap()
+    return values
+
+
+def to_rows(columns):
+    """ Turns decoded columns back into a list of row dicts (slow, it's every value as a
+        python object again). Handy for printing.
+    """
+    names = list(columns)
+    count = len(columns[names[0]]) if names else 0
+    return [{name: _item(columns[name][i]) for name in names} for i in range(count)]
+
+
+def _item(value):
+    return value.item() if hasattr(value, "item") else value
@@ -2,10 +2,17 @@
 """Api.py
 
 """
-from pymongo import MongoClient
+import config
 import pprint
 import json
 import datetime
+import time
+import base64
+from Codecs import compression_stats
+import MemoryStore
+from MemoryStore import MemoryPool, Write
+from ColumnStore import ColumnClient
+import Analytics
 
 
 def logg(message):
@@ -15,11 +22,114 @@ def logg(message):
     f.write(message+"\n")
     f.close()
 
+def parseSort(sort):
+    """ Turns a sort from a request into a list of (key, 1 or -1) for pymongo. Takes
+        "Symbol,-Date" (a leading - means descending), a json list of keys or [key, direction]
+        pairs, or a json object {key: direction}. Raises ValueError if it can't.
+    """
+    if sort in (None, ""):
+        return None
+    if isinstance(sort,str) and sort.lstrip()[:1] in ("[","{"):
+        sort = json.loads(sort)
+    elif isinstance(sort,str):
+        sort = sort.split(",")
+    if isinstance(sort,dict):
+        sort = list(sort.items())
+
+    keys = []
+    for item in sort:
+        if isinstance(item,str):
+            item = item.strip()
+            key, direction = (item[1:], -1) if item.startswith("-") else (item, 1)
+        else:
+            key, direction = item
+            direction = {"asc":1,"desc":-1}.get(str(direction).lower(),direction)
+        if not key or direction not in (1,-1):
+            raise ValueError(f"Bad sort key {item!r}.")
+        keys.append((key,int(direction)))
+    return keys
+
+def parseProjection(projection):
+    """ Turns a projection from a request into a pymongo projection dict. Takes "Date,Close",
+        a json list of field names or a json object like {"Volume":0}.
+    """
+    if projection in (None, ""):
+        return None
+    if isinstance(projection,str) and projection.lstrip()[:1] in ("[","{"):
+        projection = json.loads(projection)
+    elif isinstance(projection,str):
+        projection = [field.strip() for field in projection.split(",") if field.strip()]
+    if isinstance(projection,list):
+        projection = {field:1 for field in projection}
+    return dict(projection)
+
+def _tokenValue(value):
+    # Same {"$date"} / {"$oid"} shapes as bson's json_util, without needing bson
+    if isinstance(value,datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return {"$date":value.isoformat()}
+    if isinstance(value,MemoryStore.ObjectId):
+        return {"$oid":str(value)}
+    raise TypeError(f"Can't put a {type(value).__name__} in a continuation token.")
+
+def _tokenHook(value):
+    if list(value) == ["$date"]:
+        return datetime.datetime.fromisoformat(value["$date"])
+    if list(value) == ["$oid"]:
+        return MemoryStore.ObjectId(value["$oid"])
+    return value
+
+def encodeToken(sort,values):
+    """ Continuation token: the sort it belongs to and the sort key values of the last row
+        sent. ObjectIds and dates are tagged so they come back as themselves. Opaque to the
+        client. The base64 "=" padding is dropped so the token can be passed as after=<token>.
+    """
+    token = json.dumps({"sort":sort,"after":values},default=_tokenValue)
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decodeToken(token,sort):
+    try:
+        token = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)),object_hook=_tokenHook)
+        after, made_with = token["after"], [list(key) for key in token["sort"]]
+        # One value per sort key, or query() can't build the resume filter
+        if not isinstance(after,list) or not isinstance(token["sort"],list) or len(after) != len(made_with):
+            raise ValueError
+    except Exception:
+        raise ValueError("Bad continuation token.")
+    if [list(key) for key in sort] != made_with:
+        raise ValueError("Continuation token was made with a different sort.")
+    return after
+
+def openPool(db):
+    """ (pool, database name) for the server's db setting. "memory://name" (or just
+        "memory://") keeps the data in this process (MemoryStore.py), anything else is the
+        name of a mongo database.
+    """
+    if db.startswith("memory://"):
+        name = db[len("memory://"):] or config.database
+        pool = MemoryPool(name)
+        pool.load(config.memory_load)
+    else:
+        from MongoPool import MongoPool
+        pool, name = MongoPool(), db
+    if config.column_store:
+        # history collections come from their mapped files (ColumnStore.py)
+        pool.client = ColumnClient(pool.client,config.column_store)
+    return pool, name
+
 class Api(object):
-    def __init__(self,db,request):
+    def __init__(self,db,request,pool=None,workers=None,cache=None,advisor=None,metrics=None,profiler=None,versions=None):
         self.request = request
         self.action = self.request["action"]
-        self.mongo = MongoHelper(db)
+        self.pool = pool
+        self.workers = workers
+        self.cache = cache
+        self.advisor = advisor
+        self.metrics = metrics
+        self.profiler = profiler
+        self.versions = versions
+        self.mongo = MongoHelper(db,client=pool.client if pool else None,cache=cache,advisor=advisor,versions=versions)
         if self.request.get("collection") != None:
             self.mongo.setCollection(self.request.get("collection"))
 
@@ -89,40 +199,361 @@ class Api(object):
 
                 From Client Terminal:
                     ./Client.py action=insert collection=temporary data='{"stock":"GOOG","price":1000.88,"date":"13 Jan 2018"}'
+
+            Bulk writes - insert_many, update and delete take a list in "data" (a json string or
+                a list) and run it as unordered bulk writes, config.bulk_batch_size operations
+                per batch. One bad item doesn't stop the rest. The response has the totals, the
+                counts for each batch and a "failed" list of item indexes with the reason.
+
+                insert_many : a list of documents
+                update      : a list of {"filter": {...}, "update": {...}} ("$set" is assumed
+                              if update has no $ operators). Add "many": true to change every
+                              match instead of the first, "upsert": true to insert if none match
+                delete      : a list of filters, every document matching a filter is deleted
+                              (an empty filter is refused)
+
+                From Client Terminal:
+                    ./Client.py action=insert_many collection=temporary data='[{"stock":"GOOG"},{"stock":"AAPL"}]'
+                    ./Client.py action=update collection=temporary data='[{"filter":{"stock":"GOOG"},"update":{"price":1001}}]'
+                    ./Client.py action=delete collection=temporary data='[{"stock":"AAPL"}]'
+                    ./Client.py action=insert_many collection=temporary file=quotes.jsonl batch=5000
+
+            Search and SearchKey also take these optional keys:
+                limit       : Most rows to return
+                sort        : "Symbol,-Date" (- means descending), or json like [["Date",-1]]
+                projection  : Fields to return, "Date,Close" or json like {"Volume":0}
+                after       : The "next" token from the previous page
+                format      : "columnar" sends the rows back as one typed array per field
+                              in a binary frame (see Columnar.py), never streamed
+
+                When a limit cuts the result short, the response has a "next" token. Send it
+                back as "after" (same params and sort) to get the following page. Paging picks
+                up after the last row's sort key (with _id breaking ties), not with skip, so deep
+                pages cost the same as the first.
+
+                From Client in Terminal:
+
+                    ./Client.py action=search collection=data_med params='{"Symbol":"GOOG"}' limit=50 sort=-Date projection=Date,Close
+
+            Streaming: add "stream" to a search or searchkey request (true, or the number of
+                rows per chunk) and the rows come back in several frames as mongo hands them
+                over, followed by a final frame with the count. Use Client.stream() to read them.
+
+                From Client in Terminal:
+
+                    ./Client.py action=search collection=data_med params='{"Symbol":"GOOG"}' stream=500
+
+            4) PoolStats - no other keys needed. Returns the checkout / wait counters of the
+               server's shared MongoDB connection pool.
+
+                From Client Terminal:
+                    ./Client.py action=poolstats
+
+            5) WorkerStats - no other keys needed. Returns the size, queue depth and counters of
+               the thread pool that runs database work off the server's selector loop.
+
+                From Client Terminal:
+                    ./Client.py action=workerstats
+
+            6) CompressionStats - no other keys needed. Returns, per compressor, how many response
+               bodies were compressed or skipped (under config.compress_threshold), bytes in and
+               out, the ratio and the CPU time spent.
+
+                From Client Terminal:
+                    ./Client.py action=compressionstats
+
+            7) CacheStats - no other keys needed. Returns the hit / miss / eviction counters of
+               the server's search result cache. Any search can skip the cache with cache=bypass.
+               "versions" has how many answers were tagged and how many were answered with
+               "not modified" because the client already had them (if-none-match).
+
+                From Client Terminal:
+                    ./Client.py action=cachestats
+                    ./Client.py action=searchkey collection=info key=Symbol value=GOOG cache=bypass
+
+            8) Resample / Rolling / Returns / Stats - price series math done on the server (numpy)
+               so only the answer comes back, not every bar. They take "collection", "symbol"
+               (or a "params" filter) and optional "start" / "end" dates ("2015-01-01").
+
+                resample : "every" W, M (default), Q, Y or D. OHLCV bars per period
+                rolling  : "field" (Close), "window" bars (20), "stat" mean, std, min, max or sum
+                returns  : "field" (Close), "period" bars (1), "kind" simple or log
+                stats    : "field" (Close). count, min / max, mean, std, total return,
+                           annualized volatility, max drawdown
+
+                From Client Terminal:
+                    ./Client.py action=resample collection=data_med symbol=GOOG start=2010-01-01 every=M
+                    ./Client.py action=rolling collection=data_med symbol=GOOG window=50 stat=mean
+                    ./Client.py action=returns collection=data_med symbol=GOOG kind=log
+                    ./Client.py action=stats collection=data_med symbol=GOOG start=2010-01-01 end=2019-12-31
+
+            9) Index_Stats - optional "collection". The filter shapes searches have used (fields
+               tested for equality, sort keys, range fields), how often and how slow, the index
+               that would serve each one and whether there already is one. List_Indexes shows a
+               collection's indexes, Create_Index builds one ("keys" like a sort, "unique" optional).
+               config.index_auto builds the suggested index for hot slow shapes by itself.
+
+                From Client Terminal:
+                    ./Client.py action=index_stats collection=data_med
+                    ./Client.py action=list_indexes collection=data_med
+                    ./Client.py action=create_index collection=data_med keys=Symbol,Date
+
+            10) Batch - handled by ServerMessage before it gets here. "requests" is a list of
+               ordinary request contents, they run at the same time and come back as a list of
+               results in the same order. One failing doesn't fail the others.
+
+                From Client Terminal:
+                    ./Client.py action=batch requests='[{"action":"test"},{"action":"searchkey","collection":"info","key":"Symbol","value":"GOOG"}]'
+
+            11) ServerStats - no other keys needed. Returns this server process's counters (see
+               Metrics.py): requests, errors and cache hits per action, latency per action split
+               into queue / db / encode / send / total, bytes in and out, connections and event
+               loop time. ("stats" was already taken by the analytics action.)
+
+                From Client Terminal:
+                    ./Client.py action=serverstats
+
+            12) Profile - turns profiling on or off without restarting (see Profiler.py). Any of
+               "state" (on / off), "sample" (percent of matching requests run under cProfile),
+               "match_action", "match_collection" (comma separated, empty for all), "slow_ms"
+               (log requests slower than this to slow.jsonl) and "memory" (1 adds tracemalloc).
+               Settings not given stay as they are. Returns the settings and counts.
+
+                From Client Terminal:
+                    ./Client.py action=profile state=on sample=10 match_action=search slow_ms=200
+                    ./Client.py action=profile state=off
         """
         if self.action == "test":
             return {"results":{"Success":"Your client is communicating with the server."}}
 
+        if self.action == "poolstats":
+            if self.pool == None:
+                return {"results":{"Error":"This server is not using a shared connection pool."}}
+            stats = self.pool.counters.snapshot()
+            if isinstance(self.pool.client,ColumnClient):
+                stats["column_store"] = self.pool.client.stats()
+            return {"results":stats}
+
+        if self.action == "workerstats":
+            if self.workers == None:
+                return {"results":{"Error":"This server is not using a worker pool."}}
+            return {"results":self.workers.stats()}
+
+        if self.action == "compressionstats":
+            return {"results":compression_stats.snapshot()}
+
+        if self.action == "serverstats":
+            if self.metrics == None:
+                return {"results":{"Error":"This server is not keeping metrics (config.metrics_enabled)."}}
+            return {"results":self.metrics.snapshot()}
+
+        if self.action == "profile":
+            if self.profiler == None:
+                return {"results":{"Error":"This server can't profile requests."}}
+            options = {key:self.request[key] for key in ("state","sample","match_action","match_collection","slow_ms","memory")
+                       if key in self.request}
+            try:
+                self.profiler.configure(**options)
+            except (ValueError, TypeError) as e:
+                return {"results":{"Error":f"Bad profile setting: {e}"}}
+            except OSError as e:
+                return {"results":{"Error":f"Can't write profiles: {e}"}}
+            return {"results":self.profiler.status()}
+
+        if self.action == "cachestats":
+            if self.cache == None and self.versions == None:
+                return {"results":{"Error":"This server is not using a result cache."}}
+            stats = self.cache.stats() if self.cache != None else {}
+            if self.versions != None:
+                stats["versions"] = self.versions.stats()
+            return {"results":stats}
+
+        if self.action == "index_stats":
+            if self.advisor == None:
+                return {"results":{"Error":"This server is not tracking queries (config.index_advisor)."}}
+            collection = self.request.get("collection")
+            names = [collection] if collection else self.advisor.collections(self.mongo.db_name)
+            indexes = {name:[index["key"] for index in self.mongo.list_indexes(name)] for name in names}
+            return {"results":self.advisor.stats(self.mongo.db_name,collection,indexes)}
+
         collection = self.request.get("collection",None)
         if collection == None:
             return {"results":{"Error":"Inserting into mongo needs a specified 'collection'."}}
         
         self.mongo.setCollection(collection)
 
+        if self.action in ("insert","insert_many","update","delete","create_index") and self.mongo.read_only():
+            return {"results":{"Error":f"{collection} is read only here, it is served from config.column_store."}}
+
         if self.action == "insert":
             data = self.request.get("data")
             if data == None:
                 return {"results":{"Error":"Inserting into mongo needs 'data'."}}
             result = self.mongo.insert(data)
             content = {"results": result}
-        elif self.action == "searchkey":
+        elif self.action in ("insert_many","update","delete"):
+            data = self.request.get("data")
+            if isinstance(data,str):
+                data = json.loads(data)
+            if isinstance(data,dict):
+                data = [data]
+            if not isinstance(data,list) or not data:
+                return {"results":{"Error":f"{self.action} needs a list of items in 'data'."}}
+            if self.action == "insert_many":
+                result = self.mongo.insert_many(data)
+            elif self.action == "update":
+                result = self.mongo.update(data)
+            else:
+                result = self.mongo.delete(data)
+            content = {"results": result}
+        elif self.action in ("searchkey","search"):
+            params, error = self.searchParams()
+            if error:
+                return error
+            options, error = self.searchOptions()
+            if error:
+                return error
+            try:
+                result = self.mongo.search(params,**options)
+            except ValueError as e:
+                return {"results":{"Error":str(e)}}
+            content = {"results": result}
+        elif self.action in Analytics.ACTIONS:
+            content = self.analytics()
+        elif self.action == "list_indexes":
+            content = {"results":{"success":True,"collection":collection,"indexes":self.mongo.list_indexes()}}
+        elif self.action == "create_index":
+            try:
+                keys = parseSort(self.request.get("keys"))
+            except (ValueError, TypeError) as e:
+                return {"results":{"Error":f"Bad keys: {e}"}}
+            if not keys:
+                return {"results":{"Error":"create_index needs 'keys', e.g. Symbol,-Date."}}
+            unique = str(self.request.get("unique")).lower() in ("1","true","yes")
+            try:
+                content = {"results":self.mongo.create_index(keys,unique)}
+            except Exception as e:
+                return {"results":{"Error":f"Couldn't create the index: {e}"}}
+        else:
+            content = {"result": f'Error: invalid action "{self.action}".'}
+
+        return content
+
+    def searchParams(self):
+        """ Pulls the mongo filter out of a search / searchkey request.
+            Returns (params, None) or (None, error content).
+        """
+        if self.action == "searchkey":
             key = self.request.get("key")
             value = self.request.get("value")
             if key == None or value == None:
-                return {"results":{"Error":"Searching mongo needs a key and value."}}
-            result = self.mongo.searchkey(key,value)
-            content = {"results": result}
-        elif self.action == "search":
-            params = self.request.get("params",None)
-            if params == None:
-                return {"results":{"Error":"Searching mongo needs a params object."}}
+                return None, {"results":{"Error":"Searching mongo needs a key and value."}}
+            return {key:value}, None
+
+        params = self.request.get("params",None)
+        if params == None:
+            return None, {"results":{"Error":"Searching mongo needs a params object."}}
+        if isinstance(params,str):
             params = json.loads(params)
-            result = self.mongo.search(params)
-            content = {"results": result}
+        return params, None
+
+    def analytics(self):
+        """ resample / rolling / returns / stats: fetches the bars matching params (or symbol)
+            between start and end and works the answer out on the server with numpy.
+        """
+        if Analytics.numpy is None:
+            return {"results":{"Error":f"{self.action} needs numpy on the server (pip install numpy)."}}
+        request = self.request
+        params = request.get("params") or {}
+        if isinstance(params,str):
+            params = json.loads(params)
+        if request.get("symbol"):
+            params = dict(params,Symbol=request["symbol"])
+        field = request.get("field") or "Close"
+        try:
+            dates = Analytics.date_filter(request.get("start"),request.get("end"))
+            window = int(request.get("window") if request.get("window") not in (None,"") else 20)
+            period = int(request.get("period") if request.get("period") not in (None,"") else 1)
+        except (ValueError, TypeError) as e:
+            return {"results":{"Error":f"Bad start, end, window or period: {e}"}}
+        every = request.get("every") or "M"
+        stat = request.get("stat") or "mean"
+        kind = request.get("kind") or "simple"
+        if every not in Analytics.PERIODS:
+            return {"results":{"Error":f"every has to be one of {', '.join(Analytics.PERIODS)}."}}
+        if stat not in Analytics.ROLLING:
+            return {"results":{"Error":f"stat has to be one of {', '.join(Analytics.ROLLING)}."}}
+        if kind not in ("simple","log"):
+            return {"results":{"Error":"kind has to be simple or log."}}
+        if window < 1 or period < 1:
+            return {"results":{"Error":"window and period have to be at least 1."}}
+
+        if dates:
+            params = {"$and":[params,dates]} if params else dates
+        fields = Analytics.BAR_FIELDS if self.action == "resample" else (field,)
+        docs = self.mongo.series(params,fields)
+        if not docs:
+            return {"results":{"success": False,"database":self.mongo.db_name,"collection":self.mongo.collection,"params":params}}
+        days, columns = Analytics.to_arrays(docs,fields)
+
+        if self.action == "stats":
+            return {"results":dict(success=True,field=field,**Analytics.stats(days,columns[field]))}
+        if self.action == "resample":
+            data = Analytics.resample(days,columns,every)
+        elif self.action == "rolling":
+            data = Analytics.rolling(days,columns[field],window,stat)
         else:
-            content = {"result": f'Error: invalid action "{action}".'}
+            data = Analytics.returns(days,columns[field],period,kind)
+        return {"results":{"success": True,"count":len(data),"bars":len(days),"data":data}}
 
-        return content
+    def searchOptions(self):
+        """ Pulls limit / sort / projection / after out of a search / searchkey request.
+            Returns (options, None) or (None, error content).
+        """
+        try:
+            limit = int(self.request.get("limit") or 0)
+            sort = parseSort(self.request.get("sort"))
+            projection = parseProjection(self.request.get("projection"))
+        except (ValueError, TypeError) as e:
+            return None, {"results":{"Error":f"Bad limit, sort or projection: {e}"}}
+        if limit < 0:
+            return None, {"results":{"Error":"limit can't be negative."}}
+        if self.request.get("format") not in (None, "", "rows", "columnar"):
+            return None, {"results":{"Error":"format has to be rows or columnar."}}
+        options = {"sort":sort,"projection":projection,"limit":limit,"after":self.request.get("after") or None}
+        return options, None
+
+    def streamRequest(self,batch_size=0):
+        """ Streaming version of processRequest for search and searchkey (request has "stream").
+            Returns an iterator over the matching rows, straight off the mongo cursor, so the
+            server can send them a chunk at a time. Anything that can't be streamed (errors,
+            other actions) comes back as the normal content dict instead.
+        """
+        collection = self.request.get("collection",None)
+        if self.action not in ("searchkey","search") or collection == None:
+            return self.processRequest()
+
+        params, error = self.searchParams()
+        if error:
+            return error
+        options, error = self.searchOptions()
+        if error:
+            return error
+        try:
+            # Build the cursor now so a bad token is reported before the stream starts
+            cursor, hidden = self.mongo.query(params,collection,batch_size=batch_size,**options)
+        except ValueError as e:
+            return {"results":{"Error":str(e)}}
+        return (self.mongo.cleanRow(row,hidden) for row in cursor)
+
+    def streamChunkRows(self):
+        """ Rows per streamed chunk: the request's "stream" value if it is a number, otherwise
+            config.stream_chunk_rows. Capped at config.stream_max_chunk_rows.
+        """
+        rows = self.request.get("stream")
+        if isinstance(rows,bool) or not str(rows).isdigit() or int(rows) < 2:
+            rows = config.stream_chunk_rows
+        return min(int(rows),config.stream_max_chunk_rows)
 
 
 """
@@ -139,8 +570,15 @@ class MongoHelper(object):
     """
     constructor
     """
-    def __init__(self,db,collection=None):
-        self.client = MongoClient('mongodb://localhost:27017')
+    def __init__(self,db,collection=None,client=None,cache=None,advisor=None,versions=None):
+        # Pass in a shared client (see MongoPool) so we don't build a new pool per request
+        if client is None:
+            from pymongo import MongoClient
+            client = MongoClient(config.mongo_uri)
+        self.client = client
+        self.cache = cache      # ResultCache to clear when we write to a collection
+        self.advisor = advisor  # IndexAdvisor told how long each query took
+        self.versions = versions  # ResultCache.Versions bumped when we write to a collection
         self.db_name = db
         self.db_conn = self.client[db]
         self.collection = collection
@@ -148,6 +586,19 @@ class MongoHelper(object):
     def setCollection(self,name):
         self.collection = name
 
+    def written(self):
+        """ After a write: cached answers and handed out tags for the collection are stale.
+        """
+        if self.cache is not None:
+            self.cache.invalidate(self.db_name,self.collection)
+        if self.versions is not None:
+            self.versions.bump(self.db_name,self.collection)
+
+    def read_only(self,collection=None):
+        """ True for a collection served from ColumnStore's files.
+        """
+        return getattr(self.db_conn[collection or self.collection],"read_only",False)
+
     def insert(self,data=None,collection=None):
         
         uid = None
@@ -160,6 +611,7 @@ class MongoHelper(object):
         mongodata["last_modified"] = datetime.datetime.utcnow()
 
         result = self.db_conn[self.collection].insert_one(mongodata)
+        self.written()
 
         uid = str(result.inserted_id)
         if uid != None:
@@ -181,88 +633,253 @@ class MongoHelper(object):
 
         return self.search(params)
 
-    def search(self,params,collection=None):
-        result_list = []
-
+    def query(self,params,collection=None,sort=None,projection=None,limit=0,after=None,batch_size=0):
+        """ Builds the cursor behind search / search_iter. Returns (cursor, hidden) where hidden
+            lists fields that were only fetched to build the continuation token.
+            batch_size is how many documents the cursor fetches per round trip (0 = mongo's default).
+        """
         if collection != None:
             self.collection = collection
 
-        try:
-            result = self.db_conn[self.collection].find(params)
-        except: 
-            response = {"success": False,"database":self.db_name,"collection":self.collection,"params":params}
-            
-        for row in result:
+        sort = self.pageSort(sort,limit,after)
+        hidden = []
+        if projection:
+            projection = dict(projection)
+            include = any(value for key, value in projection.items() if key != "_id")
+            for key, direction in sort or []:
+                if include and not projection.get(key) and key != "_id":
+                    projection[key] = 1
+                    hidden.append(key)
+                elif key in projection and not projection[key]:
+                    del projection[key]
+                    hidden.append(key)
+
+        if after:
+            values = decodeToken(after,sort)
+            # Rows that sort after the last one sent: first key past it, or equal and the
+            # second key past it, and so on
+            resume = []
+            for i, (key, direction) in enumerate(sort):
+                clause = {sort[j][0]:values[j] for j in range(i)}
+                clause[key] = {"$gt" if direction > 0 else "$lt": values[i]}
+                resume.append(clause)
+            params = {"$and":[params,{"$or":resume}]}
+
+        cursor = self.db_conn[self.collection].find(params,projection,batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor, hidden
+
+    def pageSort(self,sort,limit=0,after=None):
+        """ Paging needs a total order, so once there is a sort, limit or token, _id is added
+            to the sort (if it isn't there) to break ties.
+        """
+        if not (sort or limit or after):
+            return sort
+        sort = [tuple(key) for key in sort or []]
+        if "_id" not in [key for key, direction in sort]:
+            sort.append(("_id",1))
+        return sort
+
+    def cleanRow(self,row,hidden=()):
+        if '_id' in row:
             row['_id'] = str(row['_id'])
-            result_list.append(row)
+        if 'last_modified' in row and isinstance(row['last_modified'],datetime.datetime):
+            # Set by our writes, json can't encode a datetime
+            row['last_modified'] = row['last_modified'].isoformat()
+        for key in hidden:
+            row.pop(key,None)
+        return row
+
+    def search_iter(self,params,collection=None,batch_size=0,**options):
+        """ Yields matching documents one at a time as the mongo cursor hands them over.
+            Takes the same sort / projection / limit / after options as search.
+        """
+        started = time.perf_counter()
+        cursor, hidden = self.query(params,collection,batch_size=batch_size,**options)
+        for row in cursor:
+            yield self.cleanRow(row,hidden)
+        self.track(params,self.pageSort(options.get("sort"),options.get("limit"),options.get("after")),started)
+
+    def search(self,params,collection=None,sort=None,projection=None,limit=0,after=None):
+        """ Returns the matching documents. With a limit, one extra row is asked for to see
+            if there is another page, and if there is the response gets a "next" token.
+        """
+        started = time.perf_counter()
+        cursor, hidden = self.query(params,collection,sort,projection,limit + 1 if limit else 0,after)
+        sort = self.pageSort(sort,limit,after)
+
+        result_list = []
+        last = None
+        next_token = None
+        for row in cursor:
+            if limit and len(result_list) == limit:
+                next_token = encodeToken(sort,last)
+                break
+            if limit:
+                last = [row.get(key) for key, direction in sort]
+            result_list.append(self.cleanRow(row,hidden))
+        self.track(params,sort,started)
 
         if len(result_list) > 0:
             response = {"success": True,"count":len(result_list),"data":result_list,}
+            if next_token:
+                response["next"] = next_token
         else:
             response = {"success": False,"database":self.db_name,"collection":self.collection,"params":params}
 
         return response 
 
 
-    def delete(self,uid):
-        pass
-
-"""
- ______ ___   _   __ _____ 
- |  ___/ _ \ | | / /|  ___|
- | |_ / /_\ \| |/ / | |__  
- |  _||  _  ||    \ |  __| 
- | |  | | | || |\  \| |___ 
- \_|  \_| |_/\_| \_/\____/                      
-"""
-class FakeDataBase(object):
-    """
-    constructor
-    """
-    def __init__(self,request):
-        self.request = request
-        self.action = self.request["action"]
-
-        self.fakeDB = {
-            "morpheus": "Follow the white rabbit. \U0001f430",
-            "ring": "In the caves beneath the Misty Mountains. \U0001f48d",
-            "dogface": "\U0001f43e Playing ball! \U0001f3d0",
-            "gorilla":"\U0001F98D",
-            "dog":"\U0001F415",
-            "camel":"\U0001F42A",
-            "rhino":"\U0001F98F"
-        }
-
-    def processRequest(self):
-        if self.action == "search":
-            query = self.request.get("key")
-            answer = self.search(query)
-            content = {"result": answer}
-        elif action == "insert":
-            collection = self.request.get("collection")
-            data = self.request.get("data")
-            answer = self.insert(collection,data)
-            content = {"result": answer}
-        else:
-            content = {"result": f'Error: invalid action "{action}".'}
-
-    def search(self,key=None):
-        if not key:
-            logg("key = none")
-            return {"error":"key is none"}
-        if key in self.fakeDB:
-            value = self.fakeDB[key]
-            return {"response":value}
-        else:
-            return {"response":{"error":f"Key: {key} not found"}}
-
-    def insert(self,collection=None,data=None):
-
-        if not collection:
-            response = {"Error": "collection = None"}
-        elif not data:
-            response = {"Error": "data = None"}
+    def series(self,params,fields,collection=None):
+        """ The Date and `fields` of every matching document, oldest first, for Analytics.
+        """
+        if collection != None:
+            self.collection = collection
+        projection = {field:1 for field in fields}
+        projection.update(Date=1,_id=0)
+        started = time.perf_counter()
+        cursor = self.db_conn[self.collection].find(params,projection,batch_size=config.analytics_batch_size)
+        docs = list(cursor.sort("Date",1))
+        self.track(params,[("Date",1)],started)
+        return docs
+
+    def track(self,params,sort,started):
+        """ Tells the index advisor about a query that started at `started` (perf_counter).
+        """
+        if self.advisor is not None:
+            self.advisor.record(self.client,self.db_name,self.collection,params,sort,time.perf_counter() - started)
 
-        response = {"success": {"message": {"insert":f"inserting into {collection}","data":data}}}
+    def list_indexes(self,collection=None):
+        if collection != None:
+            self.collection = collection
+        indexes = []
+        for name, info in self.db_conn[self.collection].index_information().items():
+            index = {"name":name,"key":[list(key) for key in info["key"]]}
+            index.update((option,value) for option,value in info.items() if option not in ("key","v","ns"))
+            indexes.append(index)
+        return indexes
+
+    def create_index(self,keys,unique=False,collection=None):
+        if collection != None:
+            self.collection = collection
+        started = time.perf_counter()
+        name = self.db_conn[self.collection].create_index(keys,unique=unique,background=True)
+        return {"success":True,"name":name,"seconds":round(time.perf_counter() - started,3)}
 
+    def insert_many(self,documents,collection=None):
+        """ Inserts a list of documents. Anything that isn't a json object fails on its own.
+        """
+        now = datetime.datetime.utcnow()
+        operations = []
+        for document in documents:
+            if not isinstance(document,dict):
+                operations.append("Each document must be a json object.")
+                continue
+            document["last_modified"] = now
+            operations.append(Write("insert",document=document))
+        return self.bulk(operations,("inserted",),collection)
+
+    def update(self,updates,collection=None):
+        """ Runs a list of {"filter", "update", "many", "upsert"} updates.
+        """
+        operations = []
+        for item in updates:
+            if not isinstance(item,dict) or not isinstance(item.get("filter"),dict) or not isinstance(item.get("update"),dict):
+                operations.append('Each update needs a "filter" and an "update" object.')
+                continue
+            update = dict(item["update"])
+            if not any(key.startswith("$") for key in update):
+                update = {"$set":update}
+            update.setdefault("$currentDate",{"last_modified":True})
+            operations.append(Write("update",item["filter"],update,bool(item.get("many")),bool(item.get("upsert"))))
+        return self.bulk(operations,("matched","modified","upserted"),collection)
+
+    def delete(self,filters,collection=None):
+        """ Deletes every document matching each filter in a list.
+        """
+        operations = []
+        for item in filters:
+            if not isinstance(item,dict) or not item:
+                operations.append("Each delete needs a non empty filter object.")
+                continue
+            operations.append(Write("delete",item,many=True))
+        return self.bulk(operations,("deleted",),collection)
+
+    def bulk_write(self,ops):
+        """ Runs a list of MemoryStore.Write as one unordered bulk write and returns mongo's
+            result details (writeErrors included). The memory store takes the Writes as they
+            are, for mongo they become pymongo's InsertOne / UpdateOne / UpdateMany / DeleteMany.
+        """
+        collection = self.db_conn[self.collection]
+        if isinstance(collection,MemoryStore.MemoryCollection):
+            try:
+                return collection.bulk_write(ops,ordered=False).bulk_api_result
+            except MemoryStore.BulkWriteError as e:
+                return e.details
+
+        from pymongo import InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+        from pymongo.errors import BulkWriteError
+        requests = []
+        for op in ops:
+            if op.kind == "insert":
+                requests.append(InsertOne(op.document))
+            elif op.kind == "update":
+                requests.append((UpdateMany if op.many else UpdateOne)(op.filter,op.document,upsert=op.upsert))
+            else:
+                requests.append((DeleteMany if op.many else DeleteOne)(op.filter))
+        try:
+            return collection.bulk_write(requests,ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            return e.details
+
+    def bulk(self,operations,counts,collection=None):
+        """ Runs write operations as unordered bulk writes of config.bulk_batch_size, so one
+            failure doesn't stop the rest. A string in `operations` is an item that failed
+            validation (the string is why). Returns totals, per batch counts and the indexes
+            (positions in `operations`) that failed. `counts` picks which counts to report.
+        """
+        if collection != None:
+            self.collection = collection
 
+        names = {"inserted":"nInserted","matched":"nMatched","modified":"nModified","upserted":"nUpserted","deleted":"nRemoved"}
+        size = int(config.bulk_batch_size)
+        response = {"success": True,"requested":len(operations)}
+        response.update({name:0 for name in counts})
+        response["batches"] = []
+        response["failed"] = []
+
+        for number, start in enumerate(range(0,len(operations),size)):
+            batch = {"batch":number,"size":0}
+            batch.update({name:0 for name in counts})
+            batch["failed"] = []
+            indexes = []    # position in `operations` of each op sent to mongo
+            ops = []
+            for index in range(start,min(start + size,len(operations))):
+                operation = operations[index]
+                if isinstance(operation,str):
+                    batch["failed"].append(index)
+                    response["failed"].append({"index":index,"error":operation})
+                else:
+                    indexes.append(index)
+                    ops.append(operation)
+            batch["size"] = len(indexes) + len(batch["failed"])
+
+            if ops:
+                details = self.bulk_write(ops)
+                for error in details.get("writeErrors",[]):
+                    index = indexes[error["index"]]
+                    batch["failed"].append(index)
+                    response["failed"].append({"index":index,"error":error.get("errmsg")})
+                for name in counts:
+                    batch[name] = details.get(names[name],0)
+                    response[name] += batch[name]
+            batch["failed"].sort()
+            response["batches"].append(batch)
+
+        self.written()
+        response["failed"].sort(key=lambda failure: failure["index"])
+        response["success"] = not response["failed"]
+        return response
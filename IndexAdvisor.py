@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+IndexAdvisor.py
+Description:
+    Keeps track of which filters the server runs against each collection and how long they
+    take, so we can see which ones need an index. A query's "shape" is the fields it tests for
+    equality, the fields it sorts on and the fields it tests with ranges ($gt, $lt, $in, ...),
+    not the values. For every shape it keeps count / total / max latency and suggests an index
+    in the usual equality, sort, range order.
+
+    index_stats shows it, list_indexes / create_index manage the indexes by hand. With
+    config.index_auto on, a shape that has been run index_auto_min_count times at an average
+    of index_auto_min_ms or more gets its suggested index built on a background thread (once,
+    and only if no index already starts with those keys).
+
+    Each server process has its own advisor.
+"""
+import threading
+import time
+
+# Operators that make a field a range (or multi value) test rather than an equality
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte", "$ne", "$in", "$nin", "$regex", "$exists", "$not", "$all"}
+
+
+def query_shape(params, sort=None):
+    """ (equality fields, sort keys, range fields) for a mongo filter and sort. Fields inside
+        $or / $nor are left out, an index on them can't be suggested simply.
+    """
+    equality, ranges = set(), set()
+
+    def walk(clause):
+        if not isinstance(clause, dict):
+            return
+        for key, value in clause.items():
+            if key == "$and":
+                for part in value:
+                    walk(part)
+            elif key.startswith("$"):
+                continue
+            elif isinstance(value, dict) and any(op in RANGE_OPERATORS for op in value):
+                ranges.add(key)
+            else:
+                equality.add(key)
+
+    walk(params)
+    keys = tuple((key, direction) for key, direction in sort or [] if key != "_id")
+    sorted_fields = {key for key, direction in keys}
+    return (tuple(sorted(equality - sorted_fields)), keys, tuple(sorted(ranges - equality - sorted_fields)))
+
+
+def suggested_index(shape):
+    """ The index keys (list of (field, direction)) that would serve a shape.
+    """
+    equality, keys, ranges = shape
+    return [(field, 1) for field in equality] + list(keys) + [(field, 1) for field in ranges]
+
+
+def covers(index_keys, wanted):
+    """ True if an index whose keys start with `wanted` is already there.
+    """
+    return [tuple(key) for key in index_keys[:len(wanted)]] == [tuple(key) for key in wanted]
+
+
+class IndexAdvisor:
+    def __init__(self, auto=False, min_count=20, min_ms=50.0, max_shapes=1000):
+        self.auto = auto
+        self.min_count = min_count
+        self.min_ms = min_ms
+        self.max_shapes = max_shapes        # so odd one off filters can't grow it forever
+        self.lock = threading.Lock()
+        self.shapes = {}                    # (db, collection, shape) -> counters
+        self.building = set()               # (db, collection, shape) being built or tried
+        self.built = []                     # what auto mode made (or failed to), newest last
+        self.dropped = 0
+
+    def record(self, client, db, collection, params, sort, seconds):
+        """ Called after a query ran. `client` is the MongoClient to build indexes with.
+        """
+        shape = query_shape(params, sort)
+        if not any(shape):
+            return      # find({}) with no sort, nothing an index would help
+        key = (db, collection, shape)
+        ms = seconds * 1000
+        with self.lock:
+            entry = self.shapes.get(key)
+            if entry is None:
+                if len(self.shapes) >= self.max_shapes:
+                    self.dropped += 1
+                    return
+                entry = self.shapes[key] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+            entry["count"] += 1
+            entry["total_ms"] += ms
+            entry["max_ms"] = max(entry["max_ms"], ms)
+            hot = (self.auto and key not in self.building and entry["count"] >= self.min_count
+                   and entry["total_ms"] / entry["count"] >= self.min_ms)
+            if hot:
+                self.building.add(key)
+        if hot:
+            threading.Thread(target=self._build, args=(client, key), name="index-builder", daemon=True).start()
+
+    def _build(self, client, key):
+        db, collection, shape = key
+        keys = suggested_index(shape)
+        entry = {"db": db, "collection": collection, "keys": keys, "started": time.time()}
+        try:
+            existing = client[db][collection].index_information()
+            if any(covers(index["key"], keys) for index in existing.values()):
+                entry["result"] = "already indexed"
+            else:
+                entry["name"] = client[db][collection].create_index(keys, background=True)
+                entry["result"] = "built"
+        except Exception as e:
+            entry["result"] = f"failed: {e}"
+        entry["seconds"] = round(time.time() - entry["started"], 3)
+        with self.lock:
+            self.built.append(entry)
+            del self.built[:-50]
+
+    def collections(self, db):
+        with self.lock:
+            return sorted({key[1] for key in self.shapes if key[0] == db})
+
+    def stats(self, db, collection=None, indexes=None):
+        """ Shapes for a db (or one collection), slowest in total first. `indexes` is
+            {collection: [index keys, ...]} to mark which shapes already have an index.
+        """
+        with self.lock:
+            items = [(key, dict(entry)) for key, entry in self.shapes.items()
+                     if key[0] == db and (collection is None or key[1] == collection)]
+            built = [dict(entry) for entry in self.built if entry["db"] == db]
+            dropped = self.dropped
+        shapes = []
+        for (_, name, shape), entry in sorted(items, key=lambda item: -item[1]["total_ms"]):
+            suggestion = suggested_index(shape)
+            row = {
+                "collection": name,
+                "equality": list(shape[0]),
+                "sort": [list(key) for key in shape[1]],
+                "range": list(shape[2]),
+                "count": entry["count"],
+                "mean_ms": round(entry["total_ms"] / entry["count"], 3),
+                "max_ms": round(entry["max_ms"], 3),
+                "total_ms": round(entry["total_ms"], 3),
+                "suggested_index": [list(key) for key in suggestion],
+            }
+            if indexes is not None and name in indexes:
+                row["indexed"] = any(covers(keys, suggestion) for keys in indexes[name])
+            shapes.append(row)
+        return {"auto": self.auto, "shapes": shapes, "auto_built": built, "untracked": dropped}
@@ -0,0 +1,710 @@
+#!/usr/bin/env python3
+"""
+MemoryStore.py
+Description:
+    An in-process database for db=memory:// (memory://<name> picks the database name). It
+    looks like the part of pymongo that MongoHelper uses (client[db][collection], find with
+    sort / limit, insert_one, bulk_write, create_index, index_information), so Api, paging,
+    projections, bulk writes and analytics work the same on it as on mongo. Handy for hot
+    reference collections like info (no mongo hop) and for running the server and the
+    benchmarks on a machine without mongo.
+
+    Indexes: every collection has a unique _id index. create_index (or config.memory_auto_index,
+    which indexes a field the first time a filter tests it) adds one on the first key it is
+    given. An index keeps a hash of value -> ids for equality / $in tests and a sorted list,
+    rebuilt after writes when a range test needs it, for $gt / $gte / $lt / $lte. A query uses
+    the index that gives the fewest candidates and checks them against the whole filter,
+    anything it can't narrow down is a scan.
+
+    Filters: equality, $eq $ne $gt $gte $lt $lte $in $nin $exists $regex $not $all $size,
+    $and $or $nor, dotted paths and arrays (a test on an array field matches if any element
+    does). Values of different types (numbers, strings, dates) never compare as mongo does.
+    Updates: $set $unset $inc $setOnInsert $currentDate $push $addToSet $pull. Projections are
+    on top level fields.
+
+    Bulk writes are lists of Write tuples (MongoHelper turns the same tuples into pymongo
+    operations for mongo). pymongo isn't needed for any of this, and bson only for its ObjectId
+    when it is installed.
+
+    Everything is lost when the server stops (config.memory_load reloads jsonl files at
+    start) and, with workers=N, every server process has its own copy.
+"""
+import bisect
+import collections
+import datetime
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+import config
+
+try:
+    from bson import ObjectId
+except ImportError:
+    @functools.total_ordering
+    class ObjectId:
+        """ Enough of bson's ObjectId for new _ids: 12 bytes (seconds, random, counter), shown
+            as 24 hex digits. ObjectId(hex) or ObjectId(another) makes a copy.
+        """
+        _random = os.urandom(5)
+        _counter = int.from_bytes(os.urandom(3), "big")
+        _lock = threading.Lock()
+
+        def __init__(self, oid=None):
+            if oid is None:
+                with ObjectId._lock:
+                    ObjectId._counter = (ObjectId._counter + 1) % 0xFFFFFF
+                    counter = ObjectId._counter
+                oid = int(time.time()).to_bytes(4, "big") + ObjectId._random + counter.to_bytes(3, "big")
+            elif isinstance(oid, ObjectId):
+                oid = oid.binary
+            else:
+                oid = bytes.fromhex(oid)
+            if len(oid) != 12:
+                raise ValueError(f"{oid!r} is not a valid ObjectId.")
+            self.binary = oid
+
+        @property
+        def generation_time(self):
+            return datetime.datetime.fromtimestamp(int.from_bytes(self.binary[:4], "big"), datetime.timezone.utc)
+
+        def __str__(self):
+            return self.binary.hex()
+
+        def __repr__(self):
+            return f"ObjectId('{self}')"
+
+        def __eq__(self, other):
+            return isinstance(other, ObjectId) and self.binary == other.binary
+
+        def __lt__(self, other):
+            if not isinstance(other, ObjectId):
+                return NotImplemented
+            return self.binary < other.binary
+
+        def __hash__(self):
+            return hash(self.binary)
+
+
+# One write in a bulk_write. kind is "insert" (document), "update" (filter, document is the
+# update, many, upsert) or "delete" (filter, many).
+Write = collections.namedtuple("Write", "kind filter document many upsert", defaults=(None, None, False, False))
+
+
+class BulkWriteError(Exception):
+    """ Like pymongo's: .details has the counts and the writeErrors.
+    """
+    def __init__(self, details):
+        super().__init__("batch op errors occurred")
+        self.details = details
+
+_MISSING = object()
+
+# Mongo's order between types (null < numbers < strings < objects < arrays < ids < bools < dates)
+_RANKS = ((type(None), 1), (bool, 8), (int, 2), (float, 2), (str, 3), (dict, 4), (list, 5), (tuple, 5),
+          (bytes, 6), (ObjectId, 7), (datetime.datetime, 9))
+
+
+def _rank(value):
+    for kind, rank in _RANKS:
+        if isinstance(value, kind):
+            return rank
+    return 10
+
+
+def sort_key(value):
+    """ A key that orders any values the way mongo does (by type, then value).
+    """
+    rank = _rank(value)
+    if value is None or value is _MISSING:
+        return (1, 0)
+    if rank in (4, 5):
+        return (rank, json.dumps(value, sort_keys=True, default=str))
+    if rank == 10:
+        return (rank, str(value))
+    if rank == 9 and value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return (rank, value)
+
+
+def _equal(value, target):
+    if target is None:
+        return value is None or value is _MISSING
+    if isinstance(target, datetime.datetime):
+        # naive and tz aware times of the same instant are equal
+        return _rank(value) == 9 and sort_key(value) == sort_key(target)
+    return _rank(value) == _rank(target) and value == target
+
+
+def _lookup(document, path):
+    """ The values at a dotted path: the value itself and, for an array, its elements.
+        [_MISSING] if it isn't there.
+    """
+    values = [document]
+    for part in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = found
+    if not values:
+        return [_MISSING]
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _compare(op, value, target):
+    if value is _MISSING or _rank(value) != _rank(target):
+        return False
+    value, target = sort_key(value), sort_key(target)
+    try:
+        if op == "$gt":
+            return value > target
+        if op == "$gte":
+            return value >= target
+        if op == "$lt":
+            return value < target
+        return value <= target
+    except TypeError:
+        return False
+
+
+def _test(values, op, target):
+    """ One operator against the values found at a path.
+    """
+    if op == "$eq":
+        return any(_equal(value, target) for value in values)
+    if op == "$ne":
+        return not any(_equal(value, target) for value in values)
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        return any(_compare(op, value, target) for value in values)
+    if op == "$in":
+        return any(_equal(value, item) for value in values for item in target)
+    if op == "$nin":
+        return not any(_equal(value, item) for value in values for item in target)
+    if op == "$exists":
+        return (values != [_MISSING]) == bool(target)
+    if op == "$regex":
+        pattern = target if hasattr(target, "search") else re.compile(target)
+        return any(isinstance(value, str) and pattern.search(value) for value in values)
+    if op == "$all":
+        return all(any(_equal(value, item) for value in values) for item in target)
+    if op == "$size":
+        return isinstance(values[0], list) and len(values[0]) == target
+    if op == "$not":
+        return not _field(values, target)
+    raise ValueError(f"The memory store doesn't support {op}.")
+
+
+def _field(values, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        if "$regex" in condition and "$options" in condition:
+            flags = sum(getattr(re, flag.upper()) for flag in condition["$options"] if flag in "imsx")
+            condition = dict(condition, **{"$regex": re.compile(condition["$regex"], flags)})
+            del condition["$options"]
+        return all(_test(values, op, target) for op, target in condition.items())
+    if hasattr(condition, "search"):
+        return _test(values, "$regex", condition)
+    return _test(values, "$eq", condition)
+
+
+def matches(document, query):
+    """ True if a document passes a mongo filter.
+    """
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            if not all(matches(document, part) for part in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif key == "$nor":
+            if any(matches(document, part) for part in condition):
+                return False
+        elif key.startswith("$"):
+            raise ValueError(f"The memory store doesn't support {key}.")
+        elif not _field(_lookup(document, key), condition):
+            return False
+    return True
+
+
+def project(document, projection):
+    """ A copy of a document with a find() projection applied (top level fields).
+    """
+    if not projection:
+        return dict(document)
+    include = {key for key, value in projection.items() if value and key != "_id"}
+    if include:
+        row = {key: document[key] for key in include if key in document}
+        if projection.get("_id", 1) and "_id" in document:
+            row["_id"] = document["_id"]
+        return row
+    return {key: value for key, value in document.items() if projection.get(key, 1)}
+
+
+def _hashable(value):
+    if isinstance(value, (dict, list)):
+        return ("json", json.dumps(value, sort_keys=True, default=str))
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+def _keys(keys, direction=None):
+    """ [(field, direction)] from what create_index / sort take.
+    """
+    if isinstance(keys, str):
+        return [(keys, direction or 1)]
+    return [(key, 1) if isinstance(key, str) else (key[0], key[1]) for key in keys]
+
+
+class MemoryIndex:
+    """ An index on one field (the first key of what create_index was given).
+    """
+    def __init__(self, name, keys, unique=False):
+        self.name = name
+        self.keys = keys
+        self.field = keys[0][0]
+        self.unique = unique
+        self.hash = {}          # hashable value -> set of ids
+        self._sorted = None     # (sort keys, ids), None until a range query needs it
+
+    def _entries(self, document):
+        values = _lookup(document, self.field)
+        return {None if value is _MISSING else _hashable(value) for value in values}
+
+    def conflicts(self, document, _id):
+        """ True if inserting `document` would break a unique index.
+        """
+        if not self.unique:
+            return False
+        return any(self.hash.get(value, set()) - {_id} for value in self._entries(document))
+
+    def add(self, _id, document):
+        for value in self._entries(document):
+            self.hash.setdefault(value, set()).add(_id)
+        self._sorted = None
+
+    def remove(self, _id, document):
+        for value in self._entries(document):
+            ids = self.hash.get(value)
+            if ids is not None:
+                ids.discard(_id)
+                if not ids:
+                    del self.hash[value]
+        self._sorted = None
+
+    def equal(self, targets):
+        if len(targets) == 1:
+            return self.hash.get(_hashable(targets[0]), frozenset())
+        found = set()
+        for target in targets:
+            found |= self.hash.get(_hashable(target), set())
+        return found
+
+    def range(self, condition):
+        """ Ids with values in a $gt / $gte / $lt / $lte range as (sorted ids, low, high), so
+            the caller can see how many there are before copying them out.
+        """
+        if self._sorted is None:
+            pairs = sorted(((sort_key(value), _id) for value, ids in self.hash.items() for _id in ids),
+                           key=lambda pair: pair[0])
+            self._sorted = ([pair[0] for pair in pairs], [pair[1] for pair in pairs])
+        keys, ids = self._sorted
+        low, high = 0, len(keys)
+        for op, target in condition.items():
+            key = sort_key(target)
+            if op == "$gt":
+                low = max(low, bisect.bisect_right(keys, key))
+            elif op == "$gte":
+                low = max(low, bisect.bisect_left(keys, key))
+            elif op == "$lt":
+                high = min(high, bisect.bisect_left(keys, key))
+            elif op == "$lte":
+                high = min(high, bisect.bisect_right(keys, key))
+            # only the one type compares (mongo doesn't compare across types)
+            low = max(low, bisect.bisect_left(keys, (key[0],)))
+            high = min(high, bisect.bisect_left(keys, (key[0] + 1,)))
+        return ids, low, max(low, high)
+
+
+class InsertResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class BulkResult:
+    def __init__(self, details):
+        self.bulk_api_result = details
+
+
+class MemoryCursor:
+    """ What find() returns: sort() and limit() then iterate.
+    """
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sorting = []
+        self.count = 0
+
+    def sort(self, keys, direction=None):
+        self.sorting = _keys(keys, direction)
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def __iter__(self):
+        documents = self.collection._find(self.query)
+        for key, direction in reversed(self.sorting):
+            documents.sort(key=lambda document: sort_key(_lookup(document, key)[0]), reverse=direction < 0)
+        if self.count:
+            documents = documents[:self.count]
+        return iter([self.collection._project(document, self.projection) for document in documents])
+
+
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.RLock()
+        self.documents = {}         # _id -> document
+        self.indexes = {"_id_": MemoryIndex("_id_", [("_id", 1)], unique=True)}
+        self.scans = 0              # queries no index could narrow down
+        self.lookups = 0            # queries that used an index
+
+    def find(self, query=None, projection=None, batch_size=0, **kwargs):
+        return MemoryCursor(self, query or {}, projection)
+
+    def _candidates(self, query):
+        """ Ids that could match (None means every document), from the index test that
+            narrows things down the most.
+        """
+        best = None     # (how many, ids) or (how many, (sorted ids, low, high))
+        conditions = []
+        for key, condition in query.items():
+            if key == "$and":
+                for part in condition:
+                    conditions.extend(part.items())
+            elif not key.startswith("$"):
+                conditions.append((key, condition))
+        for key, condition in conditions:
+            if key.startswith("$"):
+                continue
+            index = self._index_for(key)
+            if index is None:
+                continue
+            if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+                ranges = {op: target for op, target in condition.items() if op in ("$gt", "$gte", "$lt", "$lte")}
+                if "$eq" in condition:
+                    found = index.equal([condition["$eq"]])
+                elif isinstance(condition.get("$in"), list):
+                    found = index.equal(condition["$in"])
+                elif ranges:
+                    ids, low, high = index.range(ranges)
+                    if best is None or high - low < best[0]:
+                        best = (high - low, (ids, low, high))
+                    continue
+                else:
+                    continue
+            elif isinstance(condition, (dict, list)) or hasattr(condition, "search"):
+                continue    # whole object / array equality, or a regex
+            else:
+                found = index.equal([condition])
+            if best is None or len(found) < best[0]:
+                best = (len(found), found)
+        if best is None:
+            return None
+        if isinstance(best[1], tuple):
+            ids, low, high = best[1]
+            return dict.fromkeys(ids[low:high])     # an array's id can be there more than once
+        return best[1]
+
+    def _index_for(self, field):
+        for index in self.indexes.values():
+            if index.field == field:
+                return index
+        if config.memory_auto_index and self.documents:
+            return self._build_index(f"{field}_1", [(field, 1)])
+        return None
+
+    def _find(self, query):
+        with self.lock:
+            ids = self._candidates(query)
+            if ids is None:
+                self.scans += 1
+                documents = self.documents.values()
+            else:
+                self.lookups += 1
+                documents = [self.documents[_id] for _id in ids if _id in self.documents]
+            return [document for document in documents if matches(document, query)]
+
+    def _project(self, document, projection):
+        return project(document, projection)
+
+    def insert_one(self, document):
+        with self.lock:
+            self._insert(document)
+        return InsertResult(document["_id"])
+
+    def insert_many(self, documents):
+        with self.lock:
+            for document in documents:
+                self._insert(document)
+
+    def _insert(self, document):
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        for index in self.indexes.values():
+            if index.conflicts(document, None):
+                raise ValueError(f"E11000 duplicate key error collection: {self.name} index: {index.name}")
+        stored = dict(document)
+        self.documents[_hashable(stored["_id"])] = stored
+        for index in self.indexes.values():
+            index.add(_hashable(stored["_id"]), stored)
+
+    def _replace(self, _id, old, new):
+        for index in self.indexes.values():
+            if index.conflicts(new, _id):
+                raise ValueError(f"E11000 duplicate key error collection: {self.name} index: {index.name}")
+        for index in self.indexes.values():
+            index.remove(_id, old)
+            index.add(_id, new)
+        self.documents[_id] = new
+
+    def _delete(self, _id):
+        document = self.documents.pop(_id)
+        for index in self.indexes.values():
+            index.remove(_id, document)
+
+    def delete_many(self, query):
+        with self.lock:
+            doomed = [_hashable(document["_id"]) for document in self._find(query)]
+            for _id in doomed:
+                self._delete(_id)
+        return len(doomed)
+
+    def _update(self, query, update, many, upsert):
+        """ (matched, modified, upserted id or None)
+        """
+        matched = modified = 0
+        targets = self._find(query)
+        if not many:
+            targets = targets[:1]
+        for document in targets:
+            matched += 1
+            new = _apply(dict(document), update, inserting=False)
+            if new != document:
+                self._replace(_hashable(document["_id"]), document, new)
+                modified += 1
+        if matched or not upsert:
+            return matched, modified, None
+        seed = {key: value for key, value in query.items()
+                if not key.startswith("$") and not isinstance(value, dict)}
+        document = _apply(seed, update, inserting=True)
+        self._insert(document)
+        return 0, 0, document["_id"]
+
+    def bulk_write(self, operations, ordered=True):
+        """ Runs a list of Write tuples. Errors are reported like mongo does (BulkWriteError
+            with writeErrors).
+        """
+        details = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nUpserted": 0, "nRemoved": 0,
+                   "upserted": [], "writeErrors": []}
+        with self.lock:
+            for index, operation in enumerate(operations):
+                kind = operation.kind
+                try:
+                    if kind == "insert":
+                        self._insert(operation.document)
+                        details["nInserted"] += 1
+                    elif kind == "update":
+                        matched, modified, upserted = self._update(operation.filter, operation.document,
+                                                                   operation.many, operation.upsert)
+                        details["nMatched"] += matched
+                        details["nModified"] += modified
+                        if upserted is not None:
+                            details["nUpserted"] += 1
+                            details["upserted"].append({"index": index, "_id": upserted})
+                    elif kind == "delete":
+                        doomed = [_hashable(document["_id"]) for document in self._find(operation.filter)]
+                        for _id in doomed if operation.many else doomed[:1]:
+                            self._delete(_id)
+                            details["nRemoved"] += 1
+                    else:
+                        raise ValueError(f"The memory store doesn't support {kind}.")
+                except (ValueError, TypeError) as e:
+                    details["writeErrors"].append({"index": index, "code": 11000 if "E11000" in str(e) else 2,
+                                                   "errmsg": str(e)})
+                    if ordered:
+                        break
+        if details["writeErrors"]:
+            raise BulkWriteError(details)
+        return BulkResult(details)
+
+    def create_index(self, keys, unique=False, name=None, **options):
+        keys = _keys(keys)
+        name = name or "_".join(f"{field}_{direction}" for field, direction in keys)
+        with self.lock:
+            if name not in self.indexes:
+                self._build_index(name, keys, unique)
+            elif self.indexes[name].unique != bool(unique):
+                raise ValueError(f"Index {name} already exists with different options.")
+        return name
+
+    def _build_index(self, name, keys, unique=False):
+        index = MemoryIndex(name, keys, unique)
+        for _id, document in self.documents.items():
+            if index.conflicts(document, _id):
+                raise ValueError(f"E11000 duplicate key error building index {name}")
+            index.add(_id, document)
+        self.indexes[name] = index
+        return index
+
+    def drop_index(self, name):
+        with self.lock:
+            if name == "_id_" or name not in self.indexes:
+                raise ValueError(f"Can't drop index {name}.")
+            del self.indexes[name]
+
+    def index_information(self):
+        with self.lock:
+            return {name: dict({"key": list(index.keys)}, **({"unique": True} if index.unique and name != "_id_" else {}))
+                    for name, index in self.indexes.items()}
+
+    def count_documents(self, query):
+        return len(self._find(query))
+
+    def distinct(self, key, query=None):
+        values = {}
+        for document in self._find(query or {}):
+            for value in _lookup(document, key):
+                if value is not _MISSING and not isinstance(value, list):
+                    values.setdefault(_hashable(value), value)
+        return list(values.values())
+
+    def stats(self):
+        with self.lock:
+            return {"documents": len(self.documents), "indexes": list(self.indexes),
+                    "index_lookups": self.lookups, "scans": self.scans}
+
+
+def _apply(document, update, inserting):
+    """ A copy of `document` with an update's operators applied.
+    """
+    for op, fields in update.items():
+        if not op.startswith("$"):
+            raise ValueError("The memory store only takes updates with $ operators.")
+        for path, value in fields.items():
+            parent, key = _parent(document, path)
+            if op == "$set" or (op == "$setOnInsert" and inserting):
+                parent[key] = value
+            elif op == "$unset":
+                parent.pop(key, None)
+            elif op == "$inc":
+                current = parent.get(key, 0)
+                if _rank(current) != 2 or _rank(value) != 2:
+                    raise ValueError(f"Can't $inc {path}, it isn't a number.")
+                parent[key] = current + value
+            elif op == "$currentDate":
+                parent[key] = datetime.datetime.utcnow()
+            elif op in ("$push", "$addToSet", "$pull"):
+                current = parent.get(key, [])
+                if not isinstance(current, list):
+                    raise ValueError(f"Can't {op} to {path}, it isn't an array.")
+                if op == "$pull":
+                    parent[key] = [item for item in current if not _field([item], value)]
+                else:
+                    items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                    current = list(current)
+                    for item in items:
+                        if op == "$push" or not any(_equal(existing, item) for existing in current):
+                            current.append(item)
+                    parent[key] = current
+            elif op != "$setOnInsert":
+                raise ValueError(f"The memory store doesn't support {op}.")
+    return document
+
+
+def _parent(document, path):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        child = document.get(part)
+        child = dict(child) if isinstance(child, dict) else {}
+        document[part] = child
+        document = child
+    return document, parts[-1]
+
+
+class MemoryDatabase:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.collections = {}
+
+    def __getitem__(self, name):
+        with self.lock:
+            collection = self.collections.get(name)
+            if collection is None:
+                collection = self.collections[name] = MemoryCollection(name)
+            return collection
+
+    def list_collection_names(self):
+        with self.lock:
+            return list(self.collections)
+
+
+class MemoryClient:
+    """ Stands in for MongoClient: client[db][collection].
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.databases = {}
+
+    def __getitem__(self, name):
+        with self.lock:
+            database = self.databases.get(name)
+            if database is None:
+                database = self.databases[name] = MemoryDatabase(name)
+            return database
+
+    def close(self):
+        pass
+
+
+class MemoryPool:
+    """ Stands in for MongoPool. poolstats shows the collections instead of connection counters.
+    """
+    def __init__(self, db):
+        self.client = MemoryClient()
+        self.db = db
+        self.counters = self
+
+    def load(self, files):
+        """ Loads {collection: jsonl path} (config.memory_load) into the database.
+        """
+        for name, path in files.items():
+            collection = self.client[self.db][name]
+            with open(path) as f:
+                collection.insert_many(json.loads(line) for line in f if line.strip())
+
+    def snapshot(self):
+        database = self.client[self.db]
+        return {"backend": "memory", "database": self.db,
+                "collections": {name: database[name].stats() for name in database.list_collection_names()}}
+
+    def close(self):
+        self.client.close()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import config
 import sys
+import collections
+import asyncio
 import selectors
 import json
 import io
@@ -8,9 +10,18 @@ import struct
 import socket
 import traceback
 import time
-import traceback
+import itertools
+import threading
+import concurrent.futures
 
+import Protocol
 from DbHelpers import Api
+from Codecs import CODECS, get_codec
+from Codecs import COMPRESSORS, compress_body, decompress_body, pick_compressor
+
+# sendmsg lets us hand the kernel several buffers in one call (not on Windows)
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+SENDMSG_MAX_SEGMENTS = 64
 
 """
  ___  ___                               
@@ -32,9 +43,21 @@ class Message:
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        # Receive side: one growable bytearray. Unread data lives between _recv_start and
+        # _recv_end, so consuming a frame just moves _recv_start (no slicing / copying).
+        self._recv_chunk = int(config.recv_chunk_size)
+        self._recv_buffer = bytearray(self._recv_chunk)
+        self._recv_start = 0
+        self._recv_end = 0
+        # Send side: queue of memoryviews, written with sendmsg without joining them first.
+        self._send_queue = collections.deque()
+        self._send_pending = 0
+        # Running byte totals, so a caller can tell when something it queued has gone out
+        self._queued_total = 0
+        self._sent_total = 0
         self._jsonheader_len = None
+        self._frame = None          # v2 header fields of the frame being read, None for v1
+        self._header_size = 2
         self.jsonheader = None
 
     def _set_selector_events_mask(self, mode):
@@ -50,51 +73,161 @@ class Message:
         self.selector.modify(self.sock, events, data=self)
 
     def _read(self):
+        self._recv_reserve(self._recv_chunk)
+        view = memoryview(self._recv_buffer)[self._recv_end:]
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            nbytes = self.sock.recv_into(view, self._recv_chunk)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
+            if nbytes:
+                self._recv_end += nbytes
+            elif self.idle():
+                # Peer hung up between frames, which is how a keep-alive connection ends.
+                self.close()
             else:
                 raise RuntimeError("Peer closed.")
+        finally:
+            view.release()
+
+    def _recv_available(self):
+        return self._recv_end - self._recv_start
+
+    def _recv_reserve(self, size):
+        """ Makes sure `size` bytes fit after the unread data. Slides the unread bytes to the
+            front first and only grows the buffer (doubling) if that isn't enough.
+        """
+        if len(self._recv_buffer) - self._recv_end >= size:
+            return
+        unread = self._recv_available()
+        if self._recv_start:
+            view = memoryview(self._recv_buffer)
+            view[:unread] = view[self._recv_start:self._recv_end]
+            view.release()
+            self._recv_start, self._recv_end = 0, unread
+        if len(self._recv_buffer) - unread < size:
+            grow = max(len(self._recv_buffer), unread + size - len(self._recv_buffer))
+            self._recv_buffer.extend(bytes(grow))
+
+    def _recv_take(self, size):
+        """ Returns the next `size` unread bytes as a memoryview and marks them read. Release
+            the view (or use it in a `with`) before the next read, or the buffer can't grow.
+        """
+        start = self._recv_start
+        self._recv_start += size
+        view = memoryview(self._recv_buffer)[start:self._recv_start]
+        if self._recv_start == self._recv_end:
+            # Everything has been read, start over at the front
+            self._recv_start = self._recv_end = 0
+            if len(self._recv_buffer) > 4 * self._recv_chunk:
+                # Let a big one-off frame's memory go (the view keeps the old buffer alive)
+                self._recv_buffer = bytearray(self._recv_chunk)
+        return view
+
+    def _queue_send(self, data):
+        """ Adds bytes (or a list of byte segments) to the send queue without copying them.
+        """
+        if isinstance(data, (list, tuple)):
+            for segment in data:
+                self._queue_send(segment)
+        elif data:
+            self._send_queue.append(memoryview(data))
+            self._send_pending += len(data)
+            self._queued_total += len(data)
 
     def _write(self):
-        if self._send_buffer:
+        if self._send_queue:
             if config.debug:
-                print("sending", repr(self._send_buffer), "to", self.addr)
+                print("sending", self._send_pending, "bytes to", self.addr)
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                if HAVE_SENDMSG:
+                    sent = self.sock.sendmsg(itertools.islice(self._send_queue, SENDMSG_MAX_SEGMENTS))
+                else:
+                    sent = self.sock.send(self._send_queue[0])
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
             else:
-                self._send_buffer = self._send_buffer[sent:]
+                self._send_pending -= sent
+                self._sent_total += sent
+                # Drop the segments that went out completely, trim the one that didn't
+                while sent:
+                    segment = self._send_queue[0]
+                    if sent >= len(segment):
+                        sent -= len(segment)
+                        self._send_queue.popleft()
+                    else:
+                        self._send_queue[0] = segment[sent:]
+                        sent = 0
 
     def _json_encode(self, obj, encoding):
         return json.dumps(obj, ensure_ascii=False).encode(encoding)
 
     def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(io.BytesIO(json_bytes), encoding=encoding, newline="")
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+        # str() decodes straight out of a memoryview, no intermediate bytes copy
+        return json.loads(str(json_bytes, encoding))
 
-    def _create_message(self, *, content_bytes, content_type, content_encoding):
+    def _create_message(self, **kwargs):
+        return b"".join(self._create_frame(**kwargs))
+
+    def _create_frame(self, *, content_bytes, content_type, content_encoding, request_id=None, stream=None,
+                      content_compression=None, accept_compression=None, etag=None, if_none_match=None,
+                      not_modified=False, protocol=1, accept_protocol=None):
+        """ Builds a frame as [protoheader + json header, content] so a big body can be queued
+            for sending without being copied into one new bytes object. `stream` ("chunk" or
+            "end") marks the frames of a streamed response. `content_compression` names what
+            the body was compressed with (see ServerMessage.encode_result), `accept_compression`
+            is the list of compressors we can take in return. `etag` is the version of an
+            answer, a request carries the one it has in `if_none_match`, and `not_modified`
+            says the answer is the one the client already has (see ResultCache.Versions).
+            `protocol` 2 packs all that into a fixed binary header instead of json, and a v1
+            frame can offer v2 with `accept_protocol` (see Protocol.py).
+        """
+        if protocol >= 2:
+            return [
+                Protocol.pack(len(content_bytes), content_type, content_encoding, request_id, stream,
+                              content_compression, accept_compression, etag, if_none_match, not_modified),
+                content_bytes,
+            ]
         jsonheader = {
             "byteorder": sys.byteorder,
             "content-type": content_type,
             "content-encoding": content_encoding,
             "content-length": len(content_bytes),
         }
+        # Optional: lets a keep-alive client match pipelined responses to its requests.
+        if request_id is not None:
+            jsonheader["request-id"] = request_id
+        if stream is not None:
+            jsonheader["stream"] = stream
+        if content_compression is not None:
+            jsonheader["content-compression"] = content_compression
+        if accept_compression:
+            jsonheader["accept-compression"] = accept_compression
+        if etag is not None:
+            jsonheader["etag"] = etag
+        if if_none_match is not None:
+            jsonheader["if-none-match"] = if_none_match
+        if not_modified:
+            jsonheader["not-modified"] = True
+        if accept_protocol is not None:
+            jsonheader["accept-protocol"] = accept_protocol
         jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
         message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+        return [message_hdr + jsonheader_bytes, content_bytes]
+
+    def refusal(self, error):
+        """ A whole json error frame (as bytes) for a connection we won't take on, sent
+            before hanging up (see config.max_connections).
+        """
+        return self._create_message(
+            content_bytes=self._json_encode({"results":{"Error":error}}, "utf-8"),
+            content_type="text/json",
+            content_encoding="utf-8",
+        )
 
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
@@ -104,21 +237,49 @@ class Message:
 
     def read(self):
         self._read()
+        self.process_frames()
+
+    def process_frames(self):
+        """ Parses every complete frame sitting in the receive buffer. A keep-alive connection
+            can carry many frames back to back (pipelining), so after each frame the header
+            state is reset and parsing starts over on whatever bytes are left.
+        """
+        while self.sock is not None:
+            if self._jsonheader_len is None:
+                self.process_protoheader()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()
 
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
+            if self.jsonheader is None or not self.spec_read():
+                break
 
-        self.spec_read()
+            self.reset_frame()
+
+    def reset_frame(self):
+        """ Forget the header of the frame we just finished so the next one can be parsed.
+            Children extend this to clear their own per-frame state.
+        """
+        self._jsonheader_len = None
+        self._frame = None
+        self.jsonheader = None
+
+    def idle(self):
+        """ True when nothing is half read or half written on this connection.
+        """
+        return (
+            self._jsonheader_len is None
+            and not self._recv_available()
+            and not self._send_queue
+        )
 
     def spec_read(self):
         """ Specific Read: This is an abstract method that each client and server much
-            implement, since they do slightly different things for each read. 
+            implement, since they do slightly different things for each read. It should
+            return True once a whole frame body has been consumed.
         """
-        pass
+        return False
 
     def write(self):
         """ Each client and server do different things for a write(), so this again
@@ -148,44 +309,99 @@ class Message:
             self.sock = None
 
     def process_protoheader(self):
+        """ A v1 frame starts with the length of its json header, a v2 frame with the fixed
+            Protocol.HEADER (told apart by its magic). For v2 _jsonheader_len is the length of
+            the extra header, which is usually 0.
+        """
         hdrlen = 2
-        if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(">H", self._recv_buffer[:hdrlen])[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+        if self._recv_available() >= hdrlen:
+            start = self._recv_start
+            if self._recv_buffer[start:start + hdrlen] == Protocol.MAGIC:
+                hdrlen = Protocol.HEADER.size
+                if self._recv_available() < hdrlen:
+                    return
+                self._frame = Protocol.HEADER.unpack_from(self._recv_buffer, start)
+                self._jsonheader_len = self._frame[6]
+            else:
+                self._jsonheader_len = struct.unpack_from(">H", self._recv_buffer, start)[0]
+            self._header_size = hdrlen
+            self._recv_start += hdrlen
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
-        if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(self._recv_buffer[:hdrlen], "utf-8")
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for reqhdr in (
-                "byteorder",
-                "content-length",
-                "content-type",
-                "content-encoding",
-            ):
-                if reqhdr not in self.jsonheader:
-                    raise ValueError(f'Missing required header "{reqhdr}".')
+        if self._recv_available() >= hdrlen:
+            with self._recv_take(hdrlen) as data:
+                if self._frame is None:
+                    self.jsonheader = self._json_decode(data, "utf-8")
+                else:
+                    self.jsonheader = Protocol.unpack(self._frame, data)
+            self.check_jsonheader(self.jsonheader)
+            # Make room for the whole body (plus one more recv) now, instead of growing chunk
+            # by chunk or sliding a half-received body around
+            self._recv_reserve(
+                self.jsonheader["content-length"] - self._recv_available() + self._recv_chunk
+            )
+
+    async def read_header(self, reader):
+        """ process_protoheader + process_jsonheader for the asyncio server and client: reads
+            a frame's header (v1 or v2) off an asyncio StreamReader. Returns (jsonheader, bytes
+            read) or None if the peer hung up cleanly between frames.
+        """
+        try:
+            protoheader = await reader.readexactly(2)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise RuntimeError("Peer closed.")
+            return None
+        if protoheader == Protocol.MAGIC:
+            fields = Protocol.HEADER.unpack(protoheader + await reader.readexactly(Protocol.HEADER.size - 2))
+            extra = await reader.readexactly(fields[6]) if fields[6] else b""
+            jsonheader = Protocol.unpack(fields, extra)
+            size = Protocol.HEADER.size + fields[6]
+        else:
+            jsonheader_len = struct.unpack(">H", protoheader)[0]
+            jsonheader = self._json_decode(await reader.readexactly(jsonheader_len), "utf-8")
+            size = 2 + jsonheader_len
+        self.check_jsonheader(jsonheader)
+        return jsonheader, size
+
+    def check_jsonheader(self, jsonheader):
+        for reqhdr in (
+            "byteorder",
+            "content-length",
+            "content-type",
+            "content-encoding",
+        ):
+            if reqhdr not in jsonheader:
+                raise ValueError(f'Missing required header "{reqhdr}".')
+
+    def decode_content(self, data, jsonheader, limit=None):
+        """ Turns a frame body back into python with the codec for its content-type (see
+            Codecs.py), raw bytes if it isn't one we know. A compressed body that unpacks to
+            more than `limit` bytes raises ValueError.
+        """
+        if jsonheader.get("content-compression"):
+            data = decompress_body(data, jsonheader["content-compression"], limit)
+        codec = CODECS.get(jsonheader["content-type"])
+        if codec is not None:
+            return codec.decode(data, jsonheader["content-encoding"])
+        # Binary or unknown content-type (copied out, data may be a view of our buffer)
+        return bytes(data)
 
     def process_server_request(self):
         content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
-            return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.request = self._json_decode(data, encoding)
+        if not self._recv_available() >= content_len:
+            return False
+        with self._recv_take(content_len) as data:
+            self.request = self.decode_content(data, self.jsonheader)
+        if self.jsonheader["content-type"] in CODECS:
             print("received request", repr(self.request), "from", self.addr)
         else:
-            # Binary or unknown content-type
-            self.request = data
             print(
                 f'received {self.jsonheader["content-type"]} request from',
                 self.addr,
             )
-        # Set selector to listen for write events, we're done reading.
-        self._set_selector_events_mask("w")
+        return True
 
 
 
@@ -199,68 +415,505 @@ class Message:
                                                              __/ |     
                                                             |___/      
 """
+class ResponseSlot:
+    """ One request's place in the line of responses on a connection. Holds frames that are
+        ready but can't go out yet (an earlier request isn't finished) and whether any more
+        are coming. A streamed response has many frames; its `window` semaphore limits how
+        many of them can be queued but not yet sent.
+    """
+    def __init__(self, window=None, timer=None, capture=None):
+        self.frames = collections.deque()
+        self.done = False
+        self.window = window
+        self.cancelled = False
+        self.timer = timer      # Metrics.RequestTimer, None when the server keeps no metrics
+        self.capture = capture  # Profiler.Capture, None unless the request is being profiled
+
+    def watched(self):
+        return self.timer is not None or self.capture is not None
+
+    def failed(self):
+        if self.timer is not None:
+            self.timer.error = True
+        if self.capture is not None:
+            self.capture.error = True
+
+    def sent(self):
+        """ The last byte of the response has gone out.
+        """
+        if self.timer is not None:
+            self.timer.sent()
+        if self.capture is not None:
+            self.capture.sent()
+
+
 class ServerMessage(Message):
     """ServerMessage:
     Extends: Message
     Description: Adds necessary server message functionality. In our case, packaging a response
                  and interacting with mongo db. 
     """
-    def __init__(self, selector, sock, addr,db=None):
+    def __init__(self, selector, sock, addr,db=None,pool=None,workers=None,cache=None,batch=None,advisor=None,metrics=None,
+                 profiler=None,versions=None):
         super().__init__(selector, sock, addr)  # call parent constructor
         self.db = db    
+        self.pool = pool        # server wide MongoPool (see ServerClass.Server)
+        self.workers = workers  # server wide WorkerPool, None means answer inline
+        self.cache = cache      # server wide ResultCache, None means no caching
+        self.batch = batch      # executor for the items of a batch request, None runs them in turn
+        self.advisor = advisor  # server wide IndexAdvisor, None means queries aren't tracked
+        self.metrics = metrics  # server wide Metrics, None means nothing is counted
+        self.profiler = profiler  # server wide Profiler, None means action=profile isn't available
+        self.versions = versions  # server wide ResultCache.Versions, None means answers aren't tagged
         self.request = None
-        self.response_created = False
+        # One ResponseSlot per request still being worked on, oldest first. Responses are
+        # sent in this order even if the workers finish them out of order.
+        self.outstanding = collections.deque()
+        # (byte total, callback) pairs: callback runs once the send queue has got that far
+        self._send_marks = collections.deque()
+        # Backpressure: while a client has too much waiting on it (see backed_up) we stop
+        # reading its requests, and TCP makes it slow down instead of our memory filling up
+        self.paused = False
+        self._events = "r"      # what the selector watches this socket for, "" = not registered
+        self._in_frames = False
 
     def write(self):
-        if self.request:
-            if not self.response_created:
-                self.create_response()
+        before = self._sent_total
         self._write()
-    
+        if self.metrics is not None and self._sent_total != before:
+            self.metrics.sent(self._sent_total - before)
+        while self._send_marks and self._send_marks[0][0] <= self._sent_total:
+            self._send_marks.popleft()[1]()
+        # Once everything has gone out, go back to just listening for the next request
+        self._update_events()
+
+    def backed_up(self):
+        """ True while more than config.send_high_water bytes of responses are waiting to be
+            sent (until it's down to config.send_low_water) or config.max_in_flight requests
+            are being worked on.
+        """
+        if config.max_in_flight and len(self.outstanding) >= config.max_in_flight:
+            return True
+        if not config.send_high_water:
+            return False
+        return self._send_pending > (config.send_low_water if self.paused else config.send_high_water)
+
+    def _update_events(self):
+        self._set_selector_events_mask("rw" if self._send_queue else "r")
+
+    def _set_selector_events_mask(self, mode):
+        """ Message's version, but reading is left out while the connection is backed up. If
+            there is nothing to send either, the socket is taken out of the selector until a
+            response is ready. The selector is only touched when something changed.
+        """
+        paused = self.backed_up()
+        resumed = self.paused and not paused
+        if paused and not self.paused and self.metrics is not None:
+            self.metrics.paused()
+        self.paused = paused
+        if paused:
+            mode = mode.replace("r", "")
+        if mode != self._events:
+            if not mode:
+                self.selector.unregister(self.sock)
+            elif not self._events:
+                events = (selectors.EVENT_READ if "r" in mode else 0) | (selectors.EVENT_WRITE if "w" in mode else 0)
+                self.selector.register(self.sock, events, data=self)
+            else:
+                super()._set_selector_events_mask(mode)
+            self._events = mode
+        if resumed and self._recv_available() and not self._in_frames:
+            # Requests that came in before we paused are already in the buffer. We can be in
+            # the middle of the worker pool's drain here, so a bad frame only closes this one.
+            try:
+                self.process_frames()
+            except Exception:
+                print("main: error: exception for", f"{self.addr}:\n{traceback.format_exc()}")
+                self.close()
+
+    def process_frames(self):
+        self._in_frames = True
+        try:
+            super().process_frames()
+        finally:
+            self._in_frames = False
+
+    def check_jsonheader(self, jsonheader):
+        super().check_jsonheader(jsonheader)
+        limit = config.max_request_bytes
+        if limit and jsonheader["content-length"] > limit:
+            raise ValueError(f"Request of {jsonheader['content-length']} bytes is over the {limit} byte limit.")
+
+    def decode_content(self, data, jsonheader, limit=None):
+        # content-length only limits the compressed size, this limits what it unpacks to
+        return super().decode_content(data, jsonheader, limit or config.max_request_bytes or None)
+
     def spec_read(self):
-        if self.jsonheader:
-            if self.request is None:
-                self.process_request()
+        if self.paused:
+            # Leave it in the buffer until the client has caught up
+            return False
+        if not self.process_request():
+            return False
+        self.dispatch_request()
+        return True
+
+    def reset_frame(self):
+        super().reset_frame()
+        self.request = None
+
+    def idle(self):
+        return super().idle() and not self.outstanding
+
+    def close(self):
+        # Wake up any worker still producing a stream for us so it can give up
+        for slot in self.outstanding:
+            slot.cancelled = True
+            if slot.window is not None:
+                slot.window.release(config.stream_window)
+        if self.metrics is not None and self.sock is not None:
+            self.metrics.connection_closed()
+        if self.sock is not None and not self._events and self.selector is not None:
+            # Not watched while it was backed up, put it back so Message.close can take it out
+            self.selector.register(self.sock, selectors.EVENT_READ, data=self)
+        super().close()
 
     def process_request(self):
-        self.process_server_request()
+        return self.process_server_request()
+
+    def wants_stream(self, request, jsonheader):
+        """ True if the client asked for its results to be streamed (request has "stream").
+        """
+        if jsonheader["content-type"] not in CODECS or not isinstance(request, dict):
+            return False
+        if request.get("format") == "columnar":
+            # Columns come in one frame, there are no rows to hand out a chunk at a time
+            return False
+        return request.get("stream") not in (None, False, 0, "", "0", "false", "False")
 
-    def query_api(self):
+    def dispatch_request(self):
+        """ Hands the request to the worker pool so the selector loop never waits on mongo.
+            The request and header are captured here because reset_frame() clears them
+            before the worker gets to run.
+        """
+        request, jsonheader = self.request, self.jsonheader
+        timer = capture = None
+        if self.metrics is not None:
+            self.metrics.received(self._header_size + self._jsonheader_len + jsonheader["content-length"])
+            timer = self.metrics.timer(request)
+        if self.profiler is not None:
+            capture = self.profiler.capture(request)
+        if self.wants_stream(request, jsonheader):
+            return self.dispatch_stream(request, jsonheader, timer, capture)
+
+        slot = ResponseSlot(timer=timer, capture=capture)
+        self.outstanding.append(slot)
+
+        def finished(message, error):
+            if error is not None:
+                result = {"results":{"Error":f"Server error: {error!r}"}}
+                message = self.create_response(result, request, jsonheader)
+                slot.failed()
+            self.finish_response(slot, message)
+
+        if self.workers is None:
+            finished(self.answer(request, jsonheader, timer, capture), None)
+        elif not self.workers.submit(lambda: self.answer(request, jsonheader, timer, capture), finished, self):
+            result = {"results":{"Error":"Server busy, try again later."}}
+            slot.failed()
+            finished(self.create_response(result, request, jsonheader), None)
+        if self.sock is not None:
+            self._update_events()
+
+    def dispatch_stream(self, request, jsonheader, timer=None, capture=None):
+        """ Like dispatch_request, but the worker hands over each chunk frame as soon as it is
+            encoded. Once config.stream_window frames are waiting to be sent the worker stops
+            pulling rows off the cursor until the client catches up, so a big result never
+            sits in server memory all at once.
+        """
+        slot = ResponseSlot(threading.Semaphore(config.stream_window), timer, capture)
+        self.outstanding.append(slot)
+
+        def finished(result, error):
+            if error is not None:
+                slot.failed()
+                slot.frames.append(self.stream_error(f"Server error: {error!r}", request, jsonheader))
+            self.finish_response(slot)
+
+        if self.workers is None:
+            for frame in self.stream_frames(request, jsonheader):
+                slot.frames.append(frame)
+            finished(None, None)
+            return
+
+        def produce():
+            frames = self.stream_frames(request, jsonheader)
+            try:
+                for frame in frames:
+                    if not slot.window.acquire(timeout=config.request_timeout):
+                        # Client stopped reading, don't hold the cursor open forever
+                        frame = self.stream_error("Stream timed out waiting for the client.", request, jsonheader)
+                        slot.failed()
+                        self.workers.post(lambda result, error: self.stream_frame(slot, frame), owner=self)
+                        return
+                    if slot.cancelled:
+                        return
+                    self.workers.post(lambda result, error, frame=frame: self.stream_frame(slot, frame), owner=self)
+            finally:
+                frames.close()
+
+        if not self.workers.submit(produce, finished, self):
+            slot.failed()
+            slot.frames.append(self.stream_error("Server busy, try again later.", request, jsonheader))
+            self.finish_response(slot)
+        if self.sock is not None:
+            self._update_events()
+
+    def stream_frame(self, slot, frame):
+        """ Runs on the loop thread for every frame of a streamed response.
+        """
+        if self.sock is None:
+            return
+        slot.frames.append(frame)
+        self.flush_responses()
+
+    def finish_response(self, slot, message=None):
+        """ Runs on the loop thread once a response is ready (or a stream has sent its last
+            frame). Moves every finished response at the front of the line into the send buffer.
+        """
+        if self.sock is None:
+            # Client went away while we were working on it
+            return
+        if message is not None:
+            slot.frames.append(message)
+        slot.done = True
+        self.flush_responses()
+
+    def flush_responses(self):
+        """ Queues every frame that is allowed to go out: all of the oldest request's frames,
+            and the next request's as soon as the oldest one is done.
+        """
+        while self.outstanding:
+            slot = self.outstanding[0]
+            while slot.frames:
+                self._queue_send(slot.frames.popleft())
+                if slot.window is not None:
+                    # Give the worker its window back once this frame has actually been sent
+                    self._send_marks.append((self._queued_total, slot.window.release))
+            if not slot.done:
+                break
+            self.outstanding.popleft()
+            if slot.watched():
+                # the request is over once its last byte has been sent
+                if self._queued_total <= self._sent_total:
+                    slot.sent()
+                else:
+                    self._send_marks.append((self._queued_total, slot.sent))
+        self._update_events()
+
+    def answer(self, request, jsonheader, timer=None, capture=None):
+        """ Runs the request and returns its response frame, straight from the result cache
+            when the same search was answered recently. Runs on a worker thread. `timer`
+            (Metrics.RequestTimer) gets the queue / db / encode phases, and so does `capture`
+            (Profiler.Capture), which also profiles this part if the request was sampled.
+        """
+        if timer is not None:
+            timer.phase("queue")
+        if capture is None:
+            return self._answer(request, jsonheader, timer)
+        capture.begin()
+        try:
+            return self._answer(request, jsonheader, timer, capture)
+        finally:
+            capture.end()
+
+    def _answer(self, request, jsonheader, timer, capture=None):
+        tag = None
+        if self.versions is not None:
+            tag = self.versions.tag(self.db, request, jsonheader["content-type"])
+            if self.versions.matched(tag, jsonheader):
+                # The client has this answer already: no query, no encoding, a few bytes back
+                if timer is not None:
+                    timer.cached = True
+                return self._create_frame(**self.encode_result({"results":{"not_modified":True}}, None, jsonheader),
+                                          **self.reply_to(jsonheader), etag=tag, not_modified=True)
+        key = None
+        if self.cache is not None:
+            compressor = pick_compressor(jsonheader.get("accept-compression"))
+            key = self.cache.key(self.db, request, jsonheader["content-type"], compressor and compressor.name)
+        if key is not None:
+            body = self.cache.get(key)
+            if body is not None:
+                if timer is not None:
+                    timer.cached = True
+                return self._create_frame(**body, **self.reply_to(jsonheader), etag=tag)
+            generation = self.cache.generation(key)
+
+        result = self.query_api(request)
+        failed = "Error" in result.get("results", {}) or str(result.get("result", "")).startswith("Error")
+        if timer is not None:
+            timer.phase("db")
+            timer.error = failed
+        if capture is not None:
+            capture.phase("db")
+            capture.error = failed
+        body = self.encode_result(result, request, jsonheader)
+        if key is not None and not failed:
+            self.cache.put(key, body, len(body["content_bytes"]), generation)
+        frame = self._create_frame(**body, **self.reply_to(jsonheader), etag=None if failed else tag)
+        if timer is not None:
+            timer.phase("encode")
+        if capture is not None:
+            capture.phase("encode")
+        return frame
+
+    def query_api(self, request=None):
         """
         This is where our database is communicated with. I would move this elsewhere
         but without rewriting a lot more code, I decided to just keep it here.
+        Runs on a worker thread when the server has a WorkerPool.
         """
+        if request is None:
+            request = self.request
+
+        if request.get("action") == "batch":
+            return self.run_batch(request)
 
         # Simply passes on the "clients" request (built from key=value pairs on command line)
-        api = Api(self.db,self.request)
+        api = Api(self.db,request,self.pool,self.workers,self.cache,self.advisor,self.metrics,self.profiler,self.versions)
         # Gets result from database class (and uses it in the response to client)
         result = api.processRequest()
         return result
 
-    def create_response(self):
-        # Get our query results from the database
-        result = self.query_api()
+    def run_batch(self, request):
+        """ A batch request carries a list of ordinary requests in "requests" (each one what
+            Request.createRequest builds into "content"). They run at the same time on the
+            batch executor and come back as a list of results in the same order. An item that
+            fails gets an error result of its own, the rest of the batch is unaffected.
+        """
+        items = request.get("requests")
+        if isinstance(items, str):
+            items = json.loads(items)
+        if not isinstance(items, list):
+            return {"results":{"Error":"A batch needs a list of requests in 'requests'."}}
+        if len(items) > config.batch_max_items:
+            return {"results":{"Error":f"A batch can hold at most {config.batch_max_items} requests."}}
+
+        def run(item):
+            if not isinstance(item, dict) or "action" not in item:
+                return {"results":{"Error":"Each request in a batch needs an action."}}
+            if item["action"] == "batch":
+                return {"results":{"Error":"A batch can't contain another batch."}}
+            try:
+                return self.query_api(item)
+            except Exception as e:
+                return {"results":{"Error":f"Server error: {e!r}"}}
+
+        if self.batch is None:
+            return {"results":[run(item) for item in items]}
+
+        futures = [self.batch.submit(run, item) for item in items]
+        done, late = concurrent.futures.wait(futures, timeout=config.request_timeout)
+        results = []
+        for future in futures:
+            if future in late:
+                future.cancel()
+                results.append({"results":{"Error":f"Timed out after {config.request_timeout} seconds."}})
+            else:
+                results.append(future.result())
+        return {"results":results}
+
+    def stream_frames(self, request, jsonheader):
+        """ Generator behind a streamed search. Yields one "chunk" frame per chunk of rows as
+            the cursor produces them and then an "end" frame with the count. Anything that
+            can't be streamed comes out as one ordinary response frame.
+        """
+        api = Api(self.db,request,self.pool,self.workers,self.cache,self.advisor,self.metrics,self.profiler,self.versions)
+        chunk_rows = api.streamChunkRows()
+        rows = api.streamRequest(chunk_rows)
+        if isinstance(rows, dict):
+            yield self.create_response(rows, request, jsonheader)
+            return
+        count = yield from self.chunk_frames(rows, chunk_rows, request, jsonheader)
+        if count:
+            result = {"results":{"success": True,"count":count}}
+        else:
+            result = {"results":{"success": False,"database":api.mongo.db_name,"collection":api.mongo.collection}}
+        yield self.create_response(result, request, jsonheader, "end")
+
+    def chunk_frames(self, rows, chunk_rows, request, jsonheader):
+        """ Yields a "chunk" frame for every `chunk_rows` rows. Returns the number of rows.
+        """
+        count = 0
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                count += len(chunk)
+                yield self.create_response({"results":{"success": True,"data":chunk}}, request, jsonheader, "chunk")
+                chunk = []
+        if chunk:
+            count += len(chunk)
+            yield self.create_response({"results":{"success": True,"data":chunk}}, request, jsonheader, "chunk")
+        return count
+
+    def stream_error(self, error, request, jsonheader):
+        """ An "end" frame that stops a stream with an error.
+        """
+        return self.create_response({"results":{"Error":error}}, request, jsonheader, "end")
 
-        if self.jsonheader["content-type"] == "text/json":
+    def create_response(self, result, request, jsonheader, stream=None):
+        """ Encodes a result into a complete response frame for the given request. Returned
+            as a list of byte segments (see _create_frame).
+        """
+        return self._create_frame(
+            **self.encode_result(result, request, jsonheader),
+            **self.reply_to(jsonheader),
+            stream=stream,
+        )
+
+    def reply_to(self, jsonheader):
+        """ Frame arguments every answer to a request gets: its id back (if the client sent
+            one) so it can match up pipelined responses, the frame format the request came in,
+            and "we speak v2 too" if the client offered it (see Protocol.py).
+        """
+        offered = jsonheader.get("accept-protocol")
+        return {
+            "request_id": jsonheader.get("request-id"),
+            "protocol": jsonheader.get("protocol", 1),
+            "accept_protocol": Protocol.VERSION if offered and offered >= Protocol.VERSION
+                               and config.protocol_version >= Protocol.VERSION else None,
+        }
+
+    def encode_result(self, result, request, jsonheader):
+        """ Encodes a result into a response body in the same format (codec) the request came
+            in (columnar if it asked for format=columnar), compressed if the client accepts it
+            and it's big enough. Returns the body arguments for _create_frame (what the result
+            cache keeps).
+        """
+        codec = CODECS.get(jsonheader["content-type"])
+        if codec is not None and isinstance(request, dict) and request.get("format") == "columnar":
+            codec = get_codec("columnar")
+        if codec is not None:
             # building response to send to client
-            content_encoding = "utf-8"
             response = {
-                "content_bytes": self._json_encode(result, content_encoding),
-                "content_type": "text/json",
-                "content_encoding": content_encoding,
+                "content_bytes": codec.encode(result, codec.encoding),
+                "content_type": codec.content_type,
+                "content_encoding": codec.encoding,
             }
         else:
             # Binary or unknown content-type
             response = {
                 "content_bytes": b"First 10 bytes of request: "
-                + self.request[:10],
+                + request[:10],
                 "content_type": "binary/custom-server-binary-type",
                 "content_encoding": "binary",
             }
 
-        message = self._create_message(**response)
-        self.response_created = True
-        self._send_buffer += message
+        # Compressed only if the client said it can take it
+        response["content_bytes"], response["content_compression"] = compress_body(
+            response["content_bytes"], jsonheader.get("accept-compression")
+        )
+        return response
 
 """
   _____ _ _            _  ___  ___                               
@@ -273,11 +926,28 @@ class ServerMessage(Message):
                                                       |___/      
 """
 class ClientMessage(Message):
-    def __init__(self, selector, sock, addr, request):
+    """ClientMessage:
+    Extends: Message
+    Description: Packages requests and unpacks responses. By default it sends one request and
+                 closes once the answer arrives. With keep_alive=True the connection stays open,
+                 any number of requests can be queued (pipelined) and every response is filed
+                 under the request id it came back with. With a `cache` (ClientClass.ResponseCache)
+                 searches carry the tag of the answer we already have, and a "not modified"
+                 answer is swapped for that one.
+    """
+    def __init__(self, selector, sock, addr, request=None, keep_alive=False, cache=None):
         super().__init__(selector, sock, addr)
         self._request_queued = False
         self.request = request
         self.response = None
+        self.keep_alive = keep_alive
+        self._next_request_id = 0
+        self.pending = {}       # request id -> request still waiting on a response
+        self.responses = {}     # request id -> decoded response
+        self.chunks = {}        # request id -> deque of streamed chunks not read yet
+        self.cache = cache
+        self.revalidating = {}  # request id -> cache entry we asked the server about
+        self.protocol = 1       # frame format we send, 2 once the server says it has it (Protocol.py)
 
         if self.jsonheader:
             if self.response is None:
@@ -285,27 +955,52 @@ class ClientMessage(Message):
 
     def spec_read(self):
         if self.jsonheader:
-            if self.response is None:
-                self.process_response()
+            return self.process_response()
+        return False
+
+    def idle(self):
+        return super().idle() and not self.pending
 
     def write(self):
-        if not self._request_queued:
+        if not self._request_queued and self.request is not None:
             self.queue_request()
 
         self._write()
 
-        if self._request_queued:
-            if not self._send_buffer:
-                # Set selector to listen for read events, we're done writing.
-                self._set_selector_events_mask("r")
+        if not self._send_queue:
+            # Set selector to listen for read events, we're done writing.
+            self._set_selector_events_mask("r")
+
+    def queue_request(self, request=None):
+        """ Frames a request and adds it to the send buffer. Returns the id it was tagged with.
+        """
+        if request is None:
+            request = self.request
+            self._request_queued = True
+
+        request_id = self._next_request_id
+        self._next_request_id += 1
+
+        entry = self.cache.lookup(request) if self.cache is not None else None
+        if entry is not None:
+            self.revalidating[request_id] = entry
+        self._queue_send(self.encode_request(request, request_id, entry and entry.tag))
+        self.pending[request_id] = request
 
-    def queue_request(self):
-        content = self.request["content"]
-        content_type = self.request["type"]
-        content_encoding = self.request["encoding"]
-        if content_type == "text/json":
+        if self.sock is not None:
+            self._set_selector_events_mask("rw")
+        return request_id
+
+    def encode_request(self, request, request_id=None, if_none_match=None):
+        """ Builds the complete frame (bytes) for a request built by ClientClass.Request.
+        """
+        content = request["content"]
+        content_type = request["type"]
+        content_encoding = request["encoding"]
+        codec = get_codec(content_type)
+        if codec is not None:
             req = {
-                "content_bytes": self._json_encode(content, content_encoding),
+                "content_bytes": codec.encode(content, content_encoding),
                 "content_type": content_type,
                 "content_encoding": content_encoding,
             }
@@ -315,29 +1010,51 @@ class ClientMessage(Message):
                 "content_type": content_type,
                 "content_encoding": content_encoding,
             }
-        message = self._create_message(**req)
-        self._send_buffer += message
-        self._request_queued = True
+        # Ask for big responses to be compressed with anything we both have
+        accept = [name for name in config.accept_compression.split(",") if name in COMPRESSORS]
+        # and offer v2 framing until the server has taken it up
+        offer = config.protocol_version if self.protocol < config.protocol_version else None
+        return self._create_message(**req, request_id=request_id, accept_compression=accept, if_none_match=if_none_match,
+                                    protocol=self.protocol, accept_protocol=offer)
+
+    def negotiated(self, jsonheader):
+        """ Looks at a response's header: once the server says it speaks v2 we send v2 too.
+        """
+        offered = jsonheader.get("accept-protocol")
+        if offered and self.protocol < config.protocol_version <= offered:
+            self.protocol = config.protocol_version
 
     def process_response(self):
         content_len = self.jsonheader["content-length"]
-        if not len(self._recv_buffer) >= content_len:
-            return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
-        if self.jsonheader["content-type"] == "text/json":
-            encoding = self.jsonheader["content-encoding"]
-            self.response = self._json_decode(data, encoding)
-
+        if not self._recv_available() >= content_len:
+            return False
+        with self._recv_take(content_len) as data:
+            self.response = self.decode_content(data, self.jsonheader)
+        if self.jsonheader["content-type"] in CODECS:
             if config.debug:
                 print("received response", repr(self.response), "from", self.addr)
 
             #self._process_response_json_content()
         else:
-            # Binary or unknown content-type
-            self.response = data
             print(f'Unknown content type: received {self.jsonheader["content-type"]} response from', self.addr,)
             #self._process_response_binary_content()
-        # Close when response has been processed
-        self.close()
 
+        self.negotiated(self.jsonheader)
+        # Servers that predate request ids answer in order, so fall back to the oldest one.
+        request_id = self.jsonheader.get("request-id")
+        if request_id is None and self.pending:
+            request_id = next(iter(self.pending))
+        if self.jsonheader.get("stream") == "chunk":
+            # More frames to come for this request. Kept only if someone is reading the stream.
+            if request_id in self.chunks:
+                self.chunks[request_id].append(self.response)
+            return True
+        request = self.pending.pop(request_id, None)
+        if self.cache is not None:
+            self.response = self.cache.update(request, self.jsonheader, self.response, self.revalidating.pop(request_id, None))
+        self.responses[request_id] = self.response
+
+        if not self.keep_alive:
+            # Close when response has been processed
+            self.close()
+        return True
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Metrics.py
+Description:
+    Counters and latency histograms for one server process. action=serverstats returns them
+    as json, and with config.metrics_port set they are also served as plain text (Prometheus
+    format) at http://<host>:<metrics_port>/metrics.
+
+    A request's time is split into phases, each with a histogram per action:
+        queue    waiting for a worker thread
+        db       running the request (Api, mongo)
+        encode   turning the result into a frame (codec + compression)
+        send     from the frame being ready until its last byte is handed to the kernel,
+                 including any wait behind earlier responses on the same connection
+        total    from the request frame being read to the last byte of the answer sent
+    A result cache hit has no db / encode time and is counted in cache_hits. A streamed
+    search is worked on while it is sent, so it only gets send (= total). Also kept: requests and errors per action, bytes in and out,
+    open / accepted / refused connections, how often a connection was paused for backpressure
+    (see config.send_high_water), and the loop histogram: time the selector loop spends on the
+    events of one select() (for the asyncio server, how late a 100 ms timer fires).
+
+    Buckets are fixed, so recording is a bisect and a few adds under a lock, and percentiles
+    are estimated from the buckets. bench=metrics measures what it costs.
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds in seconds (the last bucket is everything above 10s)
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ("queue", "db", "encode", "send", "total")
+MAX_ACTIONS = 50        # action names come from clients, past this many they count as "other"
+LOOP_TICK = 0.1         # asyncio server: how often the loop lag timer fires
+
+
+def _label(value):
+    """ A label value for the text format: action names come from clients, so \\, " and
+        newlines have to be escaped or one odd request breaks /metrics for good.
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class Histogram:
+    """ Latencies in fixed buckets. Not thread safe on its own, Metrics holds the lock.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """ Estimated from the buckets (straight line inside the bucket the rank falls in).
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                low = BUCKETS[i - 1] if i else 0.0
+                high = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(low + (high - low) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": _ms(self.sum / self.count) if self.count else None,
+            "p50_ms": _ms(self.percentile(0.5)),
+            "p90_ms": _ms(self.percentile(0.9)),
+            "p99_ms": _ms(self.percentile(0.99)),
+            "max_ms": _ms(self.max),
+        }
+
+
+class RequestTimer:
+    """ Follows one request through its phases. Made when the request frame has been read,
+        `phase` ends a phase (the time since the last one ended) and `sent` ends the request.
+    """
+    __slots__ = ("metrics", "action", "started", "mark", "error", "cached")
+
+    def __init__(self, metrics, request):
+        self.metrics = metrics
+        self.action = metrics.action_name(request)
+        self.started = self.mark = time.perf_counter()
+        self.error = False
+        self.cached = False
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.metrics.observe(self.action, name, now - self.mark)
+        self.mark = now
+
+    def sent(self):
+        now = time.perf_counter()
+        self.metrics.finished(self, now - self.mark, now - self.started)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}          # action -> count
+        self.errors = {}
+        self.cache_hits = {}
+        self.phases = {}            # (action, phase) -> Histogram
+        self.loop = Histogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections_open = 0
+        self.connections_total = 0
+        self.connections_refused = 0
+        self.pauses = 0
+
+    def action_name(self, request):
+        action = request.get("action") if isinstance(request, dict) else None
+        action = str(action) if action else "unknown"
+        if action not in self.requests and len(self.requests) >= MAX_ACTIONS:
+            return "other"
+        return action
+
+    def timer(self, request):
+        return RequestTimer(self, request)
+
+    def _histogram(self, action, phase):
+        histogram = self.phases.get((action, phase))
+        if histogram is None:
+            histogram = self.phases[(action, phase)] = Histogram()
+        return histogram
+
+    def observe(self, action, phase, seconds):
+        with self.lock:
+            self._histogram(action, phase).add(seconds)
+
+    def finished(self, timer, send, total):
+        action = timer.action
+        with self.lock:
+            self._histogram(action, "send").add(send)
+            self._histogram(action, "total").add(total)
+            self.requests[action] = self.requests.get(action, 0) + 1
+            if timer.error:
+                self.errors[action] = self.errors.get(action, 0) + 1
+            if timer.cached:
+                self.cache_hits[action] = self.cache_hits.get(action, 0) + 1
+
+    def received(self, size):
+        with self.lock:
+            self.bytes_in += size
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_out += size
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections_open += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections_open -= 1
+
+    def connection_refused(self):
+        with self.lock:
+            self.connections_refused += 1
+
+    def paused(self):
+        with self.lock:
+            self.pauses += 1
+
+    def loop_time(self, seconds):
+        with self.lock:
+            self.loop.add(seconds)
+
+    def snapshot(self):
+        """ Everything as json for action=serverstats.
+        """
+        with self.lock:
+            uptime = time.time() - self.started
+            total = sum(self.requests.values())
+            actions = {}
+            for action in sorted({action for action, phase in self.phases} | set(self.requests)):
+                actions[action] = {
+                    "requests": self.requests.get(action, 0),
+                    "errors": self.errors.get(action, 0),
+                    "cache_hits": self.cache_hits.get(action, 0),
+                    "phases": {phase: self.phases[(action, phase)].summary()
+                               for phase in PHASES if (action, phase) in self.phases},
+                }
+            return {
+                "uptime": round(uptime, 1),
+                "requests": total,
+                "errors": sum(self.errors.values()),
+                "requests_per_second": round(total / uptime, 2) if uptime else None,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "connections_open": self.connections_open,
+                "connections_total": self.connections_total,
+                "connections_refused": self.connections_refused,
+                "pauses": self.pauses,
+                "loop": self.loop.summary(),
+                "actions": actions,
+            }
+
+    def text(self):
+        """ The plain text exposition format Prometheus scrapes.
+        """
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        def histogram(name, labels, histogram):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels.rstrip(',')}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{labels.rstrip(',')}}} {histogram.count}")
+
+        with self.lock:
+            metric("server_uptime_seconds", "gauge", "Seconds since the server started.",
+                   [("", round(time.time() - self.started, 3))])
+            metric("server_requests_total", "counter", "Requests answered, by action.",
+                   [(f'{{action="{_label(action)}"}}', count) for action, count in sorted(self.requests.items())])
+            metric("server_errors_total", "counter", "Requests answered with an error, by action.",
+                   [(f'{{action="{_label(action)}"}}', count) for action, count in sorted(self.errors.items())])
+            metric("server_cache_hits_total", "counter", "Requests answered from the result cache, by action.",
+                   [(f'{{action="{_label(action)}"}}', count) for action, count in sorted(self.cache_hits.items())])
+            metric("server_received_bytes_total", "counter", "Request bytes read.", [("", self.bytes_in)])
+            metric("server_sent_bytes_total", "counter", "Response bytes sent.", [("", self.bytes_out)])
+            metric("server_connections_open", "gauge", "Connections open now.", [("", self.connections_open)])
+            metric("server_connections_total", "counter", "Connections accepted.", [("", self.connections_total)])
+            metric("server_connections_refused_total", "counter", "Connections turned away, over max_connections.",
+                   [("", self.connections_refused)])
+            metric("server_backpressure_pauses_total", "counter", "Times a connection stopped being read because its answers backed up.",
+                   [("", self.pauses)])
+            lines.append("# HELP server_request_seconds Request latency by action and phase.")
+            lines.append("# TYPE server_request_seconds histogram")
+            for (action, phase), values in sorted(self.phases.items()):
+                histogram("server_request_seconds", f'action="{_label(action)}",phase="{phase}",', values)
+            lines.append("# HELP server_loop_seconds Time the event loop spends on one round of events.")
+            lines.append("# TYPE server_loop_seconds histogram")
+            histogram("server_loop_seconds", "", self.loop)
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # a scrape every few seconds would fill the console
+
+
+def serve_http(metrics, host, port):
+    """ Serves metrics.text() at http://host:port/metrics on a background thread. Returns the
+        HTTPServer (call shutdown() on it to stop).
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+MongoPool.py
+Description:
+    The shared MongoClient for db=<mongo database name> and the listener that counts its
+    connection pool events (poolstats). Only imported on the mongo path, so db=memory://
+    runs without pymongo installed.
+"""
+from pymongo import MongoClient
+from pymongo import monitoring
+import config
+import threading
+import time
+
+
+"""
+ ___  ___                       ______           _ 
+ |  \/  |                       | ___ \         | |
+ | .  . | ___  _ __   __ _  ___ | |_/ /__   ___ | |
+ | |\/| |/ _ \| '_ \ / _` |/ _ \|  __/ _ \ / _ \| |
+ | |  | | (_) | | | | (_| | (_) | | | (_) | (_) | |
+ \_|  |_/\___/|_| |_|\__, |\___/\_|  \___/ \___/|_|
+                      __/ |                        
+                     |___/                         
+"""
+class PoolCounters(monitoring.ConnectionPoolListener):
+    """ Listens to pymongo's connection pool events and keeps running totals. A checkout
+        "waits" when every connection is already in use, and the time until a connection
+        frees up (or the checkout fails) is added to wait_seconds.
+    """
+    def __init__(self,max_pool_size):
+        self.max_pool_size = max_pool_size
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.checkouts = 0
+        self.checkins = 0
+        self.checkout_failures = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.in_use = 0
+        self.created = 0
+        self.closed = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "max_pool_size": self.max_pool_size,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "checkout_failures": self.checkout_failures,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 6),
+                "in_use": self.in_use,
+                "connections_created": self.created,
+                "connections_closed": self.closed,
+            }
+
+    def _checkout_done(self):
+        started = getattr(self.local, "started", None)
+        self.local.started = None
+        if started is not None:
+            self.wait_seconds += time.perf_counter() - started
+
+    def connection_check_out_started(self,event):
+        # Checkout started / finished events fire on the same thread
+        with self.lock:
+            if self.in_use >= self.max_pool_size:
+                self.waits += 1
+                self.local.started = time.perf_counter()
+
+    def connection_checked_out(self,event):
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self._checkout_done()
+
+    def connection_check_out_failed(self,event):
+        with self.lock:
+            self.checkout_failures += 1
+            self._checkout_done()
+
+    def connection_checked_in(self,event):
+        with self.lock:
+            self.checkins += 1
+            self.in_use -= 1
+
+    def connection_created(self,event):
+        with self.lock:
+            self.created += 1
+
+    def connection_closed(self,event):
+        with self.lock:
+            self.closed += 1
+
+    # Events we don't count
+    def pool_created(self,event):
+        pass
+
+    def pool_ready(self,event):
+        pass
+
+    def pool_cleared(self,event):
+        pass
+
+    def pool_closed(self,event):
+        pass
+
+    def connection_ready(self,event):
+        pass
+
+
+class MongoPool(object):
+    """ One MongoClient for the whole life of the server. MongoClient is itself a thread safe
+        connection pool, so building it once and handing it to every Api / MongoHelper means
+        no per request server discovery, monitor threads or TCP handshakes to mongo.
+        Anything not passed in comes from config.py.
+    """
+    def __init__(self,uri=None,max_pool_size=None,min_pool_size=None,connect_timeout_ms=None,
+                 server_selection_timeout_ms=None,socket_timeout_ms=None,wait_queue_timeout_ms=None):
+        self.uri = uri or config.mongo_uri
+        max_pool_size = max_pool_size or config.mongo_max_pool_size
+        self.counters = PoolCounters(max_pool_size)
+        self.client = MongoClient(
+            self.uri,
+            maxPoolSize=max_pool_size,
+            minPoolSize=config.mongo_min_pool_size if min_pool_size is None else min_pool_size,
+            connectTimeoutMS=connect_timeout_ms or config.mongo_connect_timeout_ms,
+            serverSelectionTimeoutMS=server_selection_timeout_ms or config.mongo_server_selection_timeout_ms,
+            socketTimeoutMS=socket_timeout_ms or config.mongo_socket_timeout_ms,
+            waitQueueTimeoutMS=wait_queue_timeout_ms or config.mongo_wait_queue_timeout_ms,
+            event_listeners=[self.counters],
+        )
+
+    def close(self):
+        self.client.close()
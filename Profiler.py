@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Profiler.py
+Description:
+    Finds out where a slow request spends its time, switched on and off while the server runs
+    with action=profile (no restart):
+
+        ./Client.py action=profile state=on sample=10 match_action=search slow_ms=200
+        ./Client.py action=profile state=off
+        ./Client.py action=profile                  (just says what it is doing)
+
+    While it is on, requests matching match_action / match_collection (comma separated, empty
+    matches everything) are watched:
+        - any of them slower than slow_ms, counted from the request frame being read to the
+          last byte of its answer being sent, gets a line in <profile_dir>/slow.jsonl with its
+          queue / db / encode / send times
+        - `sample` percent of them are run under cProfile. The worker thread's work (mongo, the
+          row loop in MongoHelper.search, encoding) is dumped to <profile_dir>/<name>.prof
+          (open it with `python -m pstats` or snakeviz) with the top functions in <name>.txt.
+          With memory=1 the .txt also lists the lines that allocated the most (tracemalloc)
+    The send phase runs on the loop thread so it is only in the slow log, not the profiles.
+    Streamed searches only get the slow log.
+
+    Only one request is profiled at a time (a profiler hooks the interpreter, and two at once
+    isn't allowed from 3.12 on), a sampled request that comes along meanwhile is counted as
+    skipped. tracemalloc is global, so allocations made by other threads during a profiled
+    request show up in its memory list too. Each server process (workers=N) has its own
+    profiler and the action only reaches the process that took the connection.
+"""
+import config
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+
+TOP_FUNCTIONS = 40      # rows of the profile written to the .txt
+TOP_ALLOCATIONS = 20
+SKIP_ACTIONS = ("profile",)
+
+
+def _names(value):
+    """ "search,searchkey" or a list -> set of names, empty for nothing.
+    """
+    if value in (None, ""):
+        return set()
+    if isinstance(value, str):
+        value = value.split(",")
+    return {str(name).strip() for name in value if str(name).strip()}
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class Capture:
+    """ One watched request. Made when the request frame has been read. `phase` ends a phase,
+        `begin` / `end` wrap the worker thread's part (and profile it if it was sampled) and
+        `sent` finishes the request.
+    """
+    def __init__(self, profiler, request, profiled):
+        self.profiler = profiler
+        self.request = request
+        self.profiled = profiled
+        self.started = self.mark = time.perf_counter()
+        self.phases = {}
+        self.profile = None
+        self.snapshot = None
+        self.name = None
+        self.error = False
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+    def begin(self):
+        """ Runs on the worker thread, just before the request is worked on.
+        """
+        self.phase("queue")
+        if self.profiled and self.profiler.claim():
+            if self.profiler.memory and tracemalloc.is_tracing():
+                self.snapshot = tracemalloc.take_snapshot()
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError:
+                # something else is profiling this process
+                self.profile = None
+                self.profiler.release()
+        elif self.profiled:
+            self.profiler.count("skipped")
+            self.profiled = False
+
+    def end(self):
+        """ Runs on the worker thread once the response frame has been built.
+        """
+        if self.profile is None:
+            return
+        self.profile.disable()
+        try:
+            memory = None
+            if self.snapshot is not None and tracemalloc.is_tracing():
+                memory = tracemalloc.take_snapshot().compare_to(self.snapshot, "lineno")[:TOP_ALLOCATIONS]
+            self.name = self.profiler.dump(self, memory)
+        except OSError as e:
+            # a full disk shouldn't fail the request
+            print("profiler: can't write profile:", e)
+        finally:
+            self.profile = self.snapshot = None
+            self.profiler.release()
+
+    def sent(self):
+        now = time.perf_counter()
+        self.phases["send"] = now - self.mark
+        self.profiler.finished(self, now - self.started)
+
+
+class Profiler:
+    def __init__(self, directory=None):
+        self.directory = directory or config.profile_dir
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()      # held while a request is being profiled
+        self.enabled = False
+        self.sample = 0.0
+        self.actions = set()
+        self.collections = set()
+        self.slow_ms = None
+        self.memory = False
+        self.tracing = False            # we started tracemalloc
+        self.sequence = itertools.count(1)
+        self.counts = {"watched": 0, "slow": 0, "profiled": 0, "skipped": 0}
+        # what it starts with, action=profile changes them
+        self.configure(state="on" if config.profile_enabled else "off", sample=config.profile_sample,
+                       slow_ms=config.profile_slow_ms, match_action=config.profile_actions,
+                       match_collection=config.profile_collections, memory=config.profile_memory)
+
+    def configure(self, state=None, sample=None, match_action=None, match_collection=None, slow_ms=None, memory=None):
+        """ Changes the settings given (the others stay as they are). Raises ValueError on a bad one.
+        """
+        if state not in (None, "on", "off"):
+            raise ValueError(f'state should be on or off, not "{state}".')
+        if sample is not None:
+            sample = float(sample)
+            if not 0 <= sample <= 100:
+                raise ValueError("sample is a percentage, 0 to 100.")
+        if slow_ms == "":
+            slow_ms = -1            # "" turns the slow log off
+        elif slow_ms is not None:
+            slow_ms = float(slow_ms)
+        if state == "on":
+            os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            if sample is not None:
+                self.sample = sample
+            if match_action is not None:
+                self.actions = _names(match_action)
+            if match_collection is not None:
+                self.collections = _names(match_collection)
+            if slow_ms is not None:
+                self.slow_ms = slow_ms if slow_ms >= 0 else None
+            if memory is not None:
+                self.memory = str(memory).lower() in ("1", "true", "yes", "on")
+            if state is not None:
+                self.enabled = state == "on"
+            tracing = self.enabled and self.memory
+        if tracing and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        elif not tracing and self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def status(self):
+        with self.lock:
+            return {
+                "profiling": self.enabled,
+                "sample": self.sample,
+                "match_action": sorted(self.actions),
+                "match_collection": sorted(self.collections),
+                "slow_ms": self.slow_ms,
+                "memory": self.memory,
+                "dir": os.path.abspath(self.directory),
+                "pid": os.getpid(),
+                **self.counts,
+            }
+
+    def capture(self, request):
+        """ A Capture for this request, or None if profiling is off or it doesn't match.
+            This is the only thing every request pays for.
+        """
+        if not self.enabled or not isinstance(request, dict):
+            return None
+        action = request.get("action")
+        if action in SKIP_ACTIONS:
+            return None
+        if self.actions and action not in self.actions:
+            return None
+        if self.collections and request.get("collection") not in self.collections:
+            return None
+        profiled = self.sample > 0 and random.random() * 100 < self.sample
+        self.count("watched")
+        return Capture(self, request, profiled)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def claim(self):
+        return self.busy.acquire(blocking=False)
+
+    def release(self):
+        self.busy.release()
+
+    def dump(self, capture, memory=None):
+        """ Writes a profiled request's .prof and .txt. Returns the name they share.
+        """
+        action = re.sub(r"[^\w-]", "_", str(capture.request.get("action")))[:40]
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self.sequence)}-{action}"
+        base = os.path.join(self.directory, name)
+        capture.profile.dump_stats(base + ".prof")
+        out = io.StringIO()
+        out.write(f"request: {_describe(capture.request)}\n")
+        out.write("phases (ms): " + json.dumps({phase: _ms(seconds) for phase, seconds in capture.phases.items()}) + "\n\n")
+        pstats.Stats(capture.profile, stream=out).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        if memory is not None:
+            out.write(f"\nallocated while it ran (top {TOP_ALLOCATIONS} lines):\n")
+            for stat in memory:
+                out.write(f"{stat}\n")
+        with open(base + ".txt", "w") as f:
+            f.write(out.getvalue())
+        self.count("profiled")
+        return name
+
+    def finished(self, capture, total):
+        """ Called once the request's answer has been sent: logs it if it was slow.
+        """
+        slow_ms = self.slow_ms
+        if slow_ms is None or total * 1000 < slow_ms:
+            return
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "pid": os.getpid(),
+            "action": capture.request.get("action"),
+            "collection": capture.request.get("collection"),
+            "total_ms": _ms(total),
+            "phases_ms": {phase: _ms(seconds) for phase, seconds in capture.phases.items()},
+            "error": capture.error,
+            "profile": capture.name,
+            "request": _describe(capture.request),
+        }
+        line = json.dumps(entry, default=str) + "\n"
+        with self.lock:
+            self.counts["slow"] += 1
+            try:
+                with open(os.path.join(self.directory, "slow.jsonl"), "a") as f:
+                    f.write(line)
+            except OSError as e:
+                print("profiler: can't write slow log:", e)
+
+
+def _describe(request, limit=500):
+    """ The request for the logs, cut short (an insert_many can carry a lot of data).
+    """
+    text = json.dumps(request, default=str)
+    return text if len(text) <= limit else text[:limit] + "..."
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Protocol.py
+Description:
+    Frame format v2. A v1 frame is a 2 byte length, a json header and the body, and for small
+    requests (test, searchkey) building and parsing that json header is most of the work. A v2
+    frame starts with a fixed 22 byte header packed with struct instead, then the body:
+
+        magic        2s  b"\\xfe\\xb2"
+        version      B   2
+        flags        B   has a request id / stream chunk / stream end / not modified
+        codec        B   1 json, 2 msgpack, 3 columnar, 0 = named in the extra header
+        compression  B   what the body is compressed with: 1 zstd, 2 lz4, 3 zlib, 0 nothing
+        accept       B   a bit per compressor the sender can take back (1 << (id - 1))
+        (pad)        x
+        extra        H   length of the json "extra" header between this one and the body
+        request id   I
+        length       Q   body length
+
+    Whatever has no slot (etag, if-none-match, a content-type without an id, a request id that
+    isn't a small int, an accept-compression order that isn't zstd,lz4,zlib) goes in the extra
+    json header, which is empty for most frames. unpack() turns a v2 header back into the same
+    dict a v1 json header decodes to (plus "protocol": 2), so nothing past the framing changes.
+
+    The magic read as a v1 length would be a 65202 byte json header, which no v1 frame has, so
+    both kinds can arrive on one socket. A client sends v1 frames with "accept-protocol": 2
+    until an answer comes back with "accept-protocol": 2 too, then switches that connection to
+    v2. The server answers every frame in the format it came in, so v1 clients and servers
+    never see a v2 frame.
+"""
+import json
+import struct
+
+MAGIC = b"\xfe\xb2"
+VERSION = 2
+HEADER = struct.Struct(">2sBBBBBxHIQ")
+
+# flags
+HAS_ID = 1
+STREAM_CHUNK = 2
+STREAM_END = 4
+NOT_MODIFIED = 8
+
+CODEC_IDS = {"text/json": 1, "application/msgpack": 2, "application/x-columnar": 3}
+CODEC_TYPES = {number: content_type for content_type, number in CODEC_IDS.items()}
+# content-encoding goes with the codec, so it only has to be sent for the others
+CODEC_ENCODINGS = {"text/json": "utf-8", "application/msgpack": "binary", "application/x-columnar": "binary"}
+
+COMPRESSION_IDS = {"zstd": 1, "lz4": 2, "zlib": 3}
+COMPRESSION_NAMES = {number: name for name, number in COMPRESSION_IDS.items()}
+
+MAX_ID = 2 ** 32 - 1
+
+
+def accept_bits(accepted):
+    """ (bitmask, what has to go in the extra header instead) for an accept-compression list.
+    """
+    bits = 0
+    for name in accepted:
+        if name not in COMPRESSION_IDS:
+            return 0, accepted
+        bits |= 1 << (COMPRESSION_IDS[name] - 1)
+    if list(accepted) != accepted_names(bits):
+        # the bits can't say which one is preferred
+        return 0, accepted
+    return bits, None
+
+
+def accepted_names(bits):
+    return [name for name, number in COMPRESSION_IDS.items() if bits & (1 << (number - 1))]
+
+
+def pack(content_length, content_type, content_encoding, request_id=None, stream=None,
+         content_compression=None, accept_compression=None, etag=None, if_none_match=None,
+         not_modified=False):
+    """ The v2 header (and extra header, if one is needed) for a frame, as one bytes object.
+        Takes what Message._create_frame does.
+    """
+    extra = {}
+    flags = 0
+    codec = CODEC_IDS.get(content_type, 0)
+    if not codec or content_encoding != CODEC_ENCODINGS[content_type]:
+        codec = 0
+        extra["content-type"] = content_type
+        extra["content-encoding"] = content_encoding
+    number = 0
+    if request_id is not None:
+        if isinstance(request_id, int) and 0 <= request_id <= MAX_ID:
+            flags |= HAS_ID
+            number = request_id
+        else:
+            extra["request-id"] = request_id
+    if stream == "chunk":
+        flags |= STREAM_CHUNK
+    elif stream == "end":
+        flags |= STREAM_END
+    elif stream is not None:
+        extra["stream"] = stream
+    if not_modified:
+        flags |= NOT_MODIFIED
+    compression = 0
+    if content_compression is not None:
+        compression = COMPRESSION_IDS.get(content_compression, 0)
+        if not compression:
+            extra["content-compression"] = content_compression
+    accept = 0
+    if accept_compression:
+        accept, listed = accept_bits(accept_compression)
+        if listed is not None:
+            extra["accept-compression"] = listed
+    if etag is not None:
+        extra["etag"] = etag
+    if if_none_match is not None:
+        extra["if-none-match"] = if_none_match
+    extra = json.dumps(extra, ensure_ascii=False).encode("utf-8") if extra else b""
+    return HEADER.pack(MAGIC, VERSION, flags, codec, compression, accept, len(extra), number, content_length) + extra
+
+
+def unpack(fields, extra=b""):
+    """ The header dict for a v2 frame from HEADER's fields and its extra header bytes.
+    """
+    magic, version, flags, codec, compression, accept, extra_len, number, length = fields
+    if version != VERSION:
+        raise ValueError(f"Unsupported protocol version {version}.")
+    content_type = CODEC_TYPES.get(codec)
+    jsonheader = {
+        "byteorder": "big",     # what the fixed header is packed in
+        "content-type": content_type,
+        "content-encoding": CODEC_ENCODINGS.get(content_type),
+        "content-length": length,
+        "protocol": VERSION,
+    }
+    if flags & HAS_ID:
+        jsonheader["request-id"] = number
+    if flags & STREAM_CHUNK:
+        jsonheader["stream"] = "chunk"
+    elif flags & STREAM_END:
+        jsonheader["stream"] = "end"
+    if flags & NOT_MODIFIED:
+        jsonheader["not-modified"] = True
+    if compression:
+        if compression not in COMPRESSION_NAMES:
+            raise ValueError(f"Unknown compression id {compression}.")
+        jsonheader["content-compression"] = COMPRESSION_NAMES[compression]
+    if accept:
+        jsonheader["accept-compression"] = accepted_names(accept)
+    if extra:
+        jsonheader.update(json.loads(str(extra, "utf-8")))
+    if jsonheader["content-type"] is None:
+        raise ValueError(f"Unknown codec id {codec}.")
+    return jsonheader
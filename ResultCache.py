@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+ResultCache.py
+Description:
+    Keeps the encoded (and compressed) response bodies of recent search / searchkey (and
+    resample / rolling / returns / stats) requests so asking the same question again costs a
+    dictionary lookup instead of a mongo query plus json encoding. Entries are keyed on (db, collection, action, normalized request,
+    codec, compressor), expire after config.cache_ttl seconds and the least recently used
+    ones are dropped once the cache holds config.cache_max_bytes. An insert into a
+    collection throws away that collection's entries.
+
+    Each server process has its own cache. With workers=N an insert only clears the cache
+    of the process that did it, the others catch up when their entries expire.
+
+    Send cache=bypass with a request to skip the cache (neither read nor stored).
+
+    Versions hands out a tag (like an HTTP ETag) with every answer to those actions, made from
+    the question and a write counter for its collection. A client that sends the tag back in
+    an "if-none-match" header gets a tiny "not modified" frame instead of the result, as long
+    as nothing was written to the collection through this server process since (and at most
+    config.version_ttl seconds went by, in case something else writes to mongo). Tags carry a
+    random number picked when the process starts, so a restarted server or another worker
+    process never takes an old tag for a current one.
+"""
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Read only actions whose answers are kept / tagged
+ACTIONS = ("search", "searchkey", "resample", "rolling", "returns", "stats")
+# Request keys that change what they return. Everything else (stream, cache, ...) doesn't.
+QUERY_KEYS = ("params", "key", "value", "limit", "sort", "projection", "after", "format",
+              "symbol", "start", "end", "field", "every", "window", "stat", "period", "kind")
+
+
+def query_key(request):
+    """ The parts of a request that decide its answer, as one normalized string.
+    """
+    query = {}
+    for name in QUERY_KEYS:
+        value = request.get(name)
+        if isinstance(value, str) and value.lstrip()[:1] in ("[", "{"):
+            # Same json written with different spacing / key order is the same query
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        if value is not None:
+            query[name] = value
+    return json.dumps(query, sort_keys=True, separators=(",", ":"), default=str)
+
+
+class ResultCache:
+    ACTIONS = ACTIONS
+    QUERY_KEYS = QUERY_KEYS
+
+    def __init__(self, max_bytes, ttl, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # One huge result shouldn't push everything else out
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()   # key -> (expires, size, body), oldest first
+        self.by_collection = {}                     # (db, collection) -> keys cached for it
+        self.generations = collections.Counter()    # (db, collection) -> inserts seen so far
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stored = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def key(self, db, request, content_type, compressor=None):
+        """ The cache key for a request, or None if it can't be cached (not a search, or it
+            asked to bypass the cache).
+        """
+        if not isinstance(request, dict) or request.get("action") not in self.ACTIONS:
+            return None
+        if request.get("cache") == "bypass":
+            with self.lock:
+                self.bypassed += 1
+            return None
+        return (db, request.get("collection"), request["action"], query_key(request), content_type, compressor)
+
+    def generation(self, key):
+        """ Call before running the query. put() refuses the result if the collection was
+            written to in the meantime.
+        """
+        with self.lock:
+            return self.generations[key[:2]]
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, body, size, generation):
+        if size > self.max_entry_bytes:
+            return
+        with self.lock:
+            if self.generations[key[:2]] != generation:
+                # An insert landed while we were querying, this result may already be stale
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl, size, body)
+            self.by_collection.setdefault(key[:2], set()).add(key)
+            self.size += size
+            self.stored += 1
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, db, collection):
+        """ Drops every entry for a collection. Called after a write to it.
+        """
+        with self.lock:
+            self.generations[(db, collection)] += 1
+            for key in self.by_collection.pop((db, collection), ()):
+                if key in self.entries:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def _remove(self, key):
+        expires, size, body = self.entries.pop(key)
+        self.size -= size
+        keys = self.by_collection.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_collection[key[:2]]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "bypassed": self.bypassed,
+                "stored": self.stored,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+class Versions:
+    """ Write counters per (db, collection) and the tags made from them (see the top).
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.epoch = os.urandom(8).hex()
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()       # (db, collection) -> writes seen so far
+        self.tagged = 0
+        self.not_modified = 0
+
+    def bump(self, db, collection):
+        """ Called after a write to a collection: every tag handed out for it is now stale.
+        """
+        with self.lock:
+            self.counters[(db, collection)] += 1
+
+    def tag(self, db, request, content_type):
+        """ The tag for this request's answer as things stand, None if it doesn't get one.
+            Take it before running the query so a write that lands meanwhile changes it.
+        """
+        if not isinstance(request, dict) or request.get("action") not in ACTIONS or request.get("stream"):
+            return None
+        collection = request.get("collection")
+        with self.lock:
+            writes = self.counters[(db, collection)]
+        window = int(time.time() // self.ttl) if self.ttl else 0
+        text = f"{self.epoch}|{db}|{collection}|{request['action']}|{query_key(request)}|{content_type}|{writes}|{window}"
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:20]
+
+    def matched(self, tag, jsonheader):
+        """ True if the client already has this answer. Counts tags handed out and matched.
+        """
+        matched = tag is not None and jsonheader.get("if-none-match") == tag
+        with self.lock:
+            if matched:
+                self.not_modified += 1
+            elif tag is not None:
+                self.tagged += 1
+        return matched
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ttl": self.ttl,
+                "collections_written": len(self.counters),
+                "tagged": self.tagged,
+                "not_modified": self.not_modified,
+            }
@@ -10,15 +10,23 @@ Requires:
 Usage:
     Configure server using key value pairs: 
     ./Server.py host=10.0.61.34 port=6000
+    ./Server.py host=10.0.61.34 port=6000 threads=16
+    ./Server.py host=10.0.61.34 port=6000 workers=4
+    ./Server.py host=10.0.61.34 port=6000 mode=async         (one process, workers=N is refused)
+    ./Server.py host=10.0.61.34 port=6000 db=memory://stockmarket
+    ./Server.py host=10.0.61.34 port=6000 metrics_port=9100
+    ./Server.py host=10.0.61.34 port=6000 metrics=0
 """
 import config
 import sys
 from helpers import myArgParse
 from ServerClass import Server
+from ServerClass import Supervisor
+from AsyncServerClass import AsyncServer
 
 
 def Usage():
-    print("Usage: <host> <port> <db name>")
+    print("Usage: <host> <port> <db name> [threads] [workers] [mode=selectors|async] [metrics=0] [metrics_port]")
     print(f"Example: {sys.argv[0]} host=10.0.61.34 port=6000 db=stockmarket")
     sys.exit()
 
@@ -33,16 +41,32 @@ if __name__=='__main__':
     # Get key value pairs from command line (see usage)
     kwargs,args = myArgParse(sys.argv)
 
-    db = kwargs.get("db",config.database)          # db = mongodb database name
+    db = kwargs.get("db",config.database)          # db = mongodb database name, or memory://name
     host = kwargs.get("host",config.host)      # host = ip address
     port = int(kwargs.get("port",config.port)) # port = chosen port
+    threads = int(kwargs.get("threads",config.worker_threads)) # threads = database worker threads
+    workers = int(kwargs.get("workers",config.server_workers)) # workers = server processes
+    mode = kwargs.get("mode",config.server_mode)                # mode = selectors or async
+    metrics = kwargs.get("metrics",config.metrics_enabled) not in (False,"0","off","false")  # metrics = 0 turns them off
+    metrics_port = kwargs.get("metrics_port",config.metrics_port)  # metrics_port = plain text metrics over http
 
     # print how to use if both values not on command 
     if not (db and host and port):
         Usage()
 
+    if mode == "async" and workers > 1:
+        # Supervisor forks copies of the selectors server only
+        print("workers=N only works with mode=selectors, the asyncio server is one process.")
+        sys.exit(1)
+
     # actually start listening
-    server = Server(db,host,port)
-    server.run_server()
+    if mode == "async":
+        AsyncServer(db,host,port,threads,metrics,metrics_port).run_server()
+    elif workers > 1:
+        Supervisor(workers,db,host,port,threads,metrics,metrics_port).run()
+    else:
+        server = Server(db,host,port,threads,metrics,metrics_port)
+        server.install_signal_handlers()
+        server.run_server()
 
  
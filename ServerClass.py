@@ -7,9 +7,15 @@ Description:
     until killed.
 Requires:
     Message.py :: ServerMessage
+    WorkerPool.py :: WorkerPool
+    ResultCache.py :: ResultCache
+    Metrics.py :: Metrics
+    Profiler.py :: Profiler
     
     This line:  `message = ServerMessage(self.sel, conn, addr)` is what gives this file message
     handling capability. 
+
+    Supervisor runs several Server processes on the same port (see Server.py workers=N).
 """
 import config
 import sys
@@ -19,14 +25,25 @@ import io
 import struct
 import socket
 import traceback
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from Message import ServerMessage
+from Message import Message, ServerMessage
+from DbHelpers import openPool
+from WorkerPool import WorkerPool
+from ResultCache import ResultCache, Versions
+from IndexAdvisor import IndexAdvisor
+from Metrics import Metrics, serve_http
+from Profiler import Profiler
 
 class Server:
-    def __init__(self,db=None,host=None,port=None):
+    def __init__(self,db=None,host=None,port=None,threads=None,metrics=None,metrics_port=None):
         self.db = db
         self.host = host
         self.port = int(port)
+        self.threads = threads
 
         if not self.db:
             self.db = config.database
@@ -38,31 +55,168 @@ class Server:
             self.port = int(config.port)
 
         self.sel = selectors.DefaultSelector()
+        self.stopping = False
+        self.drain_deadline = None
+
+        if not self.threads:
+            self.threads = int(config.worker_threads)
+
+        # One mongo connection pool for the life of the server, shared by every request
+        # (or the in-process store for db=memory://)
+        self.pool, self.db = openPool(self.db)
+
+        # Database work runs here, the selector loop is woken up when a job is done
+        self.workers = WorkerPool(self.threads, config.worker_queue_limit)
+
+        # Recent search responses, already encoded
+        self.cache = ResultCache(config.cache_max_bytes, config.cache_ttl) if config.cache_enabled else None
+
+        # Runs the requests inside a batch at the same time. Separate from the worker threads
+        # so a batch waiting on its items can never use up the threads the items need.
+        self.batch = ThreadPoolExecutor(max_workers=config.batch_threads, thread_name_prefix="batch-worker")
+        self.advisor = IndexAdvisor(config.index_auto, config.index_auto_min_count, config.index_auto_min_ms,
+                                    config.index_max_shapes) if config.index_advisor else None
+
+        # Write counters per collection, tags on search answers come from them (if-none-match)
+        self.versions = Versions(config.version_ttl) if config.versions_enabled else None
+
+        # Counters and latency histograms (serverstats), optionally served over http too
+        if metrics is None:
+            metrics = config.metrics_enabled
+        self.metrics = Metrics() if metrics else None
+        self.metrics_port = config.metrics_port if metrics_port is None else metrics_port
+        self.metrics_http = None
+
+        # Slow request log and sampled cProfile runs, off until action=profile turns them on
+        self.profiler = Profiler()
+
+        # Open connections, for config.max_connections and draining. Closed ones are swept
+        # out when it has doubled in size.
+        self.messages = set()
+        self.sweep_at = 64
 
     def accept_wrapper(self,sock):
-        conn, addr = sock.accept()  # Should be ready to read
+        try:
+            conn, addr = sock.accept()  # Should be ready to read
+        except BlockingIOError:
+            # Another worker process sharing this socket got the connection first
+            return
+        if len(self.messages) >= self.sweep_at:
+            self.sweep()
+        if config.max_connections and len(self.messages) >= config.max_connections:
+            # (some of them may have closed since the last sweep)
+            self.sweep()
+            if len(self.messages) >= config.max_connections:
+                self.refuse(conn, addr)
+                return
         print("accepted connection from", addr)
         conn.setblocking(False)
-        message = ServerMessage(self.sel, conn, addr,self.db)
+        # Answers to pipelined requests go out as soon as they're ready, not when Nagle says so
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        message = ServerMessage(self.sel, conn, addr,self.db,self.pool,self.workers,self.cache,self.batch,self.advisor,self.metrics,
+                                self.profiler,self.versions)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
         self.sel.register(conn, selectors.EVENT_READ, data=message)
+        self.messages.add(message)
+
+    def sweep(self):
+        self.messages = {message for message in self.messages if message.sock is not None}
+        self.sweep_at = max(64, 2 * len(self.messages))
+
+    def refuse(self,conn,addr):
+        """ Over config.max_connections: say so and hang up. A new connection's send buffer
+            is empty so the little error frame goes out without blocking. ClientPool retries
+            "Server busy" answers.
+        """
+        print("refused connection from", addr, "(max_connections)")
+        if self.metrics is not None:
+            self.metrics.connection_refused()
+        try:
+            conn.setblocking(False)
+            conn.send(Message(None, conn, addr).refusal("Server busy: too many connections, try again later."))
+        except OSError:
+            pass
+        finally:
+            conn.close()
 
-    def run_server(self):
-        #host, port = self.host, int(self.port)
+    @staticmethod
+    def listen_socket(host,port,reuse_port=False):
+        """ Builds the listening socket. With reuse_port every worker process binds its own
+            socket to the same port and the kernel spreads new connections between them.
+        """
         lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # Avoid bind() exception: OSError: [Errno 48] Address already in use
         lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        lsock.bind((self.host, self.port))
+        if reuse_port:
+            lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        lsock.bind((host, port))
         lsock.listen()
-        print("listening on", (self.host, self.port))
         lsock.setblocking(False)
+        return lsock
+
+    def install_signal_handlers(self):
+        """ SIGTERM drains the server instead of killing it. Only works from the main thread.
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+    def stop(self):
+        """ Ask the loop to drain: stop accepting, finish what is in flight, then return.
+            Safe to call from a signal handler.
+        """
+        self.stopping = True
+        # Kick the selector awake
+        try:
+            self.workers.wakeup_send.send(b"\0")
+        except OSError:
+            pass
+
+    def drained(self,lsock):
+        """ Called each time round the loop once stop() has been called. Returns True when
+            the last connection is gone (or we ran out of patience).
+        """
+        if self.drain_deadline is None:
+            print("draining connections before exit")
+            self.drain_deadline = time.monotonic() + config.drain_timeout
+            self.sel.unregister(lsock)
+            lsock.close()
+
+        connections = [message for message in self.messages if message.sock is not None]
+        for message in connections:
+            if message.idle():
+                # nothing in flight on this one, hang up
+                message.close()
+        if time.monotonic() > self.drain_deadline:
+            return True
+        return not any(message.sock is not None for message in connections)
+
+    def run_server(self,lsock=None,reuse_port=False):
+        """ Runs the selector loop. A worker process started by Supervisor passes in the
+            listening socket it inherited, otherwise we build our own.
+        """
+        if lsock is None:
+            lsock = self.listen_socket(self.host, self.port, reuse_port)
+        print("listening on", (self.host, self.port), "pid", os.getpid())
+        if self.metrics is not None and self.metrics_port:
+            self.metrics_http = serve_http(self.metrics, self.host, int(self.metrics_port))
+            print("metrics on", f"http://{self.host}:{self.metrics_port}/metrics")
         self.sel.register(lsock, selectors.EVENT_READ, data=None)
+        self.sel.register(self.workers.wakeup_recv, selectors.EVENT_READ, data=self.workers)
+        self.stopping = False
+        self.drain_deadline = None
 
         try:
             while True:
-                events = self.sel.select(timeout=None)
+                if self.stopping and self.drained(lsock):
+                    break
+                events = self.sel.select(timeout=0.5 if self.stopping else None)
+                started = time.perf_counter()
                 for key, mask in events:
                     if key.data is None:
                         self.accept_wrapper(key.fileobj)
+                    elif key.data is self.workers:
+                        # finished database work, queue the responses
+                        self.workers.drain()
                     else:
                         message = key.data
                         try:
@@ -73,7 +227,105 @@ class Server:
                                 f"{message.addr}:\n{traceback.format_exc()}",
                             )
                             message.close()
+                if self.metrics is not None and events:
+                    self.metrics.loop_time(time.perf_counter() - started)
         except KeyboardInterrupt:
             print("caught keyboard interrupt, exiting")
         finally:
+            if self.metrics_http is not None:
+                self.metrics_http.shutdown()
             self.sel.close()
+            self.workers.shutdown()
+            self.batch.shutdown(wait=False)
+            self.pool.close()
+
+
+"""
+  _____                             _                
+ /  ___|                           (_)               
+ \ `--. _   _ _ __   ___ _ ____   ___ ___  ___  _ __ 
+  `--. \ | | | '_ \ / _ \ '__\ \ / / / __|/ _ \| '__|
+ /\__/ / |_| | |_) |  __/ |   \ V /| \__ \ (_) | |   
+ \____/ \__,_| .__/ \___|_|    \_/ |_|___/\___/|_|   
+             | |                                     
+             |_|                                     
+"""
+class Supervisor:
+    """ Pre-forks `workers` copies of Server so json encoding can use every core. Each child
+        binds the port itself with SO_REUSEPORT (or, where that isn't available, shares one
+        listening socket created here before forking). Dead children are restarted. SIGTERM
+        (or Ctrl-C) is passed on to the children, which drain their connections and exit.
+        Unix only (needs os.fork).
+    """
+    def __init__(self,workers,db=None,host=None,port=None,threads=None,metrics=None,metrics_port=None):
+        self.workers = workers
+        self.db = db
+        self.host = host or config.host
+        self.port = int(port or config.port)
+        self.threads = threads
+        self.metrics = metrics
+        self.metrics_port = config.metrics_port if metrics_port is None else metrics_port
+        self.reuse_port = config.reuse_port and hasattr(socket, "SO_REUSEPORT")
+        self.lsock = None
+        self.children = {}      # pid -> (time it was started, slot)
+        self.stopping = False
+
+    def spawn(self,slot):
+        """ Forks worker number `slot` (0..workers-1), a restarted worker gets the slot of the
+            one it replaces. Worker n serves its metrics on metrics_port + n.
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (time.monotonic(), slot)
+            return
+        # Child: build the server *after* the fork, MongoClient and threads don't survive one
+        status = 0
+        try:
+            # Ctrl-C hits the whole process group, let the supervisor turn it into a drain
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            metrics_port = int(self.metrics_port) + slot if self.metrics_port else None
+            server = Server(self.db,self.host,self.port,self.threads,self.metrics,metrics_port)
+            server.install_signal_handlers()
+            server.run_server(self.lsock,self.reuse_port)
+        except Exception:
+            print("worker: error:", traceback.format_exc())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def shutdown(self,signum,frame):
+        if self.stopping:
+            return
+        print("supervisor: stopping workers")
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        if not self.reuse_port:
+            self.lsock = Server.listen_socket(self.host, self.port)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+
+        print(f"supervisor: starting {self.workers} workers on", (self.host, self.port))
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            child = self.children.pop(pid, None)
+            if child is None or self.stopping:
+                continue
+            started, slot = child
+            print(f"supervisor: worker {pid} died (status {status}), restarting")
+            if time.monotonic() - started < 1:
+                # Don't spin if it dies straight away
+                time.sleep(1)
+            self.spawn(slot)
+        print("supervisor: all workers stopped")
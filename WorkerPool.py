@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+WorkerPool.py
+Description:
+    Runs the slow parts of a request (mongo queries and json encoding) on a small pool of
+    threads so the selector loop in ServerClass.py only ever does socket I/O. When a job
+    finishes, its callback is queued and one byte is written to a socketpair. The read end
+    of that pair is registered with the server's selector, so the loop wakes up and runs
+    the callbacks itself (see `drain`). Callbacks never run on a worker thread. A job can
+    also `post` callbacks of its own while it runs (streamed responses use this). A callback
+    that raises is logged and only its `owner` (the connection it was for) is closed.
+"""
+import collections
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WorkerPool:
+    def __init__(self, size, queue_limit=None):
+        self.size = size
+        self.queue_limit = queue_limit
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db-worker")
+
+        # wakeup_recv goes in the selector, workers write to wakeup_send
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.completed = collections.deque()
+
+        self.lock = threading.Lock()
+        self.queued = 0         # submitted but no thread has picked them up yet
+        self.running = 0
+        self.max_queue_depth = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.callback_errors = 0
+        self.closed = False     # set by shutdown(), after that post() drops callbacks
+
+    def full(self):
+        """ True when the queue is at its limit and new work should be turned away.
+        """
+        return self.queue_limit is not None and self.queued >= self.queue_limit
+
+    def submit(self, job, callback, owner=None):
+        """ Runs job() on a worker thread, later calls callback(result, error) on the loop
+            thread. Exactly one of result / error is set. `owner` (anything with a close(),
+            the ServerMessage) is closed if the callback raises.
+        """
+        with self.lock:
+            if self.full():
+                self.rejected += 1
+                return False
+            self.queued += 1
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        self.executor.submit(self._run, job, callback, owner)
+        return True
+
+    def _run(self, job, callback, owner):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        result, error = None, None
+        try:
+            result = job()
+        except Exception as e:
+            print("worker: error:", traceback.format_exc())
+            error = e
+            with self.lock:
+                self.failed += 1
+        finally:
+            with self.lock:
+                self.running -= 1
+        self.post(callback, result, error, owner)
+
+    def post(self, callback, result=None, error=None, owner=None):
+        """ Queues callback(result, error) to run on the loop thread. A long job (a streamed
+            search) uses this to hand over partial results before it finishes. Does nothing
+            once the pool is shut down, since no loop is left to run it.
+        """
+        if self.closed:
+            return
+        self.completed.append((callback, result, error, owner))
+        try:
+            self.wakeup_send.send(b"\0")
+        except BlockingIOError:
+            # The pipe is already full of wakeups, the loop will get to us
+            pass
+        except OSError:
+            # shutdown() closed the pair between the check above and the send
+            pass
+
+    def drain(self):
+        """ Called by the selector loop when wakeup_recv is readable. Runs every finished
+            job's callback.
+        """
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.completed:
+            callback, result, error, owner = self.completed.popleft()
+            try:
+                callback(result, error)
+            except Exception:
+                # e.g. a send on a socket the client already reset. Don't let it take the
+                # loop (and every other callback waiting here) down with it.
+                print("main: error: callback failed:", traceback.format_exc())
+                with self.lock:
+                    self.callback_errors += 1
+                if owner is not None and getattr(owner, "sock", None) is not None:
+                    try:
+                        owner.close()
+                    except Exception:
+                        print("main: error: closing after a failed callback:", traceback.format_exc())
+
+    def stats(self):
+        with self.lock:
+            return {
+                "threads": self.size,
+                "queue_depth": self.queued,
+                "max_queue_depth": self.max_queue_depth,
+                "queue_limit": self.queue_limit,
+                "running": self.running,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "callback_errors": self.callback_errors,
+            }
+
+    def shutdown(self):
+        self.closed = True
+        self.executor.shutdown(wait=False)
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
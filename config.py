@@ -2,4 +2,119 @@ database = "armageddon"
 host = "10.0.61.34"
 host2 = "192.168.1.177"
 port = 6000
-debug = False
\ No newline at end of file
+debug = False
+
+# MongoDB connection pool (one per server process, shared by every request)
+mongo_uri = "mongodb://localhost:27017"
+mongo_max_pool_size = 50
+mongo_min_pool_size = 0
+mongo_connect_timeout_ms = 5000
+mongo_server_selection_timeout_ms = 5000
+mongo_socket_timeout_ms = 30000
+mongo_wait_queue_timeout_ms = 5000
+
+# Threads that run database queries / encoding so the selector loop only does socket I/O
+worker_threads = 8
+worker_queue_limit = 1000   # requests waiting for a thread before we answer "busy"
+
+# Multi-process mode (Server.py workers=N)
+server_workers = 1
+reuse_port = True           # each worker binds the port itself (SO_REUSEPORT) if the OS has it
+drain_timeout = 10          # seconds a worker waits for in flight requests after SIGTERM
+
+# "selectors" (ServerClass.py) or "async" (AsyncServerClass.py / AsyncClientClass.py)
+server_mode = "selectors"
+client_mode = "selectors"
+request_timeout = 30        # seconds, asyncio server and client only
+
+# Backpressure and limits. A connection stops being read while more than send_high_water bytes
+# of answers are waiting for it (until it gets below send_low_water) or max_in_flight of its
+# requests are being worked on. Bigger requests are refused (the connection is closed), and so
+# are connections past max_connections (they get a "Server busy" answer). 0 / None = no limit.
+send_high_water = 4 * 1024 * 1024
+send_low_water = 1024 * 1024
+max_in_flight = 256         # requests per connection
+max_request_bytes = 64 * 1024 * 1024
+max_connections = 1000      # per server process
+
+# ClientPool.py: keep-alive connections per server, seconds per attempt (None waits forever),
+# extra attempts, and the first wait before one (doubles each time)
+client_pool_size = 4
+client_timeout = 10
+client_retries = 2
+client_backoff = 0.1
+client_cache_entries = 1000 # answers kept by ClientClass.ResponseCache (Client / ClientPool cache=True)
+
+# Bytes asked for per recv() call (the receive buffer grows past this for big frames)
+recv_chunk_size = 65536
+
+# Streamed search results (request has stream=...)
+stream_chunk_rows = 500     # rows per frame when the request doesn't say
+stream_max_chunk_rows = 10000
+stream_window = 4           # frames a stream may have queued but unsent before the query waits
+
+# Response compression (see Codecs.py). Only bodies at least this big are compressed.
+compress_threshold = 8192   # bytes
+compress_levels = {"zlib": 6, "zstd": 3, "lz4": 0}
+accept_compression = "zstd,lz4,zlib"   # what clients ask for, in order ("" = never compress)
+
+# Frame format. 2 = clients offer the fixed binary header (Protocol.py) and switch to it when the
+# server has it too, servers say they have it. 1 = json headers only, like before.
+protocol_version = 2
+
+# Search result cache (one per server process, see ResultCache.py)
+cache_enabled = True
+cache_max_bytes = 64 * 1024 * 1024
+cache_ttl = 60              # seconds
+
+# Tags on search answers so a client can ask "has it changed?" (see ResultCache.Versions).
+# A tag also runs out after version_ttl seconds, for writes that don't go through this server.
+versions_enabled = True
+version_ttl = 300           # seconds, None: only writes through this server change a tag
+
+# insert_many / update / delete: operations per unordered bulk_write call
+bulk_batch_size = 1000
+
+# batch action: requests carried in one frame and run at the same time
+batch_threads = 8
+batch_max_items = 100
+
+# resample / rolling / returns / stats: documents per round trip when fetching a series
+analytics_batch_size = 10000
+
+# Index advisor: records the filter shapes and latency of searches per collection (index_stats).
+# index_auto builds the suggested index in the background for shapes run at least
+# index_auto_min_count times at an average of index_auto_min_ms or slower.
+index_advisor = True
+index_auto = False
+index_auto_min_count = 20
+index_auto_min_ms = 50
+index_max_shapes = 1000
+
+# db=memory:// keeps everything in the server process (MemoryStore.py) instead of mongo.
+# memory_auto_index indexes a field the first time a filter tests it, memory_load is
+# {collection: jsonl file} loaded when the server starts.
+memory_auto_index = True
+memory_load = {}
+
+# Read only history served from memory mapped column files (ColumnStore.py) instead of mongo:
+# {collection: directory}, e.g. {"data_med": "history/data_med"}. Fill the directory with
+# ./ColumnStore.py collection=data_med first.
+column_store = {}
+
+# Request counters and latency histograms (Metrics.py), shown by action=serverstats.
+# metrics_port also serves them as plain text at http://host:metrics_port/metrics (with
+# workers=N, worker n uses metrics_port + n). None turns that off.
+metrics_enabled = True
+metrics_port = None
+
+# Profiling (action=profile turns it on and off while the server runs, these are the settings
+# it starts with). Requests slower than profile_slow_ms are logged to <profile_dir>/slow.jsonl
+# and profile_sample percent of the matching ones are run under cProfile (see Profiler.py).
+profile_enabled = False
+profile_dir = "profiles"
+profile_sample = 0          # percent
+profile_slow_ms = 500
+profile_actions = ""        # e.g. "search,searchkey", empty matches every action
+profile_collections = ""
+profile_memory = False      # tracemalloc: slow, only for hunting down memory use